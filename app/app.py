@@ -1,14 +1,18 @@
 import os
 
-from flask import Flask, render_template, request, send_from_directory, abort
+from flask import Flask, request, abort
 from flaskext.babel import gettext as _
 import logging
-import logging.handlers
 
-from .extensions import db, mail, login_manager, babel
-from .user.models import User
+from .extensions import (db, mail, login_manager, babel, email_renderer,
+                         hasher, cors, jsend, log, sitemaps, static_root,
+                         timing, metrics)
+from .user.cache import user_cache
 from config import DevConfig, ProdConfig, TestConfig
 from .utils import format_date
+from .middleware import CompressionMiddleware, PreflightMiddleware
+from .hashing import HashingUnavailable
+from .log import BufferedHandler, DigestMailHandler
 
 from .meta import meta
 from .session import session
@@ -34,6 +38,7 @@ def create_app(config=None):
     configure_logging(app)
     configure_template_filters(app)
     configure_error_handlers(app)
+    configure_middleware(app)
 
     return app
 
@@ -66,6 +71,31 @@ def configure_extensions(app):
 
     # Flask-Mail
     mail.init_app(app)
+    email_renderer.init_app(app)
+
+    # Password hashing
+    hasher.init_app(app)
+
+    # CORS
+    cors.init_app(app)
+
+    # JSend responses
+    jsend.init_app(app)
+
+    # Structured logging
+    log.init_app(app)
+
+    # Server-Timing
+    timing.init_app(app)
+
+    # Prometheus metrics
+    metrics.init_app(app)
+
+    # Sitemap cache
+    sitemaps.init_app(app)
+
+    # Static files served from the root
+    static_root.init_app(app)
 
     # Flask-Login
     #login_manager.anonymous_user = Anonymous  TODO
@@ -76,9 +106,11 @@ def configure_extensions(app):
         _(u"To protect your account, please reauthenticate to access this page.")
     )
 
+    user_cache.init_app(app)
+
     @login_manager.user_loader
     def load_user(id):
-        return User.query.get(int(id))
+        return user_cache.load(int(id))
     login_manager.setup_app(app)
 
 
@@ -89,6 +121,15 @@ def configure_blueprints(app, blueprints):
         app.register_blueprint(blueprint)
 
 
+def configure_middleware(app):
+    """Wrap WSGI middlewares around the app."""
+
+    if app.config.get('CORS_PREFLIGHT_MIDDLEWARE', True):
+        app.wsgi_app = PreflightMiddleware(app, app.wsgi_app)
+    if app.config.get('COMPRESS_ENABLED', True):
+        app.wsgi_app = CompressionMiddleware(app, app.wsgi_app)
+
+
 def configure_template_filters(app):
 
     app.jinja_env.filters['format_date'] = format_date
@@ -100,7 +141,12 @@ def configure_template_filters(app):
 def configure_hooks(app):
     @app.before_request
     def before_request():
-        pass
+        timing.start_request()
+
+    @app.after_request
+    def after_request(response):
+        metrics.record_request(response.status_code)
+        return timing.finish_request(response)
 
 
 def configure_logging(app):
@@ -115,13 +161,12 @@ def configure_logging(app):
     # Suppress DEBUG messages.
     app.logger.setLevel(logging.INFO)
 
-    # Error mails
-    mail_handler = logging.handlers.SMTPHandler(app.config['MAIL_SERVER'],
-                               app.config['MAIL_USERNAME'],
-                               app.config['ADMINS'],
-                               'Oops... %s failed!' % app.config['APP_NAME'],
-                               (app.config['MAIL_USERNAME'],
-                                app.config['MAIL_PASSWORD']))
+    # Emit records from a listener thread, off the request.
+    app.logger.handlers[:] = [BufferedHandler(app.logger.handlers,
+                                              app.config['LOG_BUFFER_SIZE'])]
+
+    # Error mails, coalesced into digests by their own listener thread.
+    mail_handler = DigestMailHandler.from_config(app.config)
     mail_handler.setLevel(logging.ERROR)
     mail_handler.setFormatter(logging.Formatter(
         '%(asctime)s %(levelname)s: %(message)s '
@@ -139,15 +184,22 @@ def configure_app_handlers(app):
     def iusedtobehere():
         abort(410)
 
-    @app.route('/robots.txt')
     def static_from_root():
-        return send_from_directory(app.static_folder, request.path[1:])
+        return static_root.send(request.path[1:], request)
+    for filename in app.config['STATIC_ROOT_FILES']:
+        app.add_url_rule('/' + filename, 'static_from_root', static_from_root)
 
     @app.route('/sitemap.xml')
-    def sitemap():
-        url_root = request.url_root[:-1]
-        rules = app.url_map.iter_rules()
-        return render_template('sitemap.xml', url_root=url_root, rules=rules)
+    @app.route('/sitemap-<int:page>.xml')
+    def sitemap(page=None):
+        content = sitemaps.get(request.url_root[:-1], page)
+        if content is None:
+            abort(404)
+        return content.make_response(request)
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        return metrics.scrape()
 
 
 def configure_error_handlers(app):
@@ -175,3 +227,11 @@ def configure_error_handlers(app):
     @app.errorhandler(500)
     def server_error(error):
         return 'Internal Server Error.', 500
+
+    @app.errorhandler(HashingUnavailable)
+    def hashing_unavailable(error):
+        # Back-pressure: password hashing is saturated, retry later.
+        response = jsend.error(_('Too busy, please try again shortly.'), 503)
+        response.headers['Retry-After'] = \
+            str(app.config['PASSWORD_HASH_RETRY_AFTER'])
+        return response
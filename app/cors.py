@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Matching of request origins against the origins allowed for CORS.
+
+ORIGINS_ALLOWED is compiled once, when the app is created, into a set of
+exact origins and one regex for the wildcard ones: '*' stands for one or
+more subdomain labels, so 'https://*.example.com' allows
+'https://www.example.com' and 'https://a.b.example.com' but not
+'https://example.com'.
+"""
+
+import re
+from datetime import timedelta
+
+WILDCARD = r'[a-z0-9-]+(?:\.[a-z0-9-]+)*'
+
+
+class OriginMatcher(object):
+    """A compiled set of allowed origins; test origins with ``in``."""
+
+    def __init__(self, origins=()):
+        self.exact = set()
+        patterns = []
+        for origin in origins:
+            origin = origin.lower().rstrip('/')
+            if '*' in origin:
+                patterns.append(re.escape(origin).replace(r'\*', WILDCARD))
+            else:
+                self.exact.add(origin)
+        self.pattern = re.compile('^(?:%s)$' % '|'.join(patterns)) \
+            if patterns else None
+
+    def __contains__(self, origin):
+        origin = origin.lower()
+        if origin in self.exact:
+            return True
+        return self.pattern is not None and \
+            self.pattern.match(origin) is not None
+
+
+class CrossDomainPolicy(object):
+    """
+    The CORS settings of a crossdomain decorated view (see its arguments),
+    with its header block computed once and its OPTIONS responses' headers
+    cached per (URL rule, origin).
+    """
+
+    def __init__(self, origin=None, methods=None, headers=None,
+                 max_age=21600, attach_to_all=True, automatic_options=True):
+        if methods is not None:
+            methods = ', '.join(sorted(x.upper() for x in methods))
+        if headers is not None and not isinstance(headers, basestring):
+            headers = ', '.join(x.upper() for x in headers)
+        if isinstance(max_age, timedelta):
+            max_age = max_age.total_seconds()
+        self.methods = methods
+        self.attach_to_all = attach_to_all
+        self.automatic_options = automatic_options
+        self.origins = OriginMatcher(origin or ())
+
+        self.static_headers = [
+            ('Access-Control-Allow-Credentials', 'true'),
+            ('Access-Control-Max-Age', str(int(max_age))),
+        ]
+        if headers is not None:
+            self.static_headers.append(('Access-Control-Allow-Headers',
+                                        headers))
+        self._allowed_methods = {}  # URL rule -> allowed methods
+        self._preflights = {}  # (URL rule, origin) -> OPTIONS headers
+
+    def allows(self, origin, app_origins):
+        """Whether origin is allowed by the app's or the view's origins."""
+        return origin in app_origins or origin in self.origins
+
+    def allowed_methods(self, rule, get_allow):
+        """
+        Return the methods allowed for the URL rule; get_allow returns the
+        rule's Allow header and is only called if the decorator wasn't given
+        methods, once per rule.
+        """
+        if self.methods is not None:
+            return self.methods
+        allowed = self._allowed_methods.get(rule)
+        if allowed is None:
+            allowed = self._allowed_methods[rule] = get_allow()
+        return allowed
+
+    def headers(self, rule, origin, get_allow):
+        """Return the CORS headers of a response to origin."""
+        return self.static_headers + [
+            ('Access-Control-Allow-Origin', origin),
+            ('Access-Control-Allow-Methods',
+             self.allowed_methods(rule, get_allow)),
+            ('Vary', 'Origin'),
+        ]
+
+    def preflight_headers(self, rule, origin, get_allow):
+        """Return the headers of the OPTIONS response to origin."""
+        key = (rule, origin)
+        h = self._preflights.get(key)
+        if h is None:
+            if len(self._preflights) >= 1024:
+                self._preflights.clear()
+            h = self._preflights[key] = [('Allow', get_allow())] + \
+                self.headers(rule, origin, get_allow)
+        return h
+
+
+class CORS(object):
+    """Compiles the app's ORIGINS_ALLOWED for the crossdomain decorator."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ORIGINS_ALLOWED', [])
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+        app.extensions['cors'] = OriginMatcher(app.config['ORIGINS_ALLOWED'])
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+Flask-SQLAlchemy with a configurable, instrumented connection pool.
+
+Besides Flask-SQLAlchemy's SQLALCHEMY_POOL_SIZE, _POOL_TIMEOUT and
+_POOL_RECYCLE, SQLALCHEMY_MAX_OVERFLOW sets how many connections are
+opened past the pool size under load and SQLALCHEMY_POOL_PRE_PING tests
+connections as they're checked out, replacing those the server dropped.
+New SQLite connections run the SQLALCHEMY_SQLITE_PRAGMAS; SQLite files
+only get a pool if its size is set.
+
+Each engine's pool records its checkouts in a PoolStats, returned by
+db.pool_stats(). A process holds at most pool size + max overflow
+connections per engine, so under gunicorn the database sees up to that
+many times the number of workers.
+
+With SQLALCHEMY_REPLICAS set, db.session is a RoutingSession: the
+SELECTs of GET, HEAD and OPTIONS requests go to one of the replicas,
+with its own pool, and everything else goes to the primary. Only
+requests the app dispatches read from replicas: the outbox workers and
+manage.py commands run in request contexts of their own, and always use
+the primary. A client that commits a write reads from the primary for
+the next SQLALCHEMY_REPLICA_STICKINESS seconds, so it sees its writes
+whatever the replication lag.
+"""
+
+import random
+import time
+from functools import partial
+from threading import Lock
+
+from flask import (_request_ctx_stack, has_request_context, request,
+                   session)
+from flask.ext.sqlalchemy import (SQLAlchemy as BaseSQLAlchemy,
+                                  _EngineConnector, _SignallingSession)
+from sqlalchemy import event, exc, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import CompoundSelect, Select
+
+from .timing import record_phase
+
+# Requests whose reads may go to a replica.
+SAFE_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+# Key of the client's session holding when it may read from replicas again.
+PRIMARY_UNTIL_KEY = '_primary_until'
+
+
+class PoolStats(object):
+    """Checkouts of an engine's pool and the time spent waiting for them."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.in_use = 0
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.checkout_seconds = 0.0
+            self.max_checkout_seconds = 0.0
+            self.timeouts = 0
+            self.max_in_use = self.in_use
+            self.max_overflow = 0
+            self.connects = 0
+            self.disconnects = 0
+
+    def checked_out(self, seconds, overflow):
+        with self._lock:
+            self.checkouts += 1
+            self.checkout_seconds += seconds
+            self.max_checkout_seconds = max(self.max_checkout_seconds,
+                                            seconds)
+            self.max_overflow = max(self.max_overflow, overflow)
+
+    def timed_out(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def on_checkout(self, dbapi_connection, connection_record,
+                    connection_proxy):
+        with self._lock:
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.in_use -= 1
+
+    def on_disconnect(self):
+        with self._lock:
+            self.disconnects += 1
+
+    def as_dict(self, pool):
+        with self._lock:
+            stats = {
+                'checkouts': self.checkouts,
+                'checkout_seconds': self.checkout_seconds,
+                'mean_checkout_seconds': self.checkout_seconds /
+                self.checkouts if self.checkouts else None,
+                'max_checkout_seconds': self.max_checkout_seconds,
+                'timeouts': self.timeouts,
+                'in_use': self.in_use,
+                'max_in_use': self.max_in_use,
+                'max_overflow': self.max_overflow,
+                'connects': self.connects,
+                'disconnects': self.disconnects,
+            }
+        # Only QueuePools have a size and an overflow.
+        stats['pool_size'] = pool.size() if hasattr(pool, 'size') else None
+        stats['overflow'] = _overflow(pool)
+        return stats
+
+
+def _overflow(pool):
+    """Return the connections a pool has open past its size."""
+    if not hasattr(pool, 'overflow'):
+        return 0
+    # A QueuePool's overflow counts up from -size.
+    return max(0, pool.overflow())
+
+
+class TimedPool(object):
+    """Mixed into an engine's pool class to time its checkouts."""
+
+    #: The engine's PoolStats, set on the class made for it.
+    stats = None
+
+    def connect(self):
+        return self._timed(super(TimedPool, self).connect)
+
+    def unique_connection(self):
+        # Engine.connect() checks out through here.
+        return self._timed(super(TimedPool, self).unique_connection)
+
+    def _timed(self, checkout):
+        started = time.time()
+        try:
+            connection = checkout()
+        except exc.TimeoutError:
+            self.stats.timed_out()
+            raise
+        seconds = time.time() - started
+        self.stats.checked_out(seconds, _overflow(self))
+        record_phase('db', seconds)
+        return connection
+
+
+class RoutingSession(_SignallingSession):
+    """
+    A session reading from a replica when the request and the client allow
+    it; writes, and reads following them, go to the primary.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        self.wrote = False
+        self._replica = None
+        _SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or not isinstance(clause, (Select, CompoundSelect)):
+            self.wrote = True
+        if self.wrote or not self.reads_from_replica():
+            return _SignallingSession.get_bind(self, mapper, clause)
+        if self._replica is None:
+            self._replica = self.db.get_engine(
+                self.app, random.choice(self.db.replica_binds(self.app)))
+        return self._replica
+
+    def reads_from_replica(self):
+        if not self.app.config['SQLALCHEMY_REPLICAS'] or \
+                not has_request_context() or \
+                not getattr(_request_ctx_stack.top, 'replica_reads', False) \
+                or request.method not in SAFE_METHODS:
+            return False
+        return session.get(PRIMARY_UNTIL_KEY, 0) <= time.time()
+
+    def commit(self):
+        _SignallingSession.commit(self)
+        if self.wrote and self.app.config['SQLALCHEMY_REPLICAS'] and \
+                has_request_context():
+            session[PRIMARY_UNTIL_KEY] = time.time() + \
+                self.app.config['SQLALCHEMY_REPLICA_STICKINESS']
+
+
+class _ReplicaConnector(_EngineConnector):
+    """Connects to the replica at index in SQLALCHEMY_REPLICAS."""
+
+    def __init__(self, sa, app, bind, index):
+        _EngineConnector.__init__(self, sa, app, bind)
+        self.index = index
+
+    def get_uri(self):
+        return self._app.config['SQLALCHEMY_REPLICAS'][self.index]
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_MAX_OVERFLOW', None)
+        app.config.setdefault('SQLALCHEMY_POOL_PRE_PING', False)
+        app.config.setdefault('SQLALCHEMY_SQLITE_PRAGMAS', [])
+        app.config.setdefault('SQLALCHEMY_REPLICAS', [])
+        app.config.setdefault('SQLALCHEMY_REPLICA_STICKINESS', 10)
+        super(SQLAlchemy, self).init_app(app)
+        app.before_request(_allow_replica_reads)
+
+    def create_scoped_session(self, options=None):
+        if options is None:
+            options = {}
+        scopefunc = options.pop('scopefunc', None)
+        return orm.scoped_session(partial(RoutingSession, self, **options),
+                                  scopefunc=scopefunc)
+
+    def replica_binds(self, app):
+        """Return the bind keys of the replicas' engines."""
+        return ['replica%d' % index for index in
+                range(len(app.config['SQLALCHEMY_REPLICAS']))]
+
+    def make_connector(self, app, bind=None):
+        replicas = self.replica_binds(app)
+        if bind in replicas:
+            return _ReplicaConnector(self, app, bind, replicas.index(bind))
+        return super(SQLAlchemy, self).make_connector(app, bind)
+
+    def apply_pool_defaults(self, app, options):
+        super(SQLAlchemy, self).apply_pool_defaults(app, options)
+        if app.config['SQLALCHEMY_MAX_OVERFLOW'] is not None:
+            options['max_overflow'] = app.config['SQLALCHEMY_MAX_OVERFLOW']
+
+    def apply_driver_hacks(self, app, info, options):
+        super(SQLAlchemy, self).apply_driver_hacks(app, info, options)
+        dialect = info.get_dialect()
+        poolclass = options.get('poolclass')
+        if poolclass is None:
+            # A sized pool is a QueuePool, even for SQLite files.
+            poolclass = QueuePool if 'pool_size' in options else \
+                dialect.get_pool_class(info)
+        if dialect.name == 'sqlite' and issubclass(poolclass, QueuePool):
+            # Pooled connections are checked out by any thread.
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+        # A class per engine: the pool keeps it when it's recreated.
+        stats = PoolStats()
+        poolclass = type('Timed' + poolclass.__name__,
+                         (TimedPool, poolclass), {'stats': stats})
+        event.listen(poolclass, 'connect', stats.on_connect)
+        # Before the stats count the checkout: a failed ping's connection is
+        # invalidated without a checkin.
+        if app.config['SQLALCHEMY_POOL_PRE_PING']:
+            event.listen(poolclass, 'checkout', _pinger(stats))
+        event.listen(poolclass, 'checkout', stats.on_checkout)
+        event.listen(poolclass, 'checkin', stats.on_checkin)
+        if dialect.name == 'sqlite' and app.config['SQLALCHEMY_SQLITE_PRAGMAS']:
+            event.listen(poolclass, 'connect',
+                         _pragmas(app.config['SQLALCHEMY_SQLITE_PRAGMAS']))
+        options['poolclass'] = poolclass
+
+    def pool_stats(self, app=None):
+        """Return the pool stats of each engine, by bind (None for the
+        default one)."""
+        app = self.get_app(app)
+        binds = [None] + list(app.config.get('SQLALCHEMY_BINDS') or ()) + \
+            self.replica_binds(app)
+        result = {}
+        for bind in binds:
+            pool = self.get_engine(app, bind).pool
+            result[bind] = pool.stats.as_dict(pool)
+        return result
+
+
+def _allow_replica_reads():
+    # Not called for the request contexts workers and commands push.
+    _request_ctx_stack.top.replica_reads = True
+
+
+def _pinger(stats):
+    """Return a checkout listener replacing connections that fail a ping."""
+
+    def ping(dbapi_connection, connection_record, connection_proxy):
+        try:
+            cursor = dbapi_connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+        except Exception:
+            stats.on_disconnect()
+            # The pool invalidates the connection and checks out another.
+            raise exc.DisconnectionError()
+    return ping
+
+
+def _pragmas(pragmas):
+    """Return a connect listener setting pragmas on SQLite connections."""
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+    return set_pragmas
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Rendering of CSS inlined transactional emails.
+
+Inlining the email CSS with premailer (an lxml parse, CSS cascade and
+serialize) is the expensive part of building an email, and its output only
+depends on the template and the locale. So each template is rendered once
+with placeholders standing in for the per-recipient variables, inlined,
+and cached; sending an email then only fills the placeholders in.
+"""
+
+import os
+import re
+from threading import Lock
+
+from jinja2 import Markup, escape
+from jinja2.meta import find_referenced_templates
+from premailer import Premailer
+
+from flask import current_app, render_template
+from flaskext.babel import get_locale
+
+from .timing import PhaseTimer
+from .utils import get_resource_as_string
+
+# Only made of characters lxml leaves alone, even in URL attributes.
+PLACEHOLDER = 'EMAILVAR-%s-EMAILVAR'
+PLACEHOLDER_RE = re.compile(r'EMAILVAR-(\w+)-EMAILVAR')
+
+
+class InlinedTemplate(object):
+    """A CSS inlined email skeleton with placeholders for its variables."""
+
+    def __init__(self, html, sources):
+        self.html = html
+        # [(path, mtime)] of the files this skeleton was built from.
+        self.sources = sources
+
+    def fill(self, context):
+        return PLACEHOLDER_RE.sub(
+            lambda match: escape(context[match.group(1)]), self.html)
+
+    def is_stale(self):
+        for path, mtime in self.sources:
+            try:
+                if os.path.getmtime(path) != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+
+class EmailRenderer(object):
+    """Render CSS inlined emails from cached skeletons."""
+
+    def __init__(self, app=None):
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('EMAIL_CSS', 'static/css/email.css')
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+        app.extensions['email_renderer'] = {}
+
+    def render(self, template, **context):
+        """
+        Render the template with the context and inline its CSS.
+
+        Context values are only substituted in as (escaped) text, so
+        templates must not apply filters or logic to them.
+        """
+        cache = current_app.extensions['email_renderer']
+        key = (template, str(get_locale()), frozenset(context))
+        inlined = cache.get(key)
+        # Templates are only reloaded in debug mode.
+        if inlined is None or (current_app.debug and inlined.is_stale()):
+            with self._lock:
+                inlined = cache[key] = self.compile(template, context)
+        with PhaseTimer('render'):
+            return inlined.fill(context)
+
+    def compile(self, template, context):
+        """Render the template with placeholders and inline its CSS."""
+        css_name = current_app.config['EMAIL_CSS']
+        placeholders = dict((name, Markup(PLACEHOLDER % name))
+                            for name in context)
+        with PhaseTimer('render'):
+            html = render_template(template,
+                                   css=get_resource_as_string(css_name),
+                                   **placeholders)
+        with PhaseTimer('inline'):
+            html = Premailer(html).transform()
+
+        sources = [os.path.join(current_app.root_path, css_name)]
+        sources.extend(self._template_paths(template))
+        return InlinedTemplate(html, [(path, os.path.getmtime(path))
+                                      for path in sources])
+
+    def _template_paths(self, template):
+        """Yield the paths of the template and the ones it extends/includes."""
+        env = current_app.jinja_env
+        seen = set()
+        pending = [template]
+        while pending:
+            name = pending.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            source, path, uptodate = env.loader.get_source(env, name)
+            yield path
+            pending.extend(ref for ref in
+                           find_referenced_templates(env.parse(source))
+                           if ref is not None)
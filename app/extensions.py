@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from flask.ext.sqlalchemy import SQLAlchemy
+from .database import SQLAlchemy
 db = SQLAlchemy()
 
 from flask.ext.mail import Mail
@@ -11,3 +11,30 @@ login_manager = LoginManager()
 
 from flask.ext.babel import Babel
 babel = Babel()
+
+from .emails import EmailRenderer
+email_renderer = EmailRenderer()
+
+from .hashing import HashingExecutor
+hasher = HashingExecutor()
+
+from .cors import CORS
+cors = CORS()
+
+from .sitemap import Sitemaps
+sitemaps = Sitemaps()
+
+from .static_root import StaticRoot
+static_root = StaticRoot()
+
+from .jsend import JSend
+jsend = JSend()
+
+from .log import StructuredLogger
+log = StructuredLogger()
+
+from .timing import RequestTiming
+timing = RequestTiming()
+
+from .metrics import Metrics
+metrics = Metrics()
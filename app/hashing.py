@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Password hashing off the request thread.
+
+Hashing and verifying passwords is deliberately expensive CPU work. Run in
+the request thread it takes a whole core and, under threaded or green
+workers, holds the GIL. The HashingExecutor runs it in a pool of
+PASSWORD_HASH_WORKERS processes instead, with at most
+PASSWORD_HASH_QUEUE_SIZE hashes in flight per process. With 0 workers
+(e.g. in tests) hashing runs inline.
+
+A hash that can't get a slot, or isn't done, within PASSWORD_HASH_TIMEOUT
+raises HashingUnavailable, which the app answers with a 503 and a
+Retry-After of PASSWORD_HASH_RETRY_AFTER seconds: back-pressure rather
+than a pile of waiting requests.
+
+What passwords are hashed with is decided by the policy (see passwords).
+"""
+
+import os
+import time
+from multiprocessing import Pool, TimeoutError
+from threading import Condition, Lock
+
+from passlib.context import CryptContext
+
+from .passwords import context_from_config
+from .timing import PhaseTimer
+
+
+class HashingUnavailable(RuntimeError):
+    """Raised when a password can't be hashed in time."""
+
+
+class HashingQueueFull(HashingUnavailable):
+    """Raised when no hashing slot frees up within PASSWORD_HASH_TIMEOUT."""
+
+
+class HashingTimeout(HashingUnavailable):
+    """Raised when a hash isn't done within PASSWORD_HASH_TIMEOUT."""
+
+
+# Run in the worker processes, so they must be module level functions.
+# They get the hash policy as a CryptContext string and return
+# (result, started, elapsed) for the executor's stats.
+
+_contexts = {}
+
+
+def _get_context(policy):
+    context = _contexts.get(policy)
+    if context is None:
+        context = _contexts[policy] = CryptContext.from_string(policy)
+    return context
+
+
+def _encrypt(policy, password):
+    started = time.time()
+    hash = _get_context(policy).encrypt(password)
+    return hash, started, time.time() - started
+
+
+def _call(func, args):
+    # Errors are returned, not raised, so the pool always calls back.
+    try:
+        return True, func(*args)
+    except Exception as e:
+        return False, e
+
+
+def _verify_and_update(policy, password, hash):
+    started = time.time()
+    result = _get_context(policy).verify_and_update(password, hash)
+    return result, started, time.time() - started
+
+
+class HashingStats(object):
+    """Queue wait and hash time totals, in seconds."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self.rejected = 0
+            self.queue_wait = 0.0
+            self.queue_wait_max = 0.0
+            self.hash_time = 0.0
+            self.hash_time_max = 0.0
+
+    def record(self, queue_wait, hash_time):
+        with self._lock:
+            self.count += 1
+            self.queue_wait += queue_wait
+            self.queue_wait_max = max(self.queue_wait_max, queue_wait)
+            self.hash_time += hash_time
+            self.hash_time_max = max(self.hash_time_max, hash_time)
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {'count': self.count,
+                    'rejected': self.rejected,
+                    'queue_wait': self.queue_wait,
+                    'queue_wait_max': self.queue_wait_max,
+                    'hash_time': self.hash_time,
+                    'hash_time_max': self.hash_time_max}
+
+
+class HashingExecutor(object):
+    """Hash and verify passwords in a process pool."""
+
+    def __init__(self, app=None):
+        self.workers = 0
+        self.queue_size = 0
+        self.timeout = None
+        self.context = None
+        self.policy = None
+        self.stats = HashingStats()
+        self._pool = None
+        self._pid = None
+        self._lock = Lock()
+        self._slots = Condition(Lock())
+        self._in_flight = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_WORKERS', 0)
+        app.config.setdefault('PASSWORD_HASH_QUEUE_SIZE', 64)
+        app.config.setdefault('PASSWORD_HASH_TIMEOUT', 10)
+        app.config.setdefault('PASSWORD_HASH_RETRY_AFTER', 5)
+        app.config.setdefault('PASSWORD_SCHEMES', ['sha256_crypt'])
+        app.config.setdefault('PASSWORD_ROUNDS', 12345)
+        app.config.setdefault('PASSWORD_ROUNDS_TOLERANCE', 0.25)
+        app.config.setdefault('PASSWORD_CALIBRATE', False)
+        app.config.setdefault('PASSWORD_VERIFY_TIME', 0.1)
+        self.shutdown()
+        self.workers = app.config['PASSWORD_HASH_WORKERS']
+        self.queue_size = app.config['PASSWORD_HASH_QUEUE_SIZE']
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+        self.context = context_from_config(app.config)
+        self.policy = self.context.to_string()
+
+    def encrypt(self, password):
+        """Return the hash of password."""
+        return self._run(_encrypt, self.policy, password)
+
+    def verify(self, password, hash):
+        """Return whether password matches hash."""
+        return self.verify_and_update(password, hash)[0]
+
+    def verify_and_update(self, password, hash):
+        """
+        Return whether password matches hash, and a new hash if it does but
+        hash doesn't comply with the policy anymore (otherwise None).
+        """
+        return self._run(_verify_and_update, self.policy, password, hash)
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.terminate()
+            self._pool = None
+        # Hashes of a terminated pool never finish.
+        with self._slots:
+            self._in_flight = 0
+            self._slots.notify_all()
+
+    def _get_pool(self):
+        # Pools don't survive a fork (e.g. gunicorn's preload), so each
+        # process lazily starts its own.
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = Pool(self.workers)
+                self._pid = os.getpid()
+            return self._pool
+
+    def _run(self, func, *args):
+        submitted = time.time()
+        with PhaseTimer('hash'):
+            if not self.workers:
+                result, started, elapsed = func(*args)
+            else:
+                # The slot is held until the pool is done with the hash,
+                # even if we stop waiting for it: the pool can't cancel it.
+                self._acquire_slot()
+                try:
+                    pending = self._get_pool().apply_async(
+                        _call, (func, args), callback=self._finished)
+                except Exception:
+                    self._release_slot()
+                    raise
+                try:
+                    ok, value = pending.get(self.timeout)
+                except TimeoutError:
+                    raise HashingTimeout('Password hash not done in %ss.'
+                                         % self.timeout)
+                if not ok:
+                    raise value
+                result, started, elapsed = value
+        self.stats.record(max(0.0, started - submitted), elapsed)
+        return result
+
+    def _acquire_slot(self):
+        deadline = time.time() + self.timeout
+        with self._slots:
+            while self._in_flight >= self.queue_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.stats.reject()
+                    raise HashingQueueFull('%s password hashes in flight.'
+                                           % self._in_flight)
+                self._slots.wait(remaining)
+            self._in_flight += 1
+
+    def _finished(self, outcome):
+        # Called by the pool's result thread.
+        self._release_slot()
+
+    def _release_slot(self):
+        with self._slots:
+            self._in_flight -= 1
+            self._slots.notify()
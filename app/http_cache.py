@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP caching helpers: bodies kept in memory with precompressed variants
+and ETags, answered with 304 when the client already has them; and weak
+ETags for dynamic resources, derived from the versions of the rows they're
+built from, so they can be revalidated without building them.
+"""
+
+import gzip
+import hashlib
+from cStringIO import StringIO
+
+from flask import current_app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def gzip_bytes(data, level=9):
+    """Return data gzip compressed, with a constant header (no mtime)."""
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level, mtime=0)
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+
+# Content-Encodings bodies are precompressed with, in order of preference.
+ENCODINGS = [('gzip', gzip_bytes)]
+if brotli is not None:
+    ENCODINGS.insert(0, ('br', brotli.compress))
+
+
+class CachedContent(object):
+    """
+    A response body built once, with its compressed variants (gzip, and
+    brotli if installed) that are smaller, and a strong ETag per variant.
+    """
+
+    def __init__(self, data, mimetype, max_age=0):
+        self.mimetype = mimetype
+        self.max_age = max_age
+        self.etag = hashlib.sha1(data).hexdigest()
+        # Content-Encoding -> (body, ETag)
+        self.variants = {None: (data, self.etag)}
+        for encoding, compress in ENCODINGS:
+            compressed = compress(data)
+            if len(compressed) < len(data):
+                self.variants[encoding] = (compressed,
+                                           '%s-%s' % (self.etag, encoding))
+
+    @property
+    def data(self):
+        return self.variants[None][0]
+
+    def choose_encoding(self, request):
+        for encoding, compress in ENCODINGS:
+            if encoding in self.variants and \
+                    request.accept_encodings[encoding]:
+                return encoding
+        return None
+
+    def make_response(self, request):
+        """Return the variant the request accepts, or a 304."""
+        encoding = self.choose_encoding(request)
+        data, etag = self.variants[encoding]
+        if request.if_none_match.contains_weak(etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = current_app.response_class(data,
+                                                  mimetype=self.mimetype)
+            if encoding is not None:
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        if len(self.variants) > 1:
+            response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.max_age = self.max_age
+        return response
+
+
+def version_etag(*versions):
+    """Return the ETag of a representation built from versions."""
+    return hashlib.sha1(repr(versions)).hexdigest()
+
+
+def not_modified(request, etag):
+    """Return a 304 response if the request has etag, otherwise None."""
+    if request.if_none_match.contains_weak(etag):
+        return set_version_etag(current_app.response_class(status=304), etag)
+    return None
+
+
+def set_version_etag(response, etag):
+    """
+    Tag a response of the current user's with a weak etag, to be
+    revalidated on each use.
+    """
+    # Werkzeug would write the weak prefix lowercase.
+    response.headers['ETag'] = 'W/"%s"' % etag
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+JSend responses (http://labs.omniti.com/labs/jsend).
+
+Flask 0.8's jsonify indents its output, which also keeps the stdlib
+encoder off its C accelerated path. JSend responses are instead encoded
+compactly by the fastest encoder available (JSEND_ENCODER, see ENCODERS)
+and the envelope around the data is written as constant byte chunks, so
+the encoded data goes into the response body as is. Whole responses that
+never change (e.g. a bare success) are encoded once, with envelope().
+"""
+
+import json
+
+from flask import current_app
+
+from .timing import PhaseTimer
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+MIMETYPE = 'application/json'
+
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj, escape_forward_slashes=False)
+
+
+# Encoder name -> function encoding an object to compact JSON, fastest
+# first; the stdlib one is always available.
+ENCODERS = []
+if ujson is not None:
+    ENCODERS.append(('ujson', _ujson_dumps))
+if simplejson is not None:
+    ENCODERS.append(('simplejson',
+                     simplejson.JSONEncoder(separators=(',', ':')).encode))
+ENCODERS.append(('json', json.JSONEncoder(separators=(',', ':')).encode))
+
+_stdlib_encode = ENCODERS[-1][1]
+
+
+def envelope(status, data=None, message=None):
+    """Return a whole JSend response body, to keep as a constant."""
+    body = {'status': status}
+    if data is not None:
+        body['data'] = data
+    if message is not None:
+        body['message'] = message
+    return _stdlib_encode(body)
+
+
+SUCCESS = envelope('success')
+FAIL = envelope('fail')
+
+_DATA_PREFIX = {
+    'success': '{"status":"success","data":',
+    'fail': '{"status":"fail","data":',
+}
+_SUFFIX = '}'
+
+
+class JSend(object):
+    """Build JSend responses with the configured encoder."""
+
+    def __init__(self, app=None):
+        self.encode = _stdlib_encode
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('JSEND_ENCODER', None)
+        name = app.config['JSEND_ENCODER']
+        encoders = dict(ENCODERS)
+        if name is None:
+            self.encode = ENCODERS[0][1]
+        elif name in encoders:
+            self.encode = encoders[name]
+        else:
+            raise ValueError('Unknown or unavailable JSON encoder: %s. '
+                             'Available: %s.' % (name, ', '.join(encoders)))
+
+    def respond(self, body, status_code=200):
+        """Return a response with an encoded body: a string or a list of
+        strings."""
+        if isinstance(body, basestring):
+            body = [body]
+        response = current_app.response_class(body, status=status_code,
+                                              mimetype=MIMETYPE)
+        response.headers['Content-Length'] = str(sum(map(len, body)))
+        return response
+
+    def success(self, data=None, status_code=200):
+        if data is None:
+            return self.respond(SUCCESS, status_code)
+        with PhaseTimer('serialize'):
+            encoded = self.encode(data)
+        return self.respond([_DATA_PREFIX['success'], encoded, _SUFFIX],
+                            status_code)
+
+    def fail(self, data=None, status_code=200):
+        if data is None:
+            return self.respond(FAIL, status_code)
+        with PhaseTimer('serialize'):
+            encoded = self.encode(data)
+        return self.respond([_DATA_PREFIX['fail'], encoded, _SUFFIX],
+                            status_code)
+
+    def error(self, message, status_code=500, code=None, data=None):
+        body = {'status': 'error', 'message': message}
+        if code is not None:
+            body['code'] = code
+        if data is not None:
+            body['data'] = data
+        with PhaseTimer('serialize'):
+            encoded = self.encode(body)
+        return self.respond(encoded, status_code)
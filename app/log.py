@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+Structured logging for the blueprints.
+
+    log.debug('Returning fail', errors=form.errors)
+
+Fields are only formatted, as sorted ``key=value`` pairs after the message,
+if the record is emitted, and then by the BufferedHandler's thread rather
+than the request's. Records below WARNING are sampled per request: a
+request to an endpoint keeps all or none of its debug and info records,
+with the probability set in LOG_SAMPLE_RATES (endpoint -> rate) or else
+LOG_SAMPLE_RATE. Handlers can read the fields from ``record.fields``.
+
+Handlers doing I/O sit behind a queue drained by a listener thread:
+BufferedHandler for the usual handlers, DigestMailHandler for error mails.
+"""
+
+import logging
+import os
+import random
+import re
+import smtplib
+import time
+import traceback
+from collections import OrderedDict, deque
+from email.mime.text import MIMEText
+from email.utils import formatdate
+from Queue import Queue, Empty, Full
+from threading import Lock, Thread
+
+from flask import current_app, json, _request_ctx_stack
+
+# Field values printed as they are; anything else is JSON encoded.
+SIMPLE_VALUE_RE = re.compile(r'^[\w./:@#%+-]+$')
+
+
+def format_value(value):
+    if isinstance(value, basestring) and SIMPLE_VALUE_RE.match(value):
+        return str(value)
+    return json.dumps(value, default=repr)
+
+
+class LogMessage(object):
+    """A log message whose fields are formatted when it's emitted."""
+
+    __slots__ = ('message', 'fields')
+
+    def __init__(self, message, fields):
+        self.message = message
+        self.fields = fields
+
+    def __str__(self):
+        if not self.fields:
+            return self.message
+        return '%s %s' % (self.message, ' '.join(
+            '%s=%s' % (key, format_value(self.fields[key]))
+            for key in sorted(self.fields)))
+
+
+class StructuredLogger(object):
+    """Log to current_app.logger with deferred, sampled key/value records."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LOG_SAMPLE_RATE', 1.0)
+        app.config.setdefault('LOG_SAMPLE_RATES', {})
+        app.config.setdefault('LOG_BUFFER_SIZE', 10000)
+        app.config.setdefault('ERROR_MAIL_WINDOW', 60)
+        app.config.setdefault('ERROR_MAIL_MAX_PER_HOUR', 10)
+        app.config.setdefault('ERROR_MAIL_MAX_ERRORS', 20)
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+        app.extensions['log'] = dict(app.config['LOG_SAMPLE_RATES'])
+
+    def debug(self, message, **fields):
+        self.log(logging.DEBUG, message, fields)
+
+    def info(self, message, **fields):
+        self.log(logging.INFO, message, fields)
+
+    def warning(self, message, **fields):
+        self.log(logging.WARNING, message, fields)
+
+    warn = warning
+
+    def error(self, message, **fields):
+        self.log(logging.ERROR, message, fields)
+
+    def exception(self, message, **fields):
+        self.log(logging.ERROR, message, fields, exc_info=True)
+
+    def log(self, level, message, fields, exc_info=None):
+        logger = current_app.logger
+        if not logger.isEnabledFor(level):
+            return
+        ctx = _request_ctx_stack.top
+        if ctx is not None:
+            if level < logging.WARNING and not self._sampled(ctx):
+                return
+            fields.setdefault('endpoint', ctx.request.endpoint)
+        logger.log(level, LogMessage(message, fields), exc_info=exc_info,
+                   extra={'fields': fields})
+
+    def _sampled(self, ctx):
+        sampled = getattr(ctx, 'log_sampled', None)
+        if sampled is None:
+            rate = current_app.extensions['log'].get(
+                ctx.request.endpoint, current_app.config['LOG_SAMPLE_RATE'])
+            sampled = ctx.log_sampled = rate >= 1 or random.random() < rate
+        return sampled
+
+
+class QueueHandler(logging.Handler):
+    """
+    Hand records over to a listener thread through a bounded queue, so
+    logging never makes a request wait on I/O. Records arriving while
+    capacity records are waiting are dropped, and counted in dropped.
+    Subclasses handle the records in handle_record; the listener also calls
+    tick after each record and whenever next_wakeup seconds pass without
+    one.
+    """
+
+    def __init__(self, capacity=10000):
+        logging.Handler.__init__(self)
+        self.queue = Queue(capacity)
+        self.dropped = 0
+        self._thread = None
+        self._pid = None
+        self._thread_lock = Lock()
+
+    def emit(self, record):
+        self._ensure_thread()
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Wait for the records queued so far to be handled."""
+        if self._thread is not None and self._pid == os.getpid():
+            self.queue.join()
+
+    def close(self):
+        # Stop the listener, so it isn't killed in the middle of
+        # interpreter shutdown.
+        if self._thread is not None and self._pid == os.getpid():
+            try:
+                self.queue.put_nowait(None)
+            except Full:
+                pass
+            else:
+                self._thread.join(5)
+            self._thread = None
+        logging.Handler.close(self)
+
+    def _ensure_thread(self):
+        # Threads don't survive a fork, so each process starts its own.
+        if self._thread is None or self._pid != os.getpid():
+            with self._thread_lock:
+                if self._thread is None or self._pid != os.getpid():
+                    self._thread = Thread(target=self._run,
+                                          name=self.__class__.__name__)
+                    self._thread.daemon = True
+                    self._thread.start()
+                    self._pid = os.getpid()
+
+    def _run(self):
+        """Handle queued records until a None one."""
+        while True:
+            try:
+                record = self.queue.get(timeout=self.next_wakeup())
+            except Empty:
+                self.tick()
+                continue
+            if record is None:
+                self.queue.task_done()
+                return
+            try:
+                self.handle_record(record)
+            except Exception:
+                self.handleError(record)
+            finally:
+                self.queue.task_done()
+            self.tick()
+
+    def handle_record(self, record):
+        """Handle a record in the listener thread; drop it by default."""
+
+    def next_wakeup(self):
+        """Return the seconds until tick is due, or None if it isn't."""
+        return None
+
+    def tick(self):
+        pass
+
+
+class BufferedHandler(QueueHandler):
+    """Emit records through handlers from a listener thread."""
+
+    def __init__(self, handlers, capacity=10000):
+        QueueHandler.__init__(self, capacity)
+        self.handlers = list(handlers)
+
+    def close(self):
+        self.flush()
+        for handler in self.handlers:
+            handler.close()
+        QueueHandler.close(self)
+
+    def handle_record(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+def fingerprint(record):
+    """
+    Return what identifies an error across occurrences: where it's logged,
+    its unformatted message (without fields or args) and exception type.
+    """
+    message = getattr(record.msg, 'message', record.msg)
+    exc_type = record.exc_info[0].__name__ if record.exc_info else None
+    return (record.name, record.levelno, record.pathname, record.lineno,
+            message, exc_type)
+
+
+class DigestMailHandler(QueueHandler):
+    """
+    Mail errors to the admins in digests.
+
+    Errors are collected for window seconds from the first one, then sent
+    in one email, with duplicates (same fingerprint) coalesced into a
+    count and the details of their first occurrence. At most max_per_hour
+    digests are sent; while over the limit, errors keep accumulating into
+    the next digest. At most max_errors distinct errors are detailed per
+    digest, the others are only counted.
+    """
+
+    def __init__(self, mailhost, fromaddr, toaddrs, subject,
+                 credentials=None, secure=False, window=60,
+                 max_per_hour=10, max_errors=20, capacity=10000):
+        QueueHandler.__init__(self, capacity)
+        self.mailhost = mailhost
+        self.fromaddr = fromaddr
+        self.toaddrs = toaddrs
+        self.subject = subject
+        self.credentials = credentials
+        self.secure = secure
+        self.window = window
+        self.max_per_hour = max_per_hour
+        self.max_errors = max_errors
+        # fingerprint -> [count, first time, last time, formatted record]
+        self.errors = OrderedDict()
+        self.overflow = 0
+        self.sent_times = deque()
+        self._digest_time = None
+        self._digest_lock = Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls((config['MAIL_SERVER'], config['MAIL_PORT']),
+                   config['MAIL_DEFAULT_SENDER'], config['ADMINS'],
+                   'Oops... %s failed!' % config['APP_NAME'],
+                   (config['MAIL_USERNAME'], config['MAIL_PASSWORD']),
+                   config['MAIL_USE_TLS'], config['ERROR_MAIL_WINDOW'],
+                   config['ERROR_MAIL_MAX_PER_HOUR'],
+                   config['ERROR_MAIL_MAX_ERRORS'],
+                   config['LOG_BUFFER_SIZE'])
+
+    def collect(self, record):
+        with self._digest_lock:
+            self._collect(record)
+
+    def _collect(self, record):
+        now = record.created
+        key = fingerprint(record)
+        error = self.errors.get(key)
+        if error is not None:
+            error[0] += 1
+            error[2] = now
+        elif len(self.errors) < self.max_errors:
+            self.errors[key] = [1, now, now, self.format(record)]
+        else:
+            self.overflow += 1
+        if self._digest_time is None:
+            self._digest_time = now + self.window
+
+    def send_digest(self, now=None):
+        """
+        Send the collected errors, if the rate limit allows; return whether
+        a digest was sent.
+        """
+        with self._digest_lock:
+            return self._send_digest(time.time() if now is None else now)
+
+    def _send_digest(self, now):
+        if not self.errors and not self.overflow:
+            return False
+        while self.sent_times and self.sent_times[0] <= now - 3600:
+            self.sent_times.popleft()
+        if len(self.sent_times) >= self.max_per_hour:
+            # Try again when the oldest digest leaves the hour.
+            self._digest_time = self.sent_times[0] + 3600
+            return False
+
+        total = sum(error[0] for error in self.errors.values()) + \
+            self.overflow
+        subject = '%s (%d errors, %d distinct)' % (
+            self.subject, total, len(self.errors))
+        parts = []
+        for count, first, last, text in sorted(
+                self.errors.values(), key=lambda error: -error[0]):
+            parts.append('%d times, first at %s, last at %s:\n%s' % (
+                count, format_time(first), format_time(last), text))
+        if self.overflow:
+            parts.append('%d more errors not detailed.' % self.overflow)
+        self.errors.clear()
+        self.overflow = 0
+        self._digest_time = None
+        self.sent_times.append(now)
+        try:
+            self.deliver(subject, '\n\n'.join(parts))
+        except Exception:
+            if logging.raiseExceptions:
+                traceback.print_exc()
+        return True
+
+    def deliver(self, subject, body):
+        message = MIMEText(body)
+        message['Subject'] = subject
+        message['From'] = self.fromaddr
+        message['To'] = ', '.join(self.toaddrs)
+        message['Date'] = formatdate()
+        host, port = self.mailhost
+        smtp = smtplib.SMTP(host, port, timeout=30)
+        try:
+            if self.credentials and self.credentials[0]:
+                if self.secure:
+                    smtp.ehlo()
+                    smtp.starttls()
+                    smtp.ehlo()
+                smtp.login(*self.credentials)
+            smtp.sendmail(self.fromaddr, self.toaddrs, message.as_string())
+        finally:
+            smtp.quit()
+
+    def close(self):
+        self.flush()
+        self.send_digest()
+        QueueHandler.close(self)
+
+    def handle_record(self, record):
+        self.collect(record)
+
+    def next_wakeup(self):
+        if self._digest_time is None:
+            return None
+        return max(0, self._digest_time - time.time())
+
+    def tick(self):
+        if self._digest_time is not None and \
+                self._digest_time <= time.time():
+            self.send_digest()
+
+
+def format_time(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
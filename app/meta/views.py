@@ -1,12 +1,10 @@
 """This module contains the view functions for the meta blueprint."""
-from premailer import Premailer
-
-from flask import (Blueprint, render_template, current_app, flash, \
-    jsonify)
+from flask import (Blueprint, current_app, flash)
 from flask_mail import Message
 from flaskext.babel import gettext as _
-from app.utils import get_resource_as_string, get_current_time
-from app.extensions import mail
+from app.utils import get_current_time, format_date
+from app.extensions import db, email_renderer, jsend, log
+from app.outbox import enqueue
 from .forms import ContactUsForm
 
 meta = Blueprint('meta', __name__)
@@ -20,26 +18,23 @@ def index():
 @meta.route('/mail/', methods=['POST'])
 def contact():
     """Send an email to the ADMINS."""
-    current_app.logger.info('Entering meta.views.contact()...')
+    log.info('Entering meta.views.contact()')
 
     form = ContactUsForm()
 
     if form.validate_on_submit():
         subject = '[%s] Message from %s: %s' % (current_app.config['APP_NAME'], form.full_name.data, form.subject.data)
-        date = get_current_time()
-
-        css = get_resource_as_string('static/css/email.css')
-        html = render_template('meta/emails/contact.html', css=css, email_recipient=form.email.data, full_name=form.full_name.data, date=date, title=subject, message=form.message.data)
+        date = format_date(get_current_time())
 
-        p = Premailer(html)
-        result_html = p.transform()
+        html = email_renderer.render('meta/emails/contact.html', email_recipient=form.email.data, full_name=form.full_name.data, date=date, title=subject, message=form.message.data)
 
-        message = Message(subject=subject, html=result_html, reply_to=form.email.data, recipients=current_app.config['ADMINS'])
-        mail.send(message)
+        message = Message(subject=subject, html=html, reply_to=form.email.data, recipients=current_app.config['ADMINS'])
+        enqueue(message)
+        db.session.commit()
 
         flash(_("Thanks for your message. We'll get back to you shortly."), 'success')
 
-    current_app.logger.debug('Returning success.')
-    response = jsonify(status='success')
+    log.debug('Returning success')
+    response = jsend.success()
     response.status_code = 200
     return response
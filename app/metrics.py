@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+"""
+Request metrics, exposed in the Prometheus text format at /metrics.
+
+Every request is counted in http_requests_total by endpoint (the
+blueprint's, e.g. ``session.post``; ``none`` when no route matched), method
+and status, and its time in the app observed by endpoint in the
+http_request_duration_seconds histogram, whose bucket bounds are
+METRICS_BUCKETS (seconds). Requests failing with an unhandled exception
+count as 500s. Recording a request is two dict updates under locks;
+nothing is formatted until a scrape, which also adds the stats kept by the
+connection pools, the password hasher, the compression middleware and the
+user cache.
+
+Under gunicorn each worker has its own metrics. With METRICS_DIR set, a
+thread in each worker writes them to METRICS_DIR/metrics-<pid>.json every
+METRICS_FLUSH_INTERVAL seconds and at exit, and a scrape, whichever worker
+handles it, adds up its own metrics and the other workers' files:
+counters and histograms of all of them, so totals don't drop when a worker
+is replaced, and gauges of the live ones. Clear the directory before
+starting the server. Without METRICS_DIR a scrape only sees the worker
+handling it.
+
+/metrics is for admins: a logged in admin user, or a scraper sending
+``Authorization: Bearer <METRICS_TOKEN>``.
+"""
+
+import atexit
+import errno
+import glob
+import json
+import os
+import re
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from threading import Lock, Thread
+
+from flask import (abort, current_app, got_request_exception, make_response,
+                   request)
+from flask.ext.login import current_user
+from passlib.utils import consteq
+
+from .timing import current_timings
+
+# Prometheus' default buckets, in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+FILE_RE = re.compile(r'metrics-(\d+)\.json$')
+
+
+class Metric(object):
+    """A metric's values, by label values (a tuple, in labels order)."""
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = Lock()
+        self._values = {}
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def describe(self):
+        """Return the metric and a copy of its values, as JSON types."""
+        with self._lock:
+            values = [[list(key), value]
+                      for key, value in self._values.iteritems()]
+        return {'name': self.name, 'kind': self.kind, 'help': self.help,
+                'labels': list(self.labels), 'values': values}
+
+
+class Counter(Metric):
+    """A count that only goes up."""
+
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set(self, labels, value):
+        """Set a count kept elsewhere, e.g. by a stats object."""
+        with self._lock:
+            self._values[labels] = value
+
+
+class Gauge(Counter):
+    """A value that goes up and down."""
+
+    kind = 'gauge'
+
+
+class Histogram(Metric):
+    """Observations counted in fixed buckets, with their sum."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def set_buckets(self, buckets):
+        buckets = tuple(sorted(buckets))
+        with self._lock:
+            if buckets != self.buckets:
+                self.buckets = buckets
+                self._values.clear()
+
+    def observe(self, labels, value):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # A count per bucket, not cumulated, +Inf's last; then the
+                # sum.
+                counts = self._values[labels] = \
+                    [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def describe(self):
+        with self._lock:
+            values = [[list(key), list(counts)]
+                      for key, counts in self._values.iteritems()]
+        return {'name': self.name, 'kind': self.kind, 'help': self.help,
+                'labels': list(self.labels), 'buckets': list(self.buckets),
+                'values': values}
+
+
+def merge(families, snapshot, alive=True):
+    """
+    Add a process' snapshot (a list of described metrics) to families, by
+    name. Gauges are only added if the process is alive.
+    """
+    for metric in snapshot:
+        if metric['kind'] == 'gauge' and not alive:
+            continue
+        family = families.get(metric['name'])
+        if family is None:
+            family = families[metric['name']] = dict(metric, values={})
+        elif family['kind'] != metric['kind'] or \
+                family.get('buckets') != metric.get('buckets'):
+            # Written with another definition, e.g. before a config change.
+            continue
+        values = family['values']
+        for labels, value in metric['values']:
+            key = tuple(labels)
+            total = values.get(key)
+            if total is None:
+                values[key] = list(value) if isinstance(value, list) \
+                    else value
+            elif isinstance(value, list):
+                values[key] = [a + b for a, b in zip(total, value)]
+            else:
+                values[key] = total + value
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+def format_labels(pairs):
+    if not pairs:
+        return u''
+    return u'{%s}' % u','.join(
+        u'%s="%s"' % (name, unicode(value).replace(u'\\', u'\\\\')
+                      .replace(u'"', u'\\"').replace(u'\n', u'\\n'))
+        for name, value in pairs)
+
+
+def exposition(families):
+    """Return families in the Prometheus text format, UTF-8 encoded."""
+    lines = []
+    for name, family in families.iteritems():
+        lines.append(u'# HELP %s %s' % (name, family['help'].replace(
+            u'\\', u'\\\\').replace(u'\n', u'\\n')))
+        lines.append(u'# TYPE %s %s' % (name, family['kind']))
+        labels = family['labels']
+        for key, value in sorted(family['values'].iteritems()):
+            pairs = zip(labels, key)
+            if family['kind'] != 'histogram':
+                lines.append(u'%s%s %s' % (name, format_labels(pairs),
+                                           format_value(value)))
+                continue
+            bounds = [format_value(float(bound))
+                      for bound in family['buckets']] + ['+Inf']
+            count = 0
+            for bound, observed in zip(bounds, value[:-1]):
+                count += observed
+                lines.append(u'%s_bucket%s %d' % (
+                    name, format_labels(pairs + [('le', bound)]), count))
+            lines.append(u'%s_sum%s %s' % (name, format_labels(pairs),
+                                          format_value(value[-1])))
+            lines.append(u'%s_count%s %d' % (name, format_labels(pairs),
+                                            count))
+    return (u'\n'.join(lines) + u'\n').encode('utf-8')
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # EPERM: alive, but someone else's.
+        return e.errno == errno.EPERM
+    return True
+
+
+# ================================================================
+# Collectors: the stats other extensions keep, set on the metrics before
+# each snapshot. extensions imports this module, hence the late imports.
+
+def collect_pools(metrics, app):
+    from .extensions import db
+    counters = (
+        ('checkouts', 'db_pool_checkouts_total', 'Connections checked out.'),
+        ('checkout_seconds', 'db_pool_checkout_seconds_total',
+         'Seconds spent waiting for connections.'),
+        ('timeouts', 'db_pool_timeouts_total', 'Checkouts that timed out.'),
+        ('connects', 'db_pool_connects_total', 'Connections opened.'),
+        ('disconnects', 'db_pool_disconnects_total',
+         'Connections found dropped by the server.'),
+    )
+    gauges = (
+        ('in_use', 'db_pool_connections_in_use',
+         'Connections checked out now.'),
+        ('overflow', 'db_pool_overflow',
+         'Connections open past the pool size.'),
+    )
+    for bind, stats in db.pool_stats(app).iteritems():
+        labels = (bind or 'default',)
+        for key, name, help in counters:
+            metrics.counter(name, help, ('bind',)).set(labels, stats[key])
+        for key, name, help in gauges:
+            metrics.gauge(name, help, ('bind',)).set(labels, stats[key])
+
+
+def collect_hashing(metrics, app):
+    from .extensions import hasher
+    stats = hasher.stats.as_dict()
+    metrics.counter('password_hashes_total',
+                    'Passwords hashed or verified.').set((), stats['count'])
+    metrics.counter('password_hashes_rejected_total',
+                    'Hashes rejected with a full queue.').set(
+                        (), stats['rejected'])
+    metrics.counter('password_hash_seconds_total',
+                    'Seconds spent hashing.').set((), stats['hash_time'])
+    metrics.counter('password_hash_queue_seconds_total',
+                    'Seconds hashes waited for a worker.').set(
+                        (), stats['queue_wait'])
+
+
+def collect_compression(metrics, app):
+    stats = app.extensions.get('compression')
+    if stats is None:
+        return
+    stats = stats.as_dict()
+    for key, help in (('responses', 'Responses compressed.'),
+                      ('bytes_in', 'Bytes compressed.'),
+                      ('bytes_out', 'Compressed bytes sent.'),
+                      ('seconds', 'Seconds spent compressing.')):
+        metrics.counter('compression_%s_total' % key, help).set(
+            (), stats[key])
+
+
+def collect_user_cache(metrics, app):
+    from .user.cache import user_cache
+    stats = user_cache.stats()
+    for key, help in (('hits', 'Users loaded from the cache.'),
+                      ('misses', 'Users loaded from the database.'),
+                      ('invalidations', 'Cached users dropped by commits.')):
+        metrics.counter('user_cache_%s_total' % key, help).set(
+            (), stats[key])
+    metrics.gauge('user_cache_size', 'Users cached.').set((), stats['size'])
+
+
+class Metrics(object):
+    """A registry of metrics, recording requests and serving scrapes."""
+
+    def __init__(self, app=None):
+        self.metrics = OrderedDict()
+        self.collectors = [collect_pools, collect_hashing,
+                           collect_compression, collect_user_cache]
+        self._lock = Lock()
+        self._thread = None
+        self._pid = None
+        self.requests = self.counter(
+            'http_requests_total', 'Requests handled.',
+            ('endpoint', 'method', 'status'))
+        self.latency = self.histogram(
+            'http_request_duration_seconds', 'Seconds spent in the app.',
+            ('endpoint',))
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_DIR', None)
+        app.config.setdefault('METRICS_FLUSH_INTERVAL', 5)
+        app.config.setdefault('METRICS_BUCKETS', DEFAULT_BUCKETS)
+        app.config.setdefault('METRICS_TOKEN', None)
+        self.latency.set_buckets(app.config['METRICS_BUCKETS'])
+        # after_request isn't called for unhandled exceptions. Connecting
+        # raises if blinker, which signals need, isn't installed.
+        got_request_exception.connect(self._record_exception, app)
+
+    def counter(self, name, help, labels=()):
+        """Return the counter called name, made if it doesn't exist."""
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def _get(self, cls, name, *args):
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self.metrics.get(name)
+                if metric is None:
+                    metric = self.metrics[name] = cls(name, *args)
+        return metric
+
+    def record_request(self, status):
+        """Count the current request, answered with status."""
+        endpoint = request.endpoint or 'none'
+        self.requests.inc((endpoint, request.method, status))
+        timings = current_timings()
+        if timings is not None:
+            self.latency.observe((endpoint,), time.time() - timings.started)
+        if self._pid != os.getpid() and current_app.config['METRICS_DIR']:
+            self._ensure_thread(current_app._get_current_object())
+
+    def _record_exception(self, sender, exception):
+        self.record_request(500)
+
+    def snapshot(self, app):
+        """Return this process' metrics, described."""
+        for collector in self.collectors:
+            collector(self, app)
+        with self._lock:
+            metrics = self.metrics.values()
+        return [metric.describe() for metric in metrics]
+
+    def flush(self, app):
+        """Write this process' metrics to its file in METRICS_DIR."""
+        path = os.path.join(app.config['METRICS_DIR'],
+                            'metrics-%d.json' % os.getpid())
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(app), f)
+        # Readers never see half a file.
+        os.rename(path + '.tmp', path)
+
+    def collect(self, app):
+        """Return the metrics of all processes, by name."""
+        families = OrderedDict()
+        merge(families, self.snapshot(app))
+        directory = app.config['METRICS_DIR']
+        if not directory:
+            return families
+        for path in sorted(glob.glob(os.path.join(directory,
+                                                  'metrics-*.json'))):
+            pid = int(FILE_RE.search(path).group(1))
+            if pid == os.getpid():
+                continue
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (IOError, ValueError):
+                continue
+            merge(families, snapshot, _alive(pid))
+        return families
+
+    def scrape(self):
+        """Return the /metrics response, or abort if not allowed."""
+        self.authorize()
+        response = make_response(exposition(self.collect(current_app)))
+        response.headers['Content-Type'] = CONTENT_TYPE
+        return response
+
+    def authorize(self):
+        """Abort unless an admin or a scraper with the token asks."""
+        status = self.access_status()
+        if status != 200:
+            abort(status)
+
+    def access_status(self):
+        """
+        Return 200 if the request comes from an admin or a scraper with the
+        token, else 401 or 403.
+        """
+        token = current_app.config['METRICS_TOKEN']
+        authorization = request.headers.get('Authorization', '')
+        if token and authorization.startswith('Bearer ') and \
+                consteq(_bytes(authorization[7:]), _bytes(token)):
+            return 200
+        # user imports the extensions, which import this module.
+        from .user.constants import ADMIN
+        if not current_user.is_authenticated():
+            return 401
+        if current_user.role_id != ADMIN:
+            return 403
+        return 200
+
+    def _ensure_thread(self, app):
+        # Threads don't survive a fork, so each process starts its own.
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = Thread(target=self._run, args=(app,),
+                                  name='MetricsFlusher')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+        atexit.register(self._flush_at_exit, app)
+
+    def _run(self, app):
+        while True:
+            time.sleep(app.config['METRICS_FLUSH_INTERVAL'])
+            try:
+                self.flush(app)
+            except Exception:
+                app.logger.exception('Writing metrics failed')
+
+    def _flush_at_exit(self, app):
+        if self._pid == os.getpid():
+            try:
+                self.flush(app)
+            except Exception:
+                pass
+
+
+def _bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+WSGI middlewares wrapped around the Flask app (see configure_middleware).
+"""
+
+import time
+import zlib
+from threading import Lock
+
+from werkzeug.datastructures import HeaderSet
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import (parse_accept_header, parse_options_header,
+                           parse_set_header)
+
+
+class PreflightMiddleware(object):
+    """
+    Answer CORS preflights before they reach Flask.
+
+    An OPTIONS request with an Origin header is matched against the app's
+    url_map; if it routes to a crossdomain view with automatic_options and
+    the origin is allowed, the response the crossdomain decorator would have
+    built is returned from its policy's cache. Such requests never push a
+    request context, open the session, run before_request hooks (e.g.
+    Flask-Login loading the user) or touch the database. Anything else,
+    including forbidden origins, goes through to Flask.
+    """
+
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] == 'OPTIONS' and 'HTTP_ORIGIN' in environ:
+            headers = self.preflight_headers(environ)
+            if headers is not None:
+                start_response('200 OK', headers)
+                return []
+        return self.wsgi_app(environ, start_response)
+
+    def preflight_headers(self, environ):
+        """Return the preflight's response headers, or None to pass it on."""
+        app = self.app
+        adapter = app.url_map.bind_to_environ(
+            environ, server_name=app.config['SERVER_NAME'])
+        try:
+            rule, args = adapter.match(method='OPTIONS', return_rule=True)
+        except HTTPException:
+            return None
+        view = app.view_functions.get(rule.endpoint)
+        policy = getattr(view, 'crossdomain', None)
+        if policy is None or not policy.automatic_options:
+            return None
+        origin = environ['HTTP_ORIGIN']
+        if not policy.allows(origin, app.extensions['cors']):
+            return None
+
+        def get_allow():
+            allow = HeaderSet()
+            allow.update(adapter.allowed_methods())
+            return allow.to_header()
+
+        return [('Content-Type', 'text/html; charset=utf-8'),
+                ('Content-Length', '0')] + \
+            policy.preflight_headers(rule.rule, origin, get_allow)
+
+
+# Content-Encoding -> zlib wbits of its container.
+COMPRESSIONS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+class CompressionStats(object):
+    """Bytes in and out of the compressor and the time spent in it."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.responses = 0
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.seconds = 0.0
+
+    def record(self, bytes_in, bytes_out, seconds):
+        with self._lock:
+            self.responses += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.seconds += seconds
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'responses': self.responses,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'seconds': self.seconds,
+                'ratio': float(self.bytes_out) / self.bytes_in
+                if self.bytes_in else None,
+                # Compression is CPU bound, so this is its CPU cost.
+                'ns_per_byte': self.seconds * 1e9 / self.bytes_in
+                if self.bytes_in else None,
+            }
+
+
+class CompressionMiddleware(object):
+    """
+    Compress responses with gzip or deflate, as negotiated from the
+    request's Accept-Encoding.
+
+    Responses are compressed if their content type is in
+    COMPRESS_MIMETYPES (which sets its zlib level), they're not encoded
+    already and, when their length is known, it's at least
+    COMPRESS_MIN_SIZE. The body is compressed chunk by chunk as the app
+    yields it; chunks of streamed bodies (without a Content-Length) are
+    flushed, so clients get them as they come. Strong ETags become weak
+    ones, which still match them.
+    """
+
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.stats = CompressionStats()
+        app.extensions['compression'] = self.stats
+
+    def __call__(self, environ, start_response):
+        encoding = self.choose_encoding(environ)
+        if encoding is None:
+            return self.wsgi_app(environ, start_response)
+
+        state = {}
+
+        def compressing_start_response(status, headers, exc_info=None):
+            level, length = self.compression_level(status, headers)
+            if level is not None:
+                headers = self.compressed_headers(headers, encoding)
+                state['compressor'] = zlib.compressobj(
+                    level, zlib.DEFLATED, COMPRESSIONS[encoding])
+                state['stream'] = length is None
+            return start_response(status, headers, exc_info)
+
+        app_iter = self.wsgi_app(environ, compressing_start_response)
+        if 'compressor' not in state:
+            return app_iter
+        return self.compress(app_iter, state['compressor'], state['stream'])
+
+    def choose_encoding(self, environ):
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return None
+        accept = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        for encoding in ('gzip', 'deflate'):
+            if accept[encoding]:
+                return encoding
+        return None
+
+    def compression_level(self, status, headers):
+        """
+        Return the zlib level to compress the response with, or None, and
+        its Content-Length.
+        """
+        if status[:3] in ('204', '304'):
+            return None, None
+        config = self.app.config
+        content_type = length = None
+        for key, value in headers:
+            key = key.lower()
+            if key == 'content-type':
+                content_type = value
+            elif key == 'content-length':
+                length = int(value)
+            elif key == 'content-encoding':
+                return None, length
+            elif key == 'cache-control' and 'no-transform' in value:
+                return None, length
+        if content_type is None or \
+                (length is not None and length < config['COMPRESS_MIN_SIZE']):
+            return None, length
+        return config['COMPRESS_MIMETYPES'].get(
+            parse_options_header(content_type)[0]), length
+
+    def compressed_headers(self, headers, encoding):
+        result = [('Content-Encoding', encoding)]
+        vary = None
+        for key, value in headers:
+            lowered = key.lower()
+            if lowered == 'content-length':
+                continue
+            elif lowered == 'etag' and value[:2] not in ('W/', 'w/'):
+                value = 'W/' + value
+            elif lowered == 'vary':
+                vary = value
+                continue
+            result.append((key, value))
+        vary = parse_set_header(vary)
+        vary.add('Accept-Encoding')
+        result.append(('Vary', vary.to_header()))
+        return result
+
+    def compress(self, app_iter, compressor, flush):
+        bytes_in = bytes_out = 0
+        seconds = 0.0
+        try:
+            for chunk in app_iter:
+                started = time.time()
+                data = compressor.compress(chunk)
+                if flush:
+                    data += compressor.flush(zlib.Z_SYNC_FLUSH)
+                seconds += time.time() - started
+                bytes_in += len(chunk)
+                if data:
+                    bytes_out += len(data)
+                    yield data
+            started = time.time()
+            data = compressor.flush()
+            seconds += time.time() - started
+            bytes_out += len(data)
+            yield data
+            self.stats.record(bytes_in, bytes_out, seconds)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+
+from .models import OutboxMessage
+from .worker import enqueue, process_pending, run_workers
+from .constants import (OUTBOX_STATUS, PENDING, SENT, FAILED)
@@ -0,0 +1,9 @@
+# Outbox message status
+PENDING = 0
+SENT = 1
+FAILED = 2
+OUTBOX_STATUS = {
+    PENDING: 'pending',
+    SENT: 'sent',
+    FAILED: 'failed',
+}
@@ -0,0 +1,60 @@
+from flask import json
+from flask_mail import Message
+
+from app.extensions import db
+from app.utils import get_current_time
+from .constants import PENDING, OUTBOX_STATUS
+
+
+class OutboxMessage(db.Model):
+    """An email waiting to be sent by the outbox workers."""
+
+    __tablename__ = 'outbox_messages'
+
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(255), nullable=False)
+    sender = db.Column(db.String(255))
+    # JSON encoded list of addresses.
+    recipients = db.Column(db.Text, nullable=False)
+    reply_to = db.Column(db.String(255))
+    body = db.Column(db.Text)
+    html = db.Column(db.Text)
+    created_time = db.Column(db.DateTime, default=get_current_time)
+
+    # ================================================================
+    # Delivery
+
+    status_id = db.Column(db.SmallInteger, default=PENDING, index=True)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    # Not picked up by a worker before this time: set when the message is
+    # claimed (so a crashed worker's claim expires) and on retry backoff.
+    next_attempt_time = db.Column(db.DateTime, default=get_current_time,
+                                  index=True)
+    sent_time = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+
+    def get_status(self):
+        return OUTBOX_STATUS[self.status_id]
+
+    # ================================================================
+    # Class methods
+
+    @classmethod
+    def from_message(cls, message):
+        return cls(subject=message.subject,
+                   sender=message.sender,
+                   recipients=json.dumps(list(message.recipients)),
+                   reply_to=message.reply_to,
+                   body=message.body,
+                   html=message.html)
+
+    def to_message(self):
+        return Message(subject=self.subject,
+                       sender=self.sender,
+                       recipients=json.loads(self.recipients),
+                       reply_to=self.reply_to,
+                       body=self.body,
+                       html=self.html)
+
+    def __repr__(self):
+        return '<OutboxMessage %r>' % (self.id)
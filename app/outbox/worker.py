@@ -0,0 +1,170 @@
+"""
+Delivery of queued outbox messages.
+
+Views enqueue() messages in the same transaction as the change that causes
+them; workers (``manage.py outbox``) claim due messages in batches and
+send them over one SMTP connection, retrying SMTP and network failures
+with exponential backoff. A message that fails otherwise (e.g. it can't be
+built or encoded) would fail the same way every time, so it's given up on
+at once, without holding up the rest of its batch.
+"""
+
+import socket
+import threading
+from datetime import timedelta
+from smtplib import SMTPException
+
+from flask import current_app
+
+from app.extensions import db, mail, log
+from app.timing import PhaseTimer
+from app.utils import get_current_time
+from .constants import PENDING, SENT, FAILED
+from .models import OutboxMessage
+
+
+def enqueue(message):
+    """
+    Queue a flask_mail Message in the current db session. It's delivered
+    only once the session is committed.
+    """
+    with PhaseTimer('mail'):
+        outbox_message = OutboxMessage.from_message(message)
+        db.session.add(outbox_message)
+    return outbox_message
+
+
+def claim(limit):
+    """Claim up to limit due messages for this worker; return their ids."""
+    now = get_current_time()
+    claim_until = now + timedelta(
+        seconds=current_app.config['OUTBOX_CLAIM_TIMEOUT'])
+    # Claimed for their last attempt by a worker that died before any
+    # outcome: give up rather than claim them forever.
+    abandoned = OutboxMessage.query \
+        .filter(OutboxMessage.status_id == PENDING) \
+        .filter(OutboxMessage.next_attempt_time <= now) \
+        .filter(OutboxMessage.attempts >=
+                current_app.config['OUTBOX_MAX_ATTEMPTS']) \
+        .update({'status_id': FAILED,
+                 'last_error': 'No outcome from the last attempt.'},
+                synchronize_session=False)
+    if abandoned:
+        log.error('Giving up on abandoned outbox messages', count=abandoned)
+    due = db.session.query(OutboxMessage.id, OutboxMessage.attempts) \
+        .filter(OutboxMessage.status_id == PENDING) \
+        .filter(OutboxMessage.next_attempt_time <= now) \
+        .order_by(OutboxMessage.id).limit(limit).all()
+
+    ids = []
+    for id, attempts in due:
+        # Another worker that got there first has already bumped attempts.
+        claimed = OutboxMessage.query \
+            .filter_by(id=id, status_id=PENDING, attempts=attempts) \
+            .update({'attempts': attempts + 1,
+                     'next_attempt_time': claim_until},
+                    synchronize_session=False)
+        if claimed:
+            ids.append(id)
+    db.session.commit()
+    return ids
+
+
+def process_pending(limit=None):
+    """Send a batch of due messages. Return the number sent."""
+    if limit is None:
+        limit = current_app.config['OUTBOX_BATCH_SIZE']
+    ids = claim(limit)
+    if not ids:
+        return 0
+
+    messages = OutboxMessage.query.filter(OutboxMessage.id.in_(ids)) \
+        .order_by(OutboxMessage.id).all()
+    done = set()
+    try:
+        with mail.connect() as connection:
+            for outbox_message in messages:
+                try:
+                    with PhaseTimer('mail'):
+                        outbox_message.to_message().send(connection)
+                except (SMTPException, socket.error) as e:
+                    retry_later(outbox_message, e)
+                except Exception as e:
+                    give_up(outbox_message, e)
+                else:
+                    outbox_message.status_id = SENT
+                    outbox_message.sent_time = get_current_time()
+                done.add(outbox_message.id)
+                db.session.commit()
+    except (SMTPException, socket.error) as e:
+        # Couldn't connect (or quit): retry whatever wasn't handled.
+        for outbox_message in messages:
+            if outbox_message.id not in done:
+                retry_later(outbox_message, e)
+        db.session.commit()
+
+    return sum(1 for m in messages if m.status_id == SENT)
+
+
+def retry_later(outbox_message, error):
+    """Back off exponentially, or give up after OUTBOX_MAX_ATTEMPTS."""
+    config = current_app.config
+    if outbox_message.attempts >= config['OUTBOX_MAX_ATTEMPTS']:
+        give_up(outbox_message, error)
+    else:
+        outbox_message.last_error = repr(error)
+        backoff = config['OUTBOX_RETRY_BACKOFF'] * 2 ** (outbox_message.attempts - 1)
+        outbox_message.next_attempt_time = get_current_time() + timedelta(seconds=backoff)
+        log.warning('Retrying outbox message', id=outbox_message.id,
+                    backoff=backoff, error=repr(error))
+
+
+def give_up(outbox_message, error):
+    outbox_message.status_id = FAILED
+    outbox_message.last_error = repr(error)
+    log.error('Giving up on outbox message', id=outbox_message.id,
+              attempts=outbox_message.attempts, error=repr(error))
+
+
+class OutboxWorker(threading.Thread):
+    """Drain the outbox until stopped, sleeping when there's nothing due."""
+
+    def __init__(self, app, poll_interval=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.app = app
+        self.poll_interval = poll_interval or app.config['OUTBOX_POLL_INTERVAL']
+        self.stopped = threading.Event()
+
+    def run(self):
+        with self.app.test_request_context():
+            while not self.stopped.is_set():
+                sent = 0
+                try:
+                    sent = process_pending()
+                except Exception:
+                    self.app.logger.exception('Outbox worker failed.')
+                finally:
+                    db.session.remove()
+                if not sent:
+                    self.stopped.wait(self.poll_interval)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def run_workers(app, workers=None):
+    """Run a pool of outbox workers until interrupted."""
+    workers = [OutboxWorker(app)
+               for i in range(workers or app.config['OUTBOX_WORKERS'])]
+    for worker in workers:
+        worker.start()
+    try:
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(1)
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            worker.join()
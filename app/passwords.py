@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Password hash policy.
+
+The schemes and cost passwords are hashed with are deployment settings:
+
+* PASSWORD_SCHEMES: passlib schemes; the first hashes new passwords, the
+  others are only verified (and deprecated).
+* PASSWORD_ROUNDS: rounds of the default scheme. Stored hashes more than
+  PASSWORD_ROUNDS_TOLERANCE (a fraction) cheaper or more expensive than
+  that are rehashed on the next successful login.
+* PASSWORD_CALIBRATE: if set, PASSWORD_ROUNDS is instead calibrated at
+  startup so verifying a password takes about PASSWORD_VERIFY_TIME seconds
+  on this host. `manage.py calibrate` prints the calibrated value to pin
+  in the config instead.
+"""
+
+import math
+import time
+
+from passlib.context import CryptContext
+from passlib.registry import get_crypt_handler
+
+
+def make_context(schemes, rounds, tolerance=0.0):
+    """Return the CryptContext for a policy."""
+    default = schemes[0]
+    options = {
+        'schemes': schemes,
+        'default': default,
+        'deprecated': list(schemes[1:]),
+    }
+    handler = get_crypt_handler(default)
+    if 'rounds' in handler.setting_kwds:
+        if handler.rounds_cost == 'log2':
+            spread = int(math.ceil(math.log(1 + tolerance, 2)))
+        else:
+            spread = int(rounds * tolerance)
+        options['%s__default_rounds' % default] = rounds
+        options['%s__min_rounds' % default] = max(handler.min_rounds,
+                                                  rounds - spread)
+        options['%s__max_rounds' % default] = min(handler.max_rounds,
+                                                  rounds + spread)
+    return CryptContext(**options)
+
+
+def measure(scheme, rounds, samples=3):
+    """Return the best of samples times to verify a hash, in seconds."""
+    handler = get_crypt_handler(scheme)
+    hash = handler.encrypt('calibration', rounds=rounds)
+    best = None
+    for i in range(samples):
+        started = time.time()
+        handler.verify('calibration', hash)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def calibrate(scheme, target, samples=3):
+    """
+    Return the rounds for which verifying a scheme hash takes about target
+    seconds on this host.
+    """
+    handler = get_crypt_handler(scheme)
+    rounds = handler.default_rounds
+    elapsed = measure(scheme, rounds, samples)
+    if handler.rounds_cost == 'log2':
+        rounds += int(round(math.log(target / elapsed, 2)))
+    else:
+        rounds = int(rounds * target / elapsed)
+    return max(handler.min_rounds, min(handler.max_rounds, rounds))
+
+
+def context_from_config(config):
+    """Return the CryptContext for an app config."""
+    schemes = config['PASSWORD_SCHEMES']
+    rounds = config['PASSWORD_ROUNDS']
+    if config['PASSWORD_CALIBRATE']:
+        rounds = calibrate(schemes[0], config['PASSWORD_VERIFY_TIME'])
+    return make_context(schemes, rounds, config['PASSWORD_ROUNDS_TOLERANCE'])
@@ -1,19 +1,19 @@
 """This module contains the view functions for the session blueprint."""
 
 from uuid import uuid4
-from premailer import Premailer
 from urllib import quote
-from smtplib import SMTPDataError
 
-from flask import Blueprint, current_app, jsonify, render_template, request
+from flask import Blueprint, current_app, request
 from flask.ext.login import login_user, current_user, logout_user, \
 login_required, confirm_login
 from flaskext.babel import gettext as _
 from flask_mail import Message
 
-from app.extensions import db, mail
+from app.extensions import db, email_renderer, jsend, log
+from app.jsend import envelope
+from app.http_cache import not_modified, set_version_etag, version_etag
 from app.decorators import crossdomain
-from app.utils import get_resource_as_string
+from app.outbox import enqueue
 from ..user.models import User
 from .forms import LoginForm
 from .decorators import anonymous_required
@@ -22,78 +22,85 @@ session = Blueprint('session', __name__, url_prefix='/session')
 
 # API spec: http://labs.omniti.com/labs/jsend
 
+SIGNED_OUT = envelope('success', {'auth': False})
+
 
 @session.route('/', methods=['POST', 'OPTIONS'])
 @crossdomain(headers='Content-Type')
 @anonymous_required
 def post():
     """Create a session."""
-    current_app.logger.info('Entering session.views.post()...')
+    log.info('Entering session.views.post()')
 
     form = LoginForm()
 
     if form.validate_on_submit():
         user, authenticated = User.authenticate(form.email.data, form.password.data)
         if user and authenticated:
+            # Saves the password if authenticate() rehashed it.
+            db.session.commit()
             if login_user(user, remember='y'):
-                response = jsonify(status='success', data=user.session_as_dict())
+                data = user.session_as_dict()
+                response = jsend.success(data)
                 response.status_code = 200
-                current_app.logger.debug('Returning success; response.data=[%s]' % response.data)
+                log.debug('Returning success', data=data)
                 return response
             else:
                 # User reactivation request.
                 user.activation_key = str(uuid4())
                 db.session.add(user)
-                db.session.commit()
 
-                # Send reactivation confirmation email.
-                css = get_resource_as_string('static/css/email.css')
+                # Queue reactivation confirmation email.
                 reactivate_url = '%s/#accounts/reactivate/%s/%s/' % (current_app.config['DOMAIN'], quote(user.email), user.activation_key)
-                html = render_template('user/emails/reactivate_confirm.html', css=css, username=user.username, email_recipient=user.email, reactivate_url=reactivate_url)
-                current_app.logger.debug('reactivate_url=[%s]' % reactivate_url)
-
-                p = Premailer(html)
-                result_html = p.transform()
-
-                message = Message(subject='%s Account Reactivation' % current_app.config['APP_NAME'], html=result_html, recipients=[user.email])
-                try:
-                    mail.send(message)
-                except SMTPDataError as e:
-                    current_app.logger.debug('Returning fail = [%s].' % e)
-                    response = jsonify(status='fail', data={'email': "Couldn't send email to %s." % form.email.data})
-                    response.status_code = 200
-                    return response
+                html = email_renderer.render('user/emails/reactivate_confirm.html', username=user.username, email_recipient=user.email, reactivate_url=reactivate_url)
+                log.debug('Queued reactivation email', reactivate_url=reactivate_url)
+
+                message = Message(subject='%s Account Reactivation' % current_app.config['APP_NAME'], html=html, recipients=[user.email])
+                enqueue(message)
+                db.session.commit()
+
                 # Return response
-                response = jsonify(status='success', data=user.session_as_dict())
+                response = jsend.success(user.session_as_dict())
                 response.status_code = 200
-                current_app.logger.debug('Returning success')
+                log.debug('Returning success')
                 return response
         else:
-            response = jsonify(status='fail', data={'email': _('Wrong email/password.')})
+            data = {'email': _('Wrong email/password.')}
+            response = jsend.fail(data)
             response.status_code = 200
-            current_app.logger.debug('Returning success; response.data=[%s]' % response.data)
+            log.debug('Returning fail', data=data)
             return response
     else:
-        current_app.logger.debug('Returning fail; data = [%s].' % form.errors)
-        return jsonify(status='fail', data=form.errors)
+        log.debug('Returning fail', errors=form.errors)
+        return jsend.fail(form.errors)
 
 
 @session.route('/', methods=['GET', 'OPTIONS'])
 @crossdomain(headers='Content-Type')
 def get():
     """Get a session."""
-    current_app.logger.info('Entering session.views.get()...')
-
+    log.info('Entering session.views.get()')
 
-    current_app.logger.debug('SERVER_NAME=[%s]' % current_app.config['SERVER_NAME'])
-    current_app.logger.debug('request.url=[%s]' % request.url)
+    # The current user is already loaded (and cached), so revalidating
+    # costs no query.
+    if current_user.is_authenticated():
+        etag = version_etag('session', current_user.id,
+                            current_user.updated_time)
+    else:
+        etag = version_etag('session')
+    response = not_modified(request, etag)
+    if response is not None:
+        log.debug('Returning not modified')
+        return response
 
     if current_user.is_authenticated():
-        current_app.logger.debug('Returning success; response.data=[%s]' % {'auth': True, 'username': current_user.username, 'email': current_user.email, 'id': current_user.id})
-        return jsonify(status='success', data=current_user.session_as_dict())
+        data = current_user.session_as_dict()
+        log.debug('Returning success', data=data)
+        response = jsend.success(data)
     else:
-        current_app.logger.debug('Returning success; response.data=[%s]' % {'auth': False})
-        return jsonify(status='success', data={'auth': False})
+        log.debug('Returning success; signed out')
+        response = jsend.respond(SIGNED_OUT)
+    return set_version_etag(response, etag)
 
 
 @session.route('/', methods=['PUT'])
@@ -101,7 +108,7 @@ def get():
 @login_required
 def reauth():
     """Recreate a session."""
-    current_app.logger.info('Entering session.views.reauth()...')
+    log.info('Entering session.views.reauth()')
 
     # TODO: Verify current_user.email = form.data.email
 
@@ -110,14 +117,17 @@ def reauth():
     if form.validate_on_submit():
         user, authenticated = User.authenticate(form.email.data, form.password.data)
         if user and authenticated:
+            # Saves the password if authenticate() rehashed it.
+            db.session.commit()
             confirm_login()
-            response = jsonify(status='success', data=user.session_as_dict())
+            data = user.session_as_dict()
+            response = jsend.success(data)
             response.status_code = 200
-            current_app.logger.debug('Returning success; response.data=[%s]' % response.data)
+            log.debug('Returning success', data=data)
             return response
 
-    current_app.logger.debug('Returning fail; data = [%s].' % form.errors)
-    return jsonify(status='fail', data=form.errors)
+    log.debug('Returning fail', errors=form.errors)
+    return jsend.fail(form.errors)
 
 
 @session.route('/', methods=['DELETE'])
@@ -125,10 +135,10 @@ def reauth():
 @login_required
 def delete():
     """Delete a session."""
-    current_app.logger.info('Entering session.views.delete()...')
+    log.info('Entering session.views.delete()')
     if current_user.is_authenticated():
         logout_user()
-    response = jsonify(status='success', data={'auth': False})
+    response = jsend.respond(SIGNED_OUT)
     response.status_code = 200
-    current_app.logger.debug('Returning success')
+    log.debug('Returning success')
     return response
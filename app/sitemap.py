@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+The sitemap, rendered once per url_root and kept in memory with its gzip
+variant and ETag.
+
+The rules fit in one /sitemap.xml until they outgrow what the protocol
+allows in one file (SITEMAP_MAX_URLS urls or SITEMAP_MAX_BYTES bytes);
+then /sitemap.xml is a sitemap index of /sitemap-1.xml, /sitemap-2.xml...
+"""
+
+from threading import Lock
+
+from flask import current_app, render_template
+
+from .http_cache import CachedContent
+from .timing import PhaseTimer
+
+# Clients choose url_root through the Host header, so bound how many
+# sitemaps are kept.
+MAX_URL_ROOTS = 16
+
+
+class Sitemaps(object):
+    """Build and cache the sitemap pages of each url_root."""
+
+    def __init__(self, app=None):
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SITEMAP_MAX_URLS', 50000)
+        app.config.setdefault('SITEMAP_MAX_BYTES', 50 * 1024 * 1024)
+        app.config.setdefault('SITEMAP_MAX_AGE', 86400)
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+        # url_root -> {page number or None for /sitemap.xml: CachedContent}
+        app.extensions['sitemaps'] = {}
+
+    def get(self, url_root, page=None):
+        """Return the CachedContent of a page, or None if there's no such
+        page."""
+        cache = current_app.extensions['sitemaps']
+        pages = cache.get(url_root)
+        if pages is None:
+            with self._lock:
+                pages = cache.get(url_root)
+                if pages is None:
+                    if len(cache) >= MAX_URL_ROOTS:
+                        cache.clear()
+                    with PhaseTimer('render'):
+                        pages = cache[url_root] = self.build(url_root)
+        return pages.get(page)
+
+    def build(self, url_root):
+        config = current_app.config
+        rules = [rule.rule for rule in current_app.url_map.iter_rules()]
+        per_page = config['SITEMAP_MAX_URLS']
+        while True:
+            chunks = [rules[i:i + per_page]
+                      for i in range(0, len(rules), per_page)] or [[]]
+            pages = [render_template('sitemap.xml', url_root=url_root,
+                                     rules=chunk).encode('utf-8')
+                     for chunk in chunks]
+            if per_page == 1 or \
+                    max(map(len, pages)) <= config['SITEMAP_MAX_BYTES']:
+                break
+            per_page = max(1, per_page // 2)
+
+        max_age = config['SITEMAP_MAX_AGE']
+        if len(pages) == 1:
+            return {None: CachedContent(pages[0], 'application/xml', max_age)}
+        cached = dict((number, CachedContent(data, 'application/xml', max_age))
+                      for number, data in enumerate(pages, 1))
+        index = render_template('sitemap_index.xml', url_root=url_root,
+                                pages=sorted(cached))
+        cached[None] = CachedContent(index.encode('utf-8'),
+                                     'application/xml', max_age)
+        return cached
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Static files served from the site root (robots.txt, humans.txt...).
+
+With STATIC_ROOT_CACHE on, the STATIC_ROOT_FILES are read into memory
+when the app is created, with their compressed variants and ETags, and
+served without touching the disk. Files of STATIC_SENDFILE_MIN_SIZE bytes
+or more can instead be left to the front proxy, by setting
+STATIC_SENDFILE to 'X-Sendfile' (Apache, lighttpd) or 'X-Accel-Redirect'
+(nginx, which needs an internal location at STATIC_ACCEL_REDIRECT_PREFIX
+aliased to the static folder).
+"""
+
+import mimetypes
+import os
+
+from flask import current_app, send_from_directory
+from werkzeug.exceptions import NotFound
+
+from .http_cache import CachedContent
+
+
+class SendfileContent(object):
+    """A static file whose body the front proxy sends."""
+
+    def __init__(self, path, filename, mimetype, max_age=0):
+        stat = os.stat(path)
+        self.path = path
+        self.filename = filename
+        self.mimetype = mimetype
+        self.max_age = max_age
+        self.etag = 'sendfile-%d-%d' % (stat.st_mtime, stat.st_size)
+
+    def make_response(self, request):
+        config = current_app.config
+        if request.if_none_match.contains_weak(self.etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = current_app.response_class(mimetype=self.mimetype)
+            if config['STATIC_SENDFILE'] == 'X-Accel-Redirect':
+                response.headers['X-Accel-Redirect'] = \
+                    config['STATIC_ACCEL_REDIRECT_PREFIX'] + self.filename
+            else:
+                response.headers['X-Sendfile'] = self.path
+        response.set_etag(self.etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = self.max_age
+        return response
+
+
+class StaticRoot(object):
+    """Serve the STATIC_ROOT_FILES, from memory or through the proxy."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        config.setdefault('STATIC_ROOT_FILES', ['robots.txt', 'humans.txt',
+                                                'crossdomain.xml'])
+        config.setdefault('STATIC_ROOT_CACHE', True)
+        config.setdefault('STATIC_ROOT_MAX_AGE', 7 * 86400)
+        config.setdefault('STATIC_SENDFILE', None)
+        config.setdefault('STATIC_SENDFILE_MIN_SIZE', 1024 * 1024)
+        config.setdefault('STATIC_ACCEL_REDIRECT_PREFIX', '/static-internal/')
+        if not hasattr(app, 'extensions'):
+            app.extensions = {}
+        files = app.extensions['static_root'] = {}
+        if not config['STATIC_ROOT_CACHE']:
+            return
+
+        for filename in config['STATIC_ROOT_FILES']:
+            path = os.path.join(app.static_folder, filename)
+            if not os.path.isfile(path):
+                continue
+            mimetype = mimetypes.guess_type(filename)[0] or \
+                'application/octet-stream'
+            max_age = config['STATIC_ROOT_MAX_AGE']
+            if config['STATIC_SENDFILE'] and \
+                    os.path.getsize(path) >= config['STATIC_SENDFILE_MIN_SIZE']:
+                files[filename] = SendfileContent(path, filename, mimetype,
+                                                  max_age)
+            else:
+                with open(path, 'rb') as f:
+                    files[filename] = CachedContent(f.read(), mimetype,
+                                                    max_age)
+
+    def send(self, filename, request):
+        """Return the response serving filename."""
+        if not current_app.config['STATIC_ROOT_CACHE']:
+            return send_from_directory(current_app.static_folder, filename)
+        content = current_app.extensions['static_root'].get(filename)
+        if content is None:
+            raise NotFound()
+        return content.make_response(request)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Per-request phase timers, reported in a Server-Timing header.
+
+Code doing a phase's work is timed for the current request with
+
+    with PhaseTimer('render'):
+        html = render_template(...)
+
+or, when it's already timed, record_phase('db', seconds). The phases are
+PHASES: database queries and pool checkouts (timed by engine events and
+the pool), password hashing, template rendering, CSS inlining, mail and
+JSON serialization. Emails are sent by the outbox workers, so in requests
+the mail phase is only their queuing. Outside of a request (or before
+before_request started its timings) timing does nothing.
+
+Each request's timings are logged, at INFO (so sampled like other
+records), with the milliseconds spent per phase and the number of times it
+was entered. app is the whole time in the app, and queue the time the
+request waited in front of it, from the X-Request-Start header set by the
+router (``t=`` seconds, milliseconds or microseconds since the epoch).
+
+The milliseconds are also sent in a header like
+
+    Server-Timing: queue;dur=2.10, db;dur=3.52, hash;dur=81.03, app;dur=90.47
+
+to admins and scrapers allowed to read the metrics, or to everyone with
+SERVER_TIMING. Only turn that on where clients can be trusted with them:
+which phases ran, and for how long, tell them about the data behind a
+response (e.g. whether a login's password was checked, so whether the
+account exists).
+"""
+
+import time
+
+from flask import _request_ctx_stack, current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# In Server-Timing header order.
+PHASES = ('db', 'hash', 'render', 'inline', 'mail', 'serialize')
+
+
+class Timings(object):
+    """The time spent per phase by a request."""
+
+    def __init__(self, started, queue=None):
+        self.started = started
+        self.queue = queue
+        # phase -> [seconds, count]
+        self.phases = {}
+
+    def add(self, phase, seconds):
+        totals = self.phases.get(phase)
+        if totals is None:
+            self.phases[phase] = [seconds, 1]
+        else:
+            totals[0] += seconds
+            totals[1] += 1
+
+    def header(self, total):
+        """Return the Server-Timing header value."""
+        metrics = []
+        if self.queue is not None:
+            metrics.append('queue;dur=%.2f' % (self.queue * 1000))
+        for phase in PHASES:
+            totals = self.phases.get(phase)
+            if totals is not None:
+                metrics.append('%s;dur=%.2f' % (phase, totals[0] * 1000))
+        metrics.append('app;dur=%.2f' % (total * 1000))
+        return ', '.join(metrics)
+
+    def as_dict(self, total):
+        """Return the timings as log fields, in milliseconds."""
+        fields = {'app_ms': round(total * 1000, 2)}
+        if self.queue is not None:
+            fields['queue_ms'] = round(self.queue * 1000, 2)
+        for phase, (seconds, count) in self.phases.iteritems():
+            fields[phase + '_ms'] = round(seconds * 1000, 2)
+            fields[phase + '_count'] = count
+        return fields
+
+
+def current_timings():
+    ctx = _request_ctx_stack.top
+    if ctx is None:
+        return None
+    return getattr(ctx, 'timings', None)
+
+
+def record_phase(phase, seconds):
+    """Add seconds spent in phase to the current request's timings."""
+    timings = current_timings()
+    if timings is not None:
+        timings.add(phase, seconds)
+
+
+class PhaseTimer(object):
+    """Time a with block as a phase of the current request."""
+
+    __slots__ = ('phase', 'started')
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record_phase(self.phase, time.time() - self.started)
+
+
+def parse_request_start(value, now):
+    """
+    Return the seconds elapsed since an X-Request-Start value, or None if
+    it can't be parsed.
+    """
+    if value.startswith('t='):
+        value = value[2:]
+    try:
+        started = float(value)
+    except ValueError:
+        return None
+    # Milliseconds or microseconds since the epoch, down to seconds.
+    while started > now * 100:
+        started /= 1000
+    return max(0.0, now - started)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info['timing_started'] = time.time()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = conn.info.pop('timing_started', None)
+    if started is not None:
+        record_phase('db', time.time() - started)
+
+
+class RequestTiming(object):
+    """Start the timings of requests and report them on their responses."""
+
+    _listening = False
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SERVER_TIMING', False)
+        # Every engine's queries, whichever app made it.
+        if not RequestTiming._listening:
+            event.listen(Engine, 'before_cursor_execute',
+                         _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                         _after_cursor_execute)
+            RequestTiming._listening = True
+
+    def start_request(self):
+        now = time.time()
+        queue = None
+        request_start = request.headers.get('X-Request-Start')
+        if request_start is not None:
+            queue = parse_request_start(request_start, now)
+        _request_ctx_stack.top.timings = Timings(now, queue)
+
+    def finish_request(self, response):
+        timings = current_timings()
+        if timings is None:
+            return response
+        total = time.time() - timings.started
+        # extensions imports this module.
+        from .extensions import log, metrics
+        if current_app.config['SERVER_TIMING'] or \
+                metrics.access_status() == 200:
+            response.headers['Server-Timing'] = timings.header(total)
+        log.info('Request timings', method=request.method, path=request.path,
+                 status=response.status_code, **timings.as_dict(total))
+        return response
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk import of users (`manage.py import_users`).
+
+Records are streamed from CSV (with a header row) or JSON lines, with the
+fields:
+
+* username, email: required.
+* password, to be hashed with the current hash policy, or password_hash,
+  already hashed with one of its PASSWORD_SCHEMES.
+* role, status: names (see USER_ROLE and USER_STATUS) or ids; user and
+  active by default.
+* activation_key, created_time (ISO 8601).
+* first_name, last_name, gender, dob (YYYY-MM-DD), phone, bio, url.
+
+Records are read and validated in batches. Their passwords are hashed in
+a pool of worker processes, a few batches ahead of the inserts. Each batch
+is then inserted in one transaction, with one executemany per table.
+user_details ids are allocated by the importer, so no other process may
+insert user details while it runs. A batch that breaks a unique
+constraint is inserted row by row instead, and the duplicate rows are
+skipped.
+
+After each batch the number of records done is saved to the checkpoint
+file, and an interrupted import resumes from there. If a batch was
+committed but its checkpoint wasn't saved, its rows come up again as
+duplicates and are skipped.
+"""
+
+import csv
+import json
+import os
+import time
+from collections import deque
+from datetime import datetime
+from itertools import islice
+from multiprocessing import Pool
+
+from passlib.context import CryptContext
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+from app.utils import get_current_time
+from .models import User, UserDetail, lookup_key
+from .constants import USER, ACTIVE, USER_ROLE, USER_STATUS
+
+ROLES = dict((name, id) for id, name in USER_ROLE.items())
+STATUSES = dict((name, id) for id, name in USER_STATUS.items())
+
+DETAIL_FIELDS = ('first_name', 'last_name', 'gender', 'dob', 'phone', 'bio',
+                 'url')
+
+users_table = User.__table__
+details_table = UserDetail.__table__
+
+
+def read_records(f, format):
+    """
+    Yield the records of a 'csv' or 'jsonl' file as dicts of unicode
+    values; unparsable records as None.
+    """
+    if format == 'csv':
+        for row in csv.DictReader(f):
+            yield dict((key, value.decode('utf-8'))
+                       for key, value in row.iteritems() if value)
+    elif format == 'jsonl':
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield record if isinstance(record, dict) else None
+    else:
+        raise ValueError('Unknown format: %s.' % format)
+
+
+def _parse_choice(value, choices, default):
+    if value is None:
+        return default
+    if value in choices:
+        return choices[value]
+    value = int(value)
+    if value not in choices.values():
+        raise ValueError(value)
+    return value
+
+
+def _parse_time(value):
+    if value is None:
+        return None
+    return datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def prepare(record, context, now):
+    """
+    Return the users row, user_details row and password to hash of a
+    record, or raise ValueError if it's invalid.
+    """
+    if record is None:
+        raise ValueError('Unparsable record.')
+    username, email = record.get('username'), record.get('email')
+    if not username or not email:
+        raise ValueError('Missing username or email.')
+    password = record.get('password')
+    password_hash = record.get('password_hash')
+    if password_hash is not None:
+        if context.identify(password_hash, required=False) is None:
+            raise ValueError('Unknown password hash scheme.')
+        password = None
+    elif not password:
+        raise ValueError('Missing password or password_hash.')
+
+    created_time = _parse_time(record.get('created_time')) or now
+    dob = record.get('dob')
+    detail = dict((field, record.get(field)) for field in DETAIL_FIELDS)
+    detail['dob'] = datetime.strptime(dob, '%Y-%m-%d').date() if dob else None
+    detail['phone'] = unicode(detail['phone']) if detail['phone'] else None
+    detail['created_time'] = created_time
+    detail['updated_time'] = now
+    user = {
+        'username': username,
+        'email': email,
+        'username_key': lookup_key(username),
+        'email_key': lookup_key(email),
+        'password': password_hash,
+        'activation_key': record.get('activation_key'),
+        'role_id': _parse_choice(record.get('role'), ROLES, USER),
+        'status_id': _parse_choice(record.get('status'), STATUSES, ACTIVE),
+        'created_time': created_time,
+        'updated_time': now,
+    }
+    return user, detail, password
+
+
+# Run in the worker processes, so they must be module level.
+
+_context = None
+
+
+def _init_worker(policy):
+    global _context
+    _context = CryptContext.from_string(policy)
+
+
+def _hash_batch(batch):
+    """Hash the passwords of a batch; return it and the time it took."""
+    end, rows = batch
+    started = time.time()
+    for user, detail, password in rows:
+        if password is not None:
+            user['password'] = _context.encrypt(password)
+    return (end, rows), time.time() - started
+
+
+class ImportStats(object):
+    """Counts and timings of an import."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.read = 0
+        self.imported = 0
+        self.skipped = 0
+        self.invalid = 0
+        self.hash_seconds = 0.0
+        self.insert_seconds = 0.0
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    def as_dict(self):
+        elapsed = self.elapsed
+        return {
+            'read': self.read,
+            'imported': self.imported,
+            'skipped': self.skipped,
+            'invalid': self.invalid,
+            'seconds': elapsed,
+            'users_per_second': self.imported / elapsed if elapsed else None,
+            # Summed over the workers, so it can exceed the elapsed time.
+            'hash_seconds': self.hash_seconds,
+            'insert_seconds': self.insert_seconds,
+        }
+
+    def report(self):
+        stats = self.as_dict()
+        stats['users_per_second'] = stats['users_per_second'] or 0
+        return ('%(read)d read, %(imported)d imported, %(skipped)d skipped, '
+                '%(invalid)d invalid in %(seconds).1fs: '
+                '%(users_per_second).0f users/s (hashing %(hash_seconds).1f '
+                'CPU s, inserting %(insert_seconds).1fs)' % stats)
+
+
+class Checkpoint(object):
+    """The number of records done, saved to a file after each batch."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return 0
+        with open(self.path) as f:
+            return json.load(f)['records']
+
+    def save(self, records):
+        if self.path is None:
+            return
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'records': records}, f)
+        os.rename(temp, self.path)
+
+    def clear(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class UserImporter(object):
+    """
+    Import records into engine, hashing passwords with context across
+    workers processes (inline with 0).
+    """
+
+    def __init__(self, engine, context, batch_size=1000, workers=0,
+                 checkpoint=None, report=None, report_every=10):
+        self.engine = engine
+        self.policy = context.to_string()
+        self.context = context
+        self.batch_size = batch_size
+        self.workers = workers
+        self.checkpoint = Checkpoint(checkpoint)
+        self.report = report
+        self.report_every = report_every
+        self.errors = []
+        self.stats = ImportStats()
+        self.next_detail_id = None
+
+    def run(self, records):
+        """Import records, resuming from the checkpoint; return the stats."""
+        done = self.checkpoint.load()
+        self.stats.read = done
+        batches = self._batches(islice(records, done, None))
+        return self.load(self._hashed(batches))
+
+    def load(self, batches):
+        """
+        Insert ((records done, rows), hashing seconds) batches of prepared
+        rows whose passwords are hashed; return the stats.
+        """
+        stats = self.stats
+        reported = time.time()
+        connection = self.engine.connect()
+        try:
+            self.next_detail_id = (connection.execute(
+                select([func.max(details_table.c.id)])).scalar() or 0) + 1
+            for (end, rows), seconds in batches:
+                stats.hash_seconds += seconds
+                started = time.time()
+                self._insert(connection, rows)
+                stats.insert_seconds += time.time() - started
+                self.checkpoint.save(end)
+                if self.report is not None and \
+                        time.time() - reported >= self.report_every:
+                    self.report(stats)
+                    reported = time.time()
+            self._reset_sequences(connection)
+        finally:
+            connection.close()
+        self.checkpoint.clear()
+        return stats
+
+    def _batches(self, records):
+        """Yield (records done, rows) batches of valid records."""
+        stats = self.stats
+        now = get_current_time()
+        rows = []
+        for record in records:
+            stats.read += 1
+            try:
+                rows.append(prepare(record, self.context, now))
+            except ValueError as e:
+                stats.invalid += 1
+                if len(self.errors) < 100:
+                    self.errors.append((stats.read, str(e)))
+            if len(rows) >= self.batch_size:
+                yield stats.read, rows
+                rows = []
+                now = get_current_time()
+        yield stats.read, rows
+
+    def _hashed(self, batches):
+        """Yield batches with their passwords hashed, hashing up to two
+        batches per worker ahead."""
+        if not self.workers:
+            _init_worker(self.policy)
+            for batch in batches:
+                yield _hash_batch(batch)
+            return
+        pool = Pool(self.workers, _init_worker, (self.policy,))
+        try:
+            pending = deque()
+            for batch in batches:
+                pending.append(pool.apply_async(_hash_batch, (batch,)))
+                if len(pending) >= 2 * self.workers:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+
+    def _insert(self, connection, rows):
+        if not rows:
+            return
+        users, details = [], []
+        for user, detail, password in rows:
+            detail['id'] = user['user_detail_id'] = self.next_detail_id
+            self.next_detail_id += 1
+            users.append(user)
+            details.append(detail)
+        try:
+            with connection.begin():
+                connection.execute(details_table.insert(), details)
+                connection.execute(users_table.insert(), users)
+            self.stats.imported += len(users)
+        except IntegrityError:
+            for user, detail in zip(users, details):
+                try:
+                    with connection.begin():
+                        connection.execute(details_table.insert(), detail)
+                        connection.execute(users_table.insert(), user)
+                    self.stats.imported += 1
+                except IntegrityError:
+                    self.stats.skipped += 1
+
+    def _reset_sequences(self, connection):
+        # The ids were inserted explicitly, bypassing PostgreSQL's sequence.
+        if connection.dialect.name == 'postgresql':
+            connection.execute(
+                "SELECT setval(pg_get_serial_sequence('user_details', 'id'), "
+                "(SELECT max(id) FROM user_details))")
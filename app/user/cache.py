@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Per-process cache of the users Flask-Login loads on every authenticated
+request.
+
+The cache holds UserSnapshot objects, not User instances, so they outlive
+the db session. An entry is dropped when a commit updates or deletes its
+user in this process, and expires after USER_CACHE_TTL seconds otherwise,
+which bounds how stale other processes' entries can get. Snapshots are
+always loaded from the primary, even when the request reads from a replica.
+"""
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, object_session
+
+from app.extensions import db
+from .models import User
+from .constants import ACTIVE, USER_ROLE, USER_STATUS
+
+
+class UserSnapshot(object):
+    """A detached, read-only stand-in for User as current_user."""
+
+    __slots__ = ('id', 'username', 'email', 'status_id', 'role_id',
+                 'updated_time')
+
+    def __init__(self, id, username, email, status_id, role_id,
+                 updated_time):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.status_id = status_id
+        self.role_id = role_id
+        self.updated_time = updated_time
+
+    def get_role(self):
+        return USER_ROLE[self.role_id]
+
+    def get_status(self):
+        return USER_STATUS[self.status_id]
+
+    def session_as_dict(self):
+        from .serializers import SESSION_FIELDS, get_serializer
+        data = get_serializer(SESSION_FIELDS).from_user(self)
+        data["auth"] = True
+        return data
+
+    def __repr__(self):
+        return '<UserSnapshot %r>' % (self.username)
+
+    # ================================================================
+    # Required by Flask-Login
+
+    def is_authenticated(self):
+        return True
+
+    def is_active(self):
+        return True if self.status_id == ACTIVE else False
+
+    def is_anonymous(self):
+        return False
+
+    def get_id(self):
+        return unicode(self.id)
+
+
+class UserCache(object):
+    """LRU cache of UserSnapshots with a TTL, keyed by user id."""
+
+    def __init__(self, app=None):
+        self.size = 0
+        self.ttl = 0
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        # Bumped by every invalidation, so a load racing with one doesn't
+        # cache what it read before the commit.
+        self._generation = 0
+        self.hits = self.misses = self.invalidations = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('USER_CACHE_SIZE', 10000)
+        app.config.setdefault('USER_CACHE_TTL', 60)
+        self.size = app.config['USER_CACHE_SIZE']
+        self.ttl = app.config['USER_CACHE_TTL']
+        self.clear()
+
+    def load(self, id):
+        """Return the snapshot of user id, or None if there's no such user."""
+        with self._lock:
+            entry = self._entries.pop(id, None)
+            if entry is not None and entry[1] > time.time():
+                self._entries[id] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self._generation
+
+        # Read from the primary: a replica may not have the row's latest
+        # version yet, and caching that would serve it for the whole TTL.
+        row = db.get_engine(db.get_app()).execute(
+            select([User.id, User.username, User.email, User.status_id,
+                    User.role_id, User.updated_time])
+            .where(User.id == id)).first()
+        if row is None:
+            return None
+        snapshot = UserSnapshot(*row)
+
+        with self._lock:
+            if generation == self._generation and self.size:
+                self._entries[id] = (snapshot, time.time() + self.ttl)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        return snapshot
+
+    def invalidate(self, ids):
+        with self._lock:
+            self._generation += 1
+            for id in ids:
+                if self._entries.pop(id, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self.hits = self.misses = self.invalidations = 0
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'invalidations': self.invalidations}
+
+
+user_cache = UserCache()
+
+
+# ================================================================
+# Invalidation: users updated or deleted in a flush are remembered on their
+# session and dropped from the cache once (and only if) it commits.
+
+def _remember_user(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        if not hasattr(session, '_changed_user_ids'):
+            session._changed_user_ids = set()
+        session._changed_user_ids.add(target.id)
+
+
+def _invalidate_users(session):
+    ids = getattr(session, '_changed_user_ids', None)
+    if ids:
+        del session._changed_user_ids
+        user_cache.invalidate(ids)
+
+
+def _forget_users(session):
+    if hasattr(session, '_changed_user_ids'):
+        del session._changed_user_ids
+
+
+event.listen(User, 'after_update', _remember_user)
+event.listen(User, 'after_delete', _remember_user)
+event.listen(Session, 'after_commit', _invalidate_users)
+event.listen(Session, 'after_rollback', _forget_users)
@@ -27,3 +27,8 @@ USER_STATUS = {
     NEW: 'new',
     ACTIVE: 'active',
 }
+
+# User listing
+USERS_PAGE_LIMIT = 50
+USERS_PAGE_LIMIT_MAX = 500
+USERS_STREAM_CHUNK_SIZE = 1000
@@ -1,11 +1,15 @@
 from flask.ext.login import AnonymousUser
-from passlib.hash import sha256_crypt
 
-from app.extensions import db
-from app.utils import get_current_time, format_date
+from app.extensions import db, hasher
+from app.utils import get_current_time
 from .constants import USER, USER_ROLE, ACTIVE, INACTIVE, USER_STATUS
 
 
+def lookup_key(login):
+    """Normalize a username or email for lookups."""
+    return login.strip().lower() if login is not None else None
+
+
 class User(db.Model):
 
     __tablename__ = 'users'
@@ -13,19 +17,30 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(32), nullable=False, unique=True)
     email = db.Column(db.String(255), unique=True)
+    # Normalized copies of username and email that logins are looked up by.
+    username_key = db.Column(db.String(32), nullable=False, unique=True)
+    email_key = db.Column(db.String(255), unique=True)
     activation_key = db.Column(db.String(36))
     created_time = db.Column(db.DateTime, default=get_current_time)
+    # Version of the row, which ETags are derived from.
+    updated_time = db.Column(db.DateTime, default=get_current_time,
+                             onupdate=get_current_time)
+
+    @db.validates('username', 'email')
+    def _set_lookup_key(self, key, value):
+        setattr(self, '%s_key' % key, lookup_key(value))
+        return value
 
     # ================================================================
     # Password
 
-    _password = db.Column('password', db.String(20), nullable=False)
+    _password = db.Column('password', db.String(255), nullable=False)
 
     def _get_password(self):
         return self._password
 
     def _set_password(self, password):
-        self._password = sha256_crypt.encrypt(password, rounds=12345)
+        self._password = hasher.encrypt(password)
 
     # Hide password encryption by exposing password field only.
     password = db.synonym('_password',
@@ -35,7 +50,21 @@ class User(db.Model):
     def check_password(self, password):
         if self._password is None:
             return False
-        return sha256_crypt.verify(password, self._password)
+        return hasher.verify(password, self._password)
+
+    def check_and_update_password(self, password):
+        """
+        Check password and, if it's right but the stored hash is outdated or
+        too expensive for the current hash policy, rehash it. The new hash is
+        only added to the session; the caller commits it.
+        """
+        if self._password is None:
+            return False
+        verified, new_hash = hasher.verify_and_update(password, self._password)
+        if new_hash is not None:
+            self._password = new_hash
+            db.session.add(self)
+        return verified
 
     # ================================================================
     # One-to-many relationship between users and roles.
@@ -59,10 +88,25 @@ class User(db.Model):
     # ================================================================
     # Class methods
 
-    @classmethod  # TODO: What does this do?
+    @classmethod
+    def get_by_login(cls, login):
+        """
+        Get a user by email or username, case insensitively. Logins without
+        an '@' can only be usernames, so only that index is queried; those
+        with one are looked up as emails first, then as usernames, which
+        may have an '@' too.
+        """
+        key = lookup_key(login)
+        if '@' in key:
+            user = cls.query.filter(User.email_key == key).first()
+            if user is not None:
+                return user
+        return cls.query.filter(User.username_key == key).first()
+
+    @classmethod
     def authenticate(cls, login, password):
-        user = cls.query.filter(db.or_(User.username == login, User.email == login)).first()
-        authenticated = user.check_password(password) if user else False
+        user = cls.get_by_login(login)
+        authenticated = user.check_and_update_password(password) if user else False
 
         return user, authenticated
 
@@ -73,29 +117,16 @@ class User(db.Model):
         return self.user_detail.dob.isoformat() if self.user_detail.dob is not None else None
 
     def as_dict(self):
-        return {"id": self.id,
-                "username": self.username,
-                "email": self.email,
-                "created_time": format_date(self.created_time),
-                "first_name": self.user_detail.first_name,
-                "last_name": self.user_detail.last_name,
-                "gender": self.user_detail.gender,
-                "dob": self.get_dob(),
-                "phone": self.user_detail.phone,
-                "bio": self.user_detail.bio,
-                "url": self.user_detail.url
-                }
+        from .serializers import get_serializer
+        return get_serializer().from_user(self)
 
     def session_as_dict(self):
         is_authenticated = self.is_authenticated()
         if (is_authenticated):
-            return {
-                "id": self.id,
-                "username": self.username,
-                "email": self.email,
-                "status": self.get_status(),
-                "auth": is_authenticated
-            }
+            from .serializers import SESSION_FIELDS, get_serializer
+            data = get_serializer(SESSION_FIELDS).from_user(self)
+            data["auth"] = is_authenticated
+            return data
         else:
             return {"auth": is_authenticated}
 
@@ -133,3 +164,5 @@ class UserDetail(db.Model):
     bio = db.Column(db.String)
     url = db.Column(db.String)
     created_time = db.Column(db.DateTime, default=get_current_time)
+    updated_time = db.Column(db.DateTime, default=get_current_time,
+                             onupdate=get_current_time)
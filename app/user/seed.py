@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic users for scale testing (`manage.py seed`).
+
+Users are generated in fixed blocks of SEED_BLOCK indexes, each from a
+random.Random seeded with the seed and the block, so a user only depends on
+the seed and its index, however runs are split up (--start, --batch-size);
+only the timestamps are relative to now and to the users seeded. Values follow rough
+production distributions: mostly active users, a few staff and admins,
+pending activation keys, some missing profile fields and bios of very
+varied length, created evenly over the last SEED_YEARS years.
+
+Hashing each password would take hours for millions of users, so they all
+share one hash of SEED_PASSWORD, computed once: any of them can log in
+with it. Rows are bulk-loaded through the UserImporter's batched inserts,
+and users already there (e.g. from an earlier run) are skipped.
+"""
+
+import random
+from datetime import timedelta
+from uuid import UUID
+
+from app.utils import get_current_time
+from .bulk import UserImporter
+from .constants import (ADMIN, STAFF, USER, INACTIVE, NEW, ACTIVE,
+                        USERNAME_LEN_MAX)
+
+SEED_PASSWORD = 'default'
+SEED_YEARS = 5
+# Users generated from one random.Random.
+SEED_BLOCK = 1000
+
+FIRST_NAMES = [
+    u'James', u'Mary', u'John', u'Patricia', u'Robert', u'Jennifer',
+    u'Michael', u'Linda', u'William', u'Elizabeth', u'David', u'Barbara',
+    u'Richard', u'Susan', u'Joseph', u'Jessica', u'Thomas', u'Sarah',
+    u'Charles', u'Karen', u'Daniel', u'Nancy', u'Matthew', u'Lisa',
+    u'Anthony', u'Betty', u'Mark', u'Margaret', u'Donald', u'Sandra',
+    u'Steven', u'Ashley', u'Paul', u'Kimberly', u'Andrew', u'Emily',
+    u'Joshua', u'Donna', u'Kenneth', u'Michelle', u'Kevin', u'Dorothy',
+    u'Brian', u'Carol', u'George', u'Amanda', u'Edward', u'Melissa',
+    u'Ronald', u'Deborah', u'Timothy', u'Stephanie', u'Jason', u'Rebecca',
+    u'Jérôme', u'Zoë', u'Nguyễn', u'François',
+]
+LAST_NAMES = [
+    u'Smith', u'Johnson', u'Williams', u'Brown', u'Jones', u'Garcia',
+    u'Miller', u'Davis', u'Rodriguez', u'Martinez', u'Hernandez', u'Lopez',
+    u'Gonzalez', u'Wilson', u'Anderson', u'Thomas', u'Taylor', u'Moore',
+    u'Jackson', u'Martin', u'Lee', u'Perez', u'Thompson', u'White',
+    u'Harris', u'Sanchez', u'Clark', u'Ramirez', u'Lewis', u'Robinson',
+    u'Walker', u'Young', u'Allen', u'King', u'Wright', u'Scott', u'Torres',
+    u'Nguyen', u'Hill', u'Flores', u'Green', u'Adams', u'Nelson', u'Baker',
+    u'Tremblay', u'Gagnon', u'Côté', u'Bouchard',
+]
+DOMAINS = ['example.com', 'example.org', 'example.net', 'mail.example.com']
+WORDS = (u'lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         u'eiusmod tempor incididunt ut labore et dolore magna aliqua enim '
+         u'ad minim veniam quis nostrud exercitation ullamco laboris nisi '
+         u'aliquip ex ea commodo consequat duis aute irure in reprehenderit '
+         u'voluptate velit esse cillum fugiat nulla pariatur excepteur sint '
+         u'occaecat cupidatat non proident sunt culpa qui officia deserunt '
+         u'mollit anim id est laborum café naïve').split()
+
+# (cumulative probability, value)
+STATUSES = [(0.80, ACTIVE), (0.92, NEW), (1.0, INACTIVE)]
+ROLES = [(0.0001, ADMIN), (0.005, STAFF), (1.0, USER)]
+GENDERS = [(0.49, u'female'), (0.98, u'male'), (1.0, None)]
+
+
+def _pick(rng, distribution):
+    x = rng.random()
+    for probability, value in distribution:
+        if x < probability:
+            return value
+    return distribution[-1][1]
+
+
+def _ascii(name):
+    return name.lower().encode('ascii', 'ignore').decode('ascii')
+
+
+def _bio(rng):
+    # Most users write nothing or a line, a few write pages.
+    if rng.random() < 0.4:
+        return None
+    length = min(int(rng.lognormvariate(4.5, 1.2)), 10000)
+    words = []
+    size = 0
+    while size < length:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return u' '.join(words).capitalize() + u'.'
+
+
+def generate(rng, index, password_hash, created_time, now):
+    """Return the users and user_details rows of user index."""
+    first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    suffix = unicode(index)
+    username = _ascii(first[0] + last)[:USERNAME_LEN_MAX - len(suffix)] + \
+        suffix
+    email = u'%s.%s%s@%s' % (_ascii(first), _ascii(last), suffix,
+                             rng.choice(DOMAINS))
+    status = _pick(rng, STATUSES)
+    if status == ACTIVE and rng.random() > 0.05:
+        activation_key = None
+    else:
+        activation_key = str(UUID(int=rng.getrandbits(128), version=4))
+    age = rng.triangular(13, 90, 28)
+    user = {
+        'username': username,
+        'email': email,
+        'username_key': username.lower(),
+        'email_key': email.lower(),
+        'password': password_hash,
+        'activation_key': activation_key,
+        'role_id': _pick(rng, ROLES),
+        'status_id': status,
+        'created_time': created_time,
+        'updated_time': created_time if rng.random() < 0.7 else now,
+    }
+    detail = {
+        'first_name': first,
+        'last_name': last,
+        'gender': _pick(rng, GENDERS),
+        'dob': now.date() - timedelta(days=int(age * 365.25)),
+        'phone': u'%010d' % rng.randrange(2000000000, 9999999999)
+        if rng.random() < 0.7 else None,
+        'bio': _bio(rng),
+        'url': u'http://www.example.com/%s' % username
+        if rng.random() < 0.2 else None,
+        'created_time': created_time,
+        'updated_time': user['updated_time'],
+    }
+    return user, detail
+
+
+def generate_batches(count, seed=0, start=0, batch_size=5000,
+                     password_hash=None):
+    """
+    Yield ((users done, rows), 0) batches of users start to start + count
+    for UserImporter.load.
+    """
+    now = get_current_time()
+    first_created = now - timedelta(days=365 * SEED_YEARS)
+    # Created evenly over the period, in id order.
+    step = timedelta(days=365 * SEED_YEARS) / max(start + count, 1)
+    rng = None
+    for batch_start in xrange(start, start + count, batch_size):
+        rows = []
+        for index in xrange(batch_start,
+                            min(batch_start + batch_size, start + count)):
+            if rng is None or index % SEED_BLOCK == 0:
+                rng = random.Random((seed << 32) + index // SEED_BLOCK)
+                # Starting within a block: draw its users before index.
+                for skipped in xrange(index - index % SEED_BLOCK, index):
+                    generate(rng, skipped, password_hash, now, now)
+            user, detail = generate(rng, index, password_hash,
+                                    first_created + step * index, now)
+            rows.append((user, detail, None))
+        yield (index + 1 - start, rows), 0.0
+
+
+def seed_users(engine, context, count, seed=0, start=0, batch_size=5000,
+               report=None):
+    """Insert count synthetic users; return the import stats."""
+    importer = UserImporter(engine, context, batch_size=batch_size,
+                            report=report)
+    password_hash = context.encrypt(SEED_PASSWORD)
+    importer.stats.read = count
+    return importer.load(generate_batches(count, seed, start, batch_size,
+                                          password_hash))
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Serialization of users (and their details) into plain dicts for the JSON
+API.
+
+A serializer is built once per projection (the ``?fields=`` query
+parameter) and knows which columns it needs, so read paths can fetch plain
+row tuples with a single joined select instead of hydrating ORM objects
+and lazy loading ``User.user_detail`` for every row.
+"""
+
+from app.extensions import db
+from app.utils import format_date
+from .models import User, UserDetail
+from .constants import USER_STATUS
+
+_users = User.__table__
+_details = UserDetail.__table__
+
+
+def _memoize(formatter, maxsize=4096):
+    """Cache a formatter's output for values that repeat across rows."""
+    cache = {}
+
+    def memoized(value):
+        try:
+            return cache[value]
+        except KeyError:
+            if len(cache) >= maxsize:
+                cache.clear()
+            result = cache[value] = formatter(value)
+            return result
+    return memoized
+
+
+def _format_created_time(value):
+    return format_date(value) if value is not None else None
+
+
+@_memoize
+def _format_dob(value):
+    return value.isoformat() if value is not None else None
+
+
+@_memoize
+def _format_status(value):
+    return USER_STATUS[value]
+
+
+# name -> (column, formatter)
+FIELDS = {
+    'id': (_users.c.id, None),
+    'username': (_users.c.username, None),
+    'email': (_users.c.email, None),
+    'status': (_users.c.status_id, _format_status),
+    'created_time': (_users.c.created_time, _format_created_time),
+    'first_name': (_details.c.first_name, None),
+    'last_name': (_details.c.last_name, None),
+    'gender': (_details.c.gender, None),
+    'dob': (_details.c.dob, _format_dob),
+    'phone': (_details.c.phone, None),
+    'bio': (_details.c.bio, None),
+    'url': (_details.c.url, None),
+}
+
+# Projection of User.as_dict().
+DEFAULT_FIELDS = ('id', 'username', 'email', 'created_time', 'first_name',
+                  'last_name', 'gender', 'dob', 'phone', 'bio', 'url')
+
+# Projection of User.session_as_dict().
+SESSION_FIELDS = ('id', 'username', 'email', 'status')
+
+
+class UserSerializer(object):
+    """Serialize users to dicts restricted to a projection of fields."""
+
+    def __init__(self, fields=DEFAULT_FIELDS):
+        unknown = [name for name in fields if name not in FIELDS]
+        if unknown:
+            raise ValueError('Unknown field(s): %s.' % ', '.join(unknown))
+
+        self.fields = tuple(fields)
+        # The id is always selected (first) so listings can keyset paginate
+        # on it, whether or not it was asked for.
+        self.columns = [_users.c.id]
+        self._plan = []
+        for name in self.fields:
+            column, formatter = FIELDS[name]
+            if column is _users.c.id:
+                index = 0
+            else:
+                index = len(self.columns)
+                self.columns.append(column)
+            self._plan.append((name, column, index, formatter))
+        self.needs_detail = any(column.table is _details
+                                for column in self.columns)
+
+    def select(self, *criteria):
+        """Return a core select of the projected columns, ordered by id."""
+        return self._select(self.columns, criteria)
+
+    def versions(self, *criteria):
+        """
+        Return a core select of the versions (ids and updated times) of the
+        rows select() would serialize, in the same order.
+        """
+        columns = [_users.c.id, _users.c.updated_time]
+        if self.needs_detail:
+            columns.append(_details.c.updated_time)
+        return self._select(columns, criteria)
+
+    def _select(self, columns, criteria):
+        from_obj = _users.outerjoin(_details) if self.needs_detail else _users
+        query = db.select(columns, from_obj=from_obj).order_by(_users.c.id)
+        for criterion in criteria:
+            query = query.where(criterion)
+        return query
+
+    def first(self, *criteria):
+        """Fetch and serialize the first user matching the criteria."""
+        row = db.session.execute(self.select(*criteria).limit(1)).first()
+        return self.from_row(row) if row is not None else None
+
+    def from_row(self, row):
+        """Serialize a row of select()."""
+        data = {}
+        for name, column, index, formatter in self._plan:
+            value = row[index]
+            data[name] = formatter(value) if formatter else value
+        return data
+
+    def from_user(self, user):
+        """Serialize an already loaded User instance."""
+        data = {}
+        for name, column, index, formatter in self._plan:
+            source = user.user_detail if column.table is _details else user
+            value = getattr(source, column.key) if source is not None else None
+            data[name] = formatter(value) if formatter else value
+        return data
+
+
+_serializers = {}
+
+
+def get_serializer(fields=None):
+    """
+    Return the (cached) serializer for a ``fields`` projection, given as a
+    sequence or a comma separated string, or the default projection if it's
+    empty.
+
+    Raises ValueError for unknown fields.
+    """
+    if isinstance(fields, basestring):
+        fields = [name.strip() for name in fields.split(',')]
+    key = tuple(name for name in fields if name) if fields else ()
+    serializer = _serializers.get(key)
+    if serializer is None:
+        if len(_serializers) >= 256:
+            _serializers.clear()
+        serializer = _serializers[key] = UserSerializer(key or DEFAULT_FIELDS)
+    return serializer
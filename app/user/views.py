@@ -1,24 +1,25 @@
 """This module contains the view functions for the user blueprint."""
 
 from uuid import uuid4
-from premailer import Premailer
-from smtplib import SMTPDataError
 from urllib import quote
 
-from flask import (Blueprint, current_app, request, jsonify,
-                   render_template)
+from flask import Blueprint, Response, current_app, request, url_for
 from flask.ext.login import (login_required, current_user)
 from flaskext.babel import gettext as _
 from flask_mail import Message
 
-from app.extensions import db, mail
+from app.extensions import db, email_renderer, jsend, log
 from app.decorators import crossdomain
-from app.utils import get_resource_as_string
+from app.outbox import enqueue
+from app.http_cache import not_modified, set_version_etag, version_etag
 from .models import User, UserDetail
+from .serializers import get_serializer
 from .forms import (ActivateForm, ChangePasswordForm,
                     DeactivateAccountForm, ProfileForm, RegisterForm,
                     RecoverPasswordForm)
-from .constants import USER, ACTIVE, INACTIVE, ADMIN, STAFF
+from .constants import (USER, ACTIVE, INACTIVE, ADMIN, STAFF,
+                        USERS_PAGE_LIMIT, USERS_PAGE_LIMIT_MAX,
+                        USERS_STREAM_CHUNK_SIZE)
 from ..session.decorators import anonymous_required
 
 
@@ -36,34 +37,115 @@ def get(id=None):
     Get a user given an ID.
     Get a list of users.
     """
-    current_app.logger.info('Entering users.views.get()...')
+    log.info('Entering users.views.get()')
+
+    fields = request.args.get('fields')
+    try:
+        serializer = get_serializer(fields)
+    except ValueError as e:
+        response = jsend.fail({'fields': str(e)})
+        response.status_code = 200
+        log.debug('Returning fail', error=str(e))
+        return response
 
     if id is None:
         if current_user.role_id == ADMIN or current_user.role_id == STAFF:
-            # Get and return list of users.
-            users = User.query.all()
-            return jsonify(dict(users=[user.as_dict() for user in users]))
-        else:
-            # Get and return current user.
-            response = jsonify(status='success', data=current_user.as_dict())
-            response.status_code = 200
-            current_app.logger.debug('Returning success; response.data=[%s]' % response.data)
-            return response
-    else:
-        # Get the user.
-        user = User.query.get(id)
+            # Get and return a page of users, keyset paginated on id.
+            after = request.args.get('after', None, type=int)
+            if request.args.get('stream'):
+                return stream_users(serializer, after)
+
+            limit = request.args.get('limit', USERS_PAGE_LIMIT, type=int)
+            limit = max(1, min(limit, USERS_PAGE_LIMIT_MAX))
+            criteria = [User.id > after] if after is not None else []
+
+            # Revalidate the page from its rows' versions alone.
+            versions = db.session.execute(
+                serializer.versions(*criteria).limit(limit + 1)).fetchall()
+            etag = version_etag(serializer.fields,
+                                [tuple(row) for row in versions])
+            response = not_modified(request, etag)
+            if response is not None:
+                log.debug('Returning not modified')
+                return response
 
-        # Return the user.
-        if not user:
-            response = jsonify(status='fail', data={'id': 'Sorry, no user found.'})
+            query = serializer.select(*criteria)
+            rows = db.session.execute(query.limit(limit + 1)).fetchall()
+
+            next_url = None
+            if len(rows) > limit:
+                rows = rows[:limit]
+                next_url = url_for('.get', limit=limit, after=rows[-1][0],
+                                   fields=fields, _external=True)
+
+            response = jsend.success({
+                'users': [serializer.from_row(row) for row in rows],
+                'next': next_url})
+            if next_url is not None:
+                response.headers['Link'] = '<%s>; rel="next"' % next_url
             response.status_code = 200
-            current_app.logger.debug('Returning fail; data = [Sorry, no user found.].')
-            return response
+            log.debug('Returning success', users=len(rows), next=next_url)
+            return set_version_etag(response, etag)
         else:
-            response = jsonify(status='success', data=user.as_dict())
-            response.status_code = 200
-            current_app.logger.debug('Returning success; response.data=[%s]' % response.data)
-            return response
+            # Get and return current user.
+            id = current_user.id
+
+    # Revalidate the user from its version alone.
+    version = db.session.execute(serializer.versions(User.id == id)).first()
+    if version is None:
+        response = jsend.fail({'id': 'Sorry, no user found.'})
+        response.status_code = 200
+        log.debug('Returning fail; no user found', id=id)
+        return response
+    etag = version_etag(serializer.fields, tuple(version))
+    response = not_modified(request, etag)
+    if response is not None:
+        log.debug('Returning not modified', id=id)
+        return response
+
+    # Get and return the user.
+    data = serializer.first(User.id == id)
+    response = jsend.success(data)
+    response.status_code = 200
+    log.debug('Returning success', data=data)
+    return set_version_etag(response, etag)
+
+
+def stream_users(serializer, after=None):
+    """
+    Stream the list of users as a JSON array, chunk by chunk, from a
+    server-side cursor so memory stays flat whatever the table size.
+    """
+    # The db session is removed on teardown, before the body is iterated,
+    # so the generator holds its own connection, to the engine the session
+    # reads from.
+    query = serializer.select()
+    if after is not None:
+        query = query.where(User.id > after)
+    engine = db.session.get_bind(clause=query)
+
+    encode = jsend.encode
+
+    def generate():
+        connection = engine.connect()
+        try:
+            result = connection.execution_options(stream_results=True) \
+                .execute(query)
+            yield '{"status":"success","data":{"users":['
+            separator = ''
+            while True:
+                rows = result.fetchmany(USERS_STREAM_CHUNK_SIZE)
+                if not rows:
+                    break
+                # One encoder call per chunk, without its brackets.
+                yield separator + encode(
+                    [serializer.from_row(row) for row in rows])[1:-1]
+                separator = ','
+            yield ']}}'
+        finally:
+            connection.close()
+
+    return Response(generate(), mimetype='application/json')
 
 
 @user.route('/<string:email>/<string:activation_key>/', methods=['GET'])
@@ -71,28 +153,28 @@ def get(id=None):
 @anonymous_required
 def get_alt(email=None, activation_key=None):
     """Get a user given an email and activation key."""
-    current_app.logger.info('Entering users.views.get_alt()...')
+    log.info('Entering users.views.get_alt()')
 
     if (email is not None and activation_key is not None):
         # Get the user.
-        user = User.query.filter_by(activation_key=activation_key) \
-            .filter_by(email=email).first()
+        data = get_serializer().first(User.activation_key == activation_key,
+                                      User.email == email)
 
         # Return the user.
-        if not user:
-            response = jsonify(status='fail', data={'id': 'Sorry, no user found.'})
+        if not data:
+            response = jsend.fail({'id': 'Sorry, no user found.'})
             response.status_code = 200
-            current_app.logger.debug('Returning fail; response.data=[%s]' % response.data)
+            log.debug('Returning fail; no user found', email=email)
             return response
         else:
-            response = jsonify(status='success', data=user.as_dict())
+            response = jsend.success(data)
             response.status_code = 200
-            current_app.logger.debug('Returning success; response.data=[%s]' % response.data)
+            log.debug('Returning success', data=data)
             return response
     else:
-        response = jsonify(status='fail', data={'id': 'Sorry, no user found.'})
+        response = jsend.fail({'id': 'Sorry, no user found.'})
         response.status_code = 200
-        current_app.logger.debug('Returning fail; response.data=[%s]' % response.data)
+        log.debug('Returning fail; no user found')
         return response
 
 
@@ -101,7 +183,7 @@ def get_alt(email=None, activation_key=None):
 @anonymous_required
 def post():
     """Create a user."""
-    current_app.logger.info('Entering users.views.post()...')
+    log.info('Entering users.views.post()')
 
     form = RegisterForm()
     if request.method == 'POST' and form.validate_on_submit():
@@ -116,21 +198,23 @@ def post():
 
         # Insert the record in our database and commit it
         db.session.add(user)
+        db.session.flush()
+        data = get_serializer().from_user(user)
         db.session.commit()
         # Return response
-        response = jsonify(status='success', data=user.as_dict())
+        response = jsend.success(data)
         response.status_code = 200
-        current_app.logger.debug('Returning success')
+        log.debug('Returning success', id=data['id'])
         return response
     elif request.method == 'POST':
-        response = jsonify(status='fail', data=form.errors)
+        response = jsend.fail(form.errors)
         response.status_code = 200
-        current_app.logger.debug('Returning fail; data = [%s].' % form.errors)
+        log.debug('Returning fail', errors=form.errors)
         return response
     else:
-        response = jsonify(status='error', message=_('Wrong data.'))
+        response = jsend.error(_('Wrong data.'))
         response.status_code = 405
-        current_app.logger.debug('Returning error; form errors = [%s]' % form.errors)
+        log.debug('Returning error', errors=form.errors)
         return response
 
 
@@ -139,7 +223,7 @@ def post():
 @login_required
 def delete(id):
     """Delete a user."""
-    current_app.logger.info('Entering users.views.delete()...')
+    log.info('Entering users.views.delete()')
 
     # TODO: Verify that id === current_user.id
 
@@ -148,33 +232,23 @@ def delete(id):
     if form.validate():
         user.status_id = INACTIVE
         db.session.add(user)
-        db.session.commit()
 
-        # Send deactivation receipt email
-        css = get_resource_as_string('static/css/email.css')
+        # Queue deactivation receipt email
         reactivate_request_url = '%s/#sessions/login/' % current_app.config['DOMAIN']
-        current_app.logger.debug('reactivate_request_url=[%s]' % reactivate_request_url)
-        html = render_template('user/emails/deactivate_receipt.html', css=css, username=user.username, email_recipient=user.email, reactivate_request_url=reactivate_request_url)
+        log.debug('Queued deactivation receipt', reactivate_request_url=reactivate_request_url)
+        html = email_renderer.render('user/emails/deactivate_receipt.html', username=user.username, email_recipient=user.email, reactivate_request_url=reactivate_request_url)
 
-        p = Premailer(html)
-        result_html = p.transform()
-
-        message = Message(subject='Your %s account is now deactivated' % current_app.config['APP_NAME'], html=result_html, recipients=[user.email])
-        try:
-            mail.send(message)
-        except SMTPDataError as e:
-            current_app.logger.error('Returning fail = [%s].' % e)
-            response = jsonify(status='fail', data={'email': "Couldn't send email to %s." % form.email.data})
-            response.status_code = 200
-            return response
+        message = Message(subject='Your %s account is now deactivated' % current_app.config['APP_NAME'], html=html, recipients=[user.email])
+        enqueue(message)
+        db.session.commit()
 
         # Return response
-        response = jsonify(status='success')
+        response = jsend.success()
         response.status_code = 200
         return response
     else:
-        response = jsonify(status='fail', data=form.errors)
-        current_app.logger.debug('form errors = [%s]' % form.errors)
+        response = jsend.fail(form.errors)
+        log.debug('Returning fail', errors=form.errors)
         response.status_code = 200
         return response
 
@@ -184,11 +258,11 @@ def delete(id):
 @login_required
 def put(id):
     """Update a user."""
-    current_app.logger.info('Entering users.views.put()...')
+    log.info('Entering users.views.put()')
 
     # TODO: Verify that id === current_user.id
 
-    user = User.query.get(id)
+    user = User.query.options(db.joinedload('user_detail')).get(id)
 
     form = None
     if ('password' in request.data):
@@ -202,13 +276,13 @@ def put(id):
         db.session.add(user)
         db.session.commit()
 
-        current_app.logger.debug('Returning success.')
-        response = jsonify(status='success')
+        log.debug('Returning success')
+        response = jsend.success()
         response.status_code = 200
         return response
     else:
-        current_app.logger.debug('Returning fail = [%s].' % form.errors)
-        response = jsonify(status='fail', data=form.errors)
+        log.debug('Returning fail', errors=form.errors)
+        response = jsend.fail(form.errors)
         response.status_code = 200
         return response
 
@@ -218,16 +292,16 @@ def put(id):
 @anonymous_required
 def put_password(email, activation_key):
     """Update a user's password."""
-    current_app.logger.info('Entering users.views.put_password()...')
+    log.info('Entering users.views.put_password()')
 
     user = User.query.filter_by(activation_key=activation_key) \
                      .filter_by(email=email).first()
     form = ChangePasswordForm()
 
     if not user:
-        response = jsonify(status='fail', data={'id': "Password couldn't be changed. Perhaps you already changed it?"})
+        response = jsend.fail({'id': "Password couldn't be changed. Perhaps you already changed it?"})
         response.status_code = 200
-        current_app.logger.debug('Returning fail; data = [Sorry, no user found.].')
+        log.debug('Returning fail; no user found', email=email)
         return response
     elif user and form.validate_on_submit():
         user.password = form.password.data
@@ -236,13 +310,13 @@ def put_password(email, activation_key):
         db.session.add(user)
         db.session.commit()
 
-        current_app.logger.debug('Returning success.')
-        response = jsonify(status='success')
+        log.debug('Returning success')
+        response = jsend.success()
         response.status_code = 200
         return response
     else:
-        current_app.logger.debug('Returning fail = [%s].' % form.errors)
-        response = jsonify(status='fail', data=form.errors)
+        log.debug('Returning fail', errors=form.errors)
+        response = jsend.fail(form.errors)
         response.status_code = 200
         return response
 
@@ -252,16 +326,16 @@ def put_password(email, activation_key):
 @anonymous_required
 def put_activate(email, activation_key):
     """Activate a user."""
-    current_app.logger.info('Entering users.views.put_activate()...')
+    log.info('Entering users.views.put_activate()')
 
     user = User.query.filter_by(activation_key=activation_key) \
                      .filter_by(email=email).first()
     form = ActivateForm()
 
     if not user:
-        response = jsonify(status='fail', data={'id': "Account couldn't be activated. Perhaps you already activated it?"})
+        response = jsend.fail({'id': "Account couldn't be activated. Perhaps you already activated it?"})
         response.status_code = 200
-        current_app.logger.debug('Returning fail; response.data=[%s]' % response.data)
+        log.debug('Returning fail; no user found', email=email)
         return response
     elif user and form.validate_on_submit():
         user.status_id = ACTIVE
@@ -270,14 +344,14 @@ def put_activate(email, activation_key):
         db.session.add(user)
         db.session.commit()
 
-        response = jsonify(status='success')
+        response = jsend.success()
         response.status_code = 200
-        current_app.logger.debug('Returning success.')
+        log.debug('Returning success')
         return response
     else:
-        response = jsonify(status='fail', data=form.errors)
+        response = jsend.fail(form.errors)
         response.status_code = 200
-        current_app.logger.debug('Returning fail; response.data=[%s]' % response.data)
+        log.debug('Returning fail', errors=form.errors)
         return response
 
 
@@ -294,35 +368,26 @@ def password_reset():
         if user:
             user.activation_key = str(uuid4())
             db.session.add(user)
-            db.session.commit()
 
-            # Send reset password email.
-            css = get_resource_as_string('static/css/email.css')
+            # Queue reset password email.
             change_password_url = '%s/#accounts/password/reset/confirm/%s/%s/' % (current_app.config['DOMAIN'], quote(user.email), quote(user.activation_key))
-            html = render_template('user/emails/reset_password.html', css=css, username=user.username, email_recipient=user.email, change_password_url=change_password_url)
-            current_app.logger.debug('change_password_url=[%s]' % change_password_url)
-            p = Premailer(html)
-            result_html = p.transform()
-            message = Message(subject='Recover your password', html=result_html, recipients=[user.email])
-            try:
-                mail.send(message)
-            except SMTPDataError as e:
-                current_app.logger.debug('Returning fail = [%s].' % e)
-                response = jsonify(status='fail', data={'email': "Couldn't send email to %s." % form.email.data})
-                response.status_code = 200
-                return response
+            html = email_renderer.render('user/emails/reset_password.html', username=user.username, email_recipient=user.email, change_password_url=change_password_url)
+            log.debug('Queued password reset email', change_password_url=change_password_url)
+            message = Message(subject='Recover your password', html=html, recipients=[user.email])
+            enqueue(message)
+            db.session.commit()
 
-            current_app.logger.debug('Returning success.')
-            response = jsonify(status='success')
+            log.debug('Returning success')
+            response = jsend.success()
             response.status_code = 200
             return response
         else:
-            current_app.logger.debug('Returning fail = [Sorry, no user found for that email address.].')
-            response = jsonify(status='fail', data={'email': 'Sorry, no user found for that email address.'})
+            log.debug('Returning fail; no user found', email=form.email.data)
+            response = jsend.fail({'email': 'Sorry, no user found for that email address.'})
             response.status_code = 200
             return response
     else:
-        current_app.logger.debug('Returning fail = [%s].' % form.errors)
-        response = jsonify(status='fail', data=form.errors)
+        log.debug('Returning fail', errors=form.errors)
+        response = jsend.fail(form.errors)
         response.status_code = 200
         return response
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+"""
+Performance benchmarks. Run each one from the repository root, e.g.
+
+    $ python -m benchmarks.login_lookup --help
+"""
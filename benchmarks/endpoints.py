@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+Endpoint benchmark suite.
+
+Times every route through the test client of create_app(TestConfig), on a
+throwaway SQLite database of seeded users, and reports p50/p95/p99
+latencies, ops/s and allocations per request:
+
+    $ python -m benchmarks.endpoints --iterations 100 --route 'user GET'
+
+`manage.py bench` runs it too, and saves results as a JSON baseline
+(--save) or, only when asked to (--compare), fails when a route regressed
+from the baseline. Latencies depend on the host, so a baseline records how
+long a fixed CPU-bound workload took on its host (its calibration), and
+they're scaled by how much slower or faster that workload runs here before
+they're compared. That evens out CPU speed, not everything else (disks,
+other load): a gate on a CI runner is best compared to a baseline saved on
+the same kind of runner.
+
+Each request is prepared (users picked, logged in, given activation keys)
+outside of its timing. Allocations are measured in a separate pass, with
+the garbage collector disabled: gc_objects is the number of objects
+allocated by a request that are still tracked once it's done (retained,
+or garbage left to the cycle collector), and allocated_bytes the peak of
+memory allocated during it when tracemalloc is available (Python 3, or
+pytracemalloc).
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from app import create_app
+from app.extensions import db, hasher
+from app.user.models import User
+from app.user.constants import ADMIN, USER, ACTIVE
+from app.user.seed import SEED_PASSWORD, seed_users
+from config import TestConfig
+
+ENVIRON_BASE = {
+    'HTTP_USER_AGENT': 'Benchmark',
+    'REMOTE_ADDR': '127.0.0.1',
+    'HTTP_ORIGIN': 'http://localhost:9000',
+}
+
+ACTIVATION_KEY = 'benchmark-activation-key'
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# Latency and allocation figures compared to the baseline.
+COMPARED = ('p50', 'p95', 'gc_objects', 'allocated_bytes')
+
+users = User.__table__
+
+# (name, prepare) in run order; prepare(context, i) returns the client,
+# method, path and keyword arguments of the i-th request to time.
+ROUTES = []
+
+
+def route(name):
+    def decorate(prepare):
+        ROUTES.append((name, prepare))
+        return prepare
+    return decorate
+
+
+def as_json(data):
+    return {'data': json.dumps(data), 'content_type': 'application/json'}
+
+
+class Context(object):
+    """The app, its clients and the seeded users requests are made for."""
+
+    def __init__(self, app, accounts):
+        self.app = app
+        self.engine = db.get_engine(app)
+        self._accounts = iter(accounts)
+        self.admin = self.login(self.next_user(role_id=ADMIN)[1])
+        self.member_id, self.member_email = self.next_user()
+        self.member_username = self.engine.execute(
+            users.select().where(users.c.id == self.member_id)).first().username
+        self.member = self.login(self.member_email)
+
+    def client(self):
+        return self.app.test_client()
+
+    def next_user(self, **values):
+        """Return the id and email of an unused active user."""
+        id, email = next(self._accounts)
+        if values:
+            self.engine.execute(users.update().where(users.c.id == id)
+                                .values(**values))
+        return id, email
+
+    def login(self, email):
+        client = self.client()
+        rv = client.post('/session/', data={'email': email,
+                                            'password': SEED_PASSWORD},
+                         environ_base=ENVIRON_BASE)
+        assert '"status":"success"' in rv.data, rv.data
+        return client
+
+
+@route('session POST')
+def session_post(context, i):
+    id, email = context.next_user()
+    return context.client(), 'POST', '/session/', {
+        'data': {'email': email, 'password': SEED_PASSWORD}}
+
+
+@route('session GET')
+def session_get(context, i):
+    return context.member, 'GET', '/session/', {}
+
+
+@route('session PUT')
+def session_put(context, i):
+    id, email = context.next_user()
+    return context.login(email), 'PUT', '/session/', {
+        'data': {'email': email, 'password': SEED_PASSWORD}}
+
+
+@route('session DELETE')
+def session_delete(context, i):
+    id, email = context.next_user()
+    return context.login(email), 'DELETE', '/session/', {}
+
+
+@route('users GET')
+def users_get(context, i):
+    return context.admin, 'GET', '/users/', {}
+
+
+@route('user GET')
+def user_get(context, i):
+    return context.member, 'GET', '/users/%d/' % context.member_id, {}
+
+
+@route('users POST')
+def users_post(context, i):
+    return context.client(), 'POST', '/users/', as_json({
+        'username': 'bench%d' % i, 'email': 'bench%d@example.com' % i,
+        'password': 'benchmark', 'password_again': 'benchmark'})
+
+
+@route('user PUT')
+def user_put(context, i):
+    return context.member, 'PUT', '/users/%d/' % context.member_id, as_json({
+        'username': context.member_username, 'email': context.member_email,
+        'first_name': 'Bench', 'last_name': 'Mark%d' % i,
+        'gender': 'female', 'bio': 'Benchmarked %d times.' % i,
+        'url': 'http://www.example.com/bench'})
+
+
+@route('user DELETE')
+def user_delete(context, i):
+    id, email = context.next_user()
+    return context.login(email), 'DELETE', '/users/%d/' % id, {}
+
+
+@route('password reset POST')
+def password_reset(context, i):
+    id, email = context.next_user()
+    return context.client(), 'POST', '/users/password/reset/', as_json({
+        'email': email})
+
+
+@route('password PUT')
+def password_put(context, i):
+    id, email = context.next_user(activation_key=ACTIVATION_KEY)
+    return context.client(), 'PUT', \
+        '/users/password/%s/%s/' % (email, ACTIVATION_KEY), as_json({
+            'password': 'benchmark', 'password_again': 'benchmark'})
+
+
+@route('activate PUT')
+def activate_put(context, i):
+    id, email = context.next_user(activation_key=ACTIVATION_KEY)
+    return context.client(), 'PUT', \
+        '/users/activate/%s/%s/' % (email, ACTIVATION_KEY), as_json({
+            'status': 'active'})
+
+
+@route('contact POST')
+def contact(context, i):
+    return context.client(), 'POST', '/mail/', as_json({
+        'full_name': 'Bench Mark', 'email': 'bench@example.com',
+        'subject': 'Benchmark %d' % i, 'message': 'Timing the contact form.'})
+
+
+@route('sitemap GET')
+def sitemap(context, i):
+    return context.client(), 'GET', '/sitemap.xml', {}
+
+
+@route('robots.txt GET')
+def robots(context, i):
+    return context.client(), 'GET', '/robots.txt', {}
+
+
+def request(name, args):
+    client, method, path, kwargs = args
+    rv = client.open(path, method=method, environ_base=ENVIRON_BASE,
+                     **kwargs)
+    if rv.status_code != 200 or '"status":"fail"' in rv.data or \
+            '"status":"error"' in rv.data:
+        raise AssertionError('%s: %s %s' % (name, rv.status, rv.data[:200]))
+
+
+def time_route(context, name, prepare, iterations, warmup):
+    for i in xrange(warmup):
+        request(name, prepare(context, i))
+    timings = []
+    for i in xrange(warmup, warmup + iterations):
+        args = prepare(context, i)
+        started = time.time()
+        request(name, args)
+        timings.append(time.time() - started)
+    timings.sort()
+    return timings
+
+
+def measure_allocations(context, name, prepare, start, samples):
+    """Return the median gc_objects and allocated_bytes of a route."""
+    objects, allocated = [], []
+    enabled = gc.isenabled()
+    for i in xrange(start, start + samples):
+        args = prepare(context, i)
+        gc.collect()
+        gc.disable()
+        try:
+            if tracemalloc is not None:
+                tracemalloc.start()
+            request(name, args)
+            objects.append(gc.get_count()[0])
+            if tracemalloc is not None:
+                allocated.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+        finally:
+            if enabled:
+                gc.enable()
+    return median(objects), median(allocated) if allocated else None
+
+
+def calibrate(samples=5):
+    """
+    Return the best time of a fixed, CPU-bound workload in pure Python,
+    like the app's: this host's speed, in seconds.
+    """
+    rows = [{'id': i, 'username': u'user%d' % i, 'bio': u'Bio %d.' % i * 10}
+            for i in xrange(2000)]
+    best = None
+    for i in xrange(samples):
+        started = time.time()
+        for j in xrange(5):
+            json.loads(json.dumps(rows))
+            sorted(rows, key=lambda row: row['username'])
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def percentile(timings, p):
+    return timings[min(len(timings) - 1, int(len(timings) * p / 100.0))]
+
+
+def make_app(path, accounts):
+    app = create_app(TestConfig)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    with app.test_request_context():
+        db.create_all()
+    engine = db.get_engine(app)
+    seed_users(engine, hasher.context, accounts)
+    # All active users, except for the admin.
+    engine.execute(users.update().values(status_id=ACTIVE, role_id=USER))
+    return app
+
+
+def run(iterations=100, warmup=10, samples=5, names=None, report=None):
+    """Benchmark the routes (all or those named); return their results."""
+    selected = [(name, prepare) for name, prepare in ROUTES
+                if names is None or name in names]
+    per_route = warmup + iterations + samples
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        app = make_app(path, per_route * len(selected) + 2)
+        accounts = db.get_engine(app).execute(
+            users.select().order_by(users.c.id)).fetchall()
+        context = Context(app, [(row.id, row.email) for row in accounts])
+        results = {}
+        for name, prepare in selected:
+            timings = time_route(context, name, prepare, iterations, warmup)
+            gc_objects, allocated_bytes = measure_allocations(
+                context, name, prepare, warmup + iterations, samples)
+            results[name] = {
+                'p50': percentile(timings, 50),
+                'p95': percentile(timings, 95),
+                'p99': percentile(timings, 99),
+                'ops_per_sec': len(timings) / sum(timings),
+                'gc_objects': gc_objects,
+                'allocated_bytes': allocated_bytes,
+            }
+            if report is not None:
+                report(name, results[name])
+        return results
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+def format_result(name, result):
+    allocated = result['allocated_bytes']
+    return '%-20s p50=%8.3fms p95=%8.3fms p99=%8.3fms %8.1f ops/s ' \
+        '%6d objects %s' % (
+            name, result['p50'] * 1000, result['p95'] * 1000,
+            result['p99'] * 1000, result['ops_per_sec'],
+            result['gc_objects'],
+            '%8d bytes' % allocated if allocated is not None else '')
+
+
+# Figures in seconds, scaled by the hosts' speed.
+TIMINGS = ('p50', 'p95')
+
+
+def save(path, results, iterations, calibration):
+    with open(path, 'w') as f:
+        json.dump({'python': platform.python_version(),
+                   'iterations': iterations,
+                   'calibration': calibration,
+                   'routes': results}, f, indent=2, sort_keys=True)
+
+
+def compare(baseline, results, threshold, calibration):
+    """
+    Return (route, figure, baseline, result) for each figure of a route
+    that's more than threshold (a fraction) above its baseline, whose
+    timings are first scaled from the baseline's calibration to this
+    host's.
+    """
+    scale = calibration / baseline['calibration']
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline['routes'].get(name)
+        if base is None:
+            continue
+        for figure in COMPARED:
+            if base.get(figure) is None or result.get(figure) is None:
+                continue
+            expected = base[figure] * scale if figure in TIMINGS \
+                else base[figure]
+            # Allow a few objects of noise when there are none to begin with.
+            limit = expected * (1 + threshold)
+            if figure == 'gc_objects':
+                limit += 10
+            # Or half a millisecond of scheduler jitter.
+            elif figure in TIMINGS:
+                limit += 0.0005
+            if result[figure] > limit:
+                regressions.append((name, figure, expected, result[figure]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--route', action='append', dest='routes',
+                        help='route to run (default: all), e.g. "user GET"')
+    args = parser.parse_args()
+
+    print '%d iterations per route' % args.iterations
+    run(args.iterations, names=args.routes,
+        report=lambda name, result: sys.stdout.write(
+            format_result(name, result) + '\n'))
+
+
+if __name__ == '__main__':
+    main()
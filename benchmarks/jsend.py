@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+JSend response benchmark.
+
+Times building a response and reading its body with Flask's jsonify
+against the jsend factory, with each available encoder, for a bare
+success, a session and a page of users:
+
+    $ python -m benchmarks.jsend --iterations 20000
+"""
+
+import argparse
+import time
+
+from flask import jsonify
+
+from app import create_app
+from app.extensions import jsend
+from app.jsend import ENCODERS
+from config import TestConfig
+
+SESSION = {'auth': True, 'id': 42, 'username': 'demo',
+           'email': 'demo@example.com', 'status': 'active'}
+USERS = {'users': [{'id': i, 'username': 'user%d' % i,
+                    'email': 'user%d@example.com' % i, 'status': 'active',
+                    'created_time': '2013-01-17T10:20:30'}
+                   for i in range(50)],
+         'next': 'http://localhost/users/?limit=50&after=50'}
+
+PAYLOADS = (('success', None), ('session', SESSION), ('users page', USERS))
+
+
+def run(build, iterations):
+    started = time.time()
+    for i in xrange(iterations):
+        ''.join(build().response)
+    return (time.time() - started) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    app = create_app(TestConfig)
+    with app.test_request_context():
+        for name, data in PAYLOADS:
+            print
+            print '%s, %d iterations' % (name, args.iterations)
+            if data is None:
+                candidates = [('jsonify', lambda: jsonify(status='success'))]
+            else:
+                candidates = [('jsonify', lambda: jsonify(status='success',
+                                                          data=data))]
+            for encoder, encode in ENCODERS:
+                def build(encode=encode):
+                    jsend.encode = encode
+                    return jsend.success(data)
+                candidates.append(('jsend/%s' % encoder, build))
+
+            baseline = None
+            for label, build in candidates:
+                build()  # Warm up.
+                elapsed = run(build, args.iterations)
+                baseline = baseline or elapsed
+                size = len(''.join(build().response))
+                print '%-16s %8.2fus  %5.1fx  %6d bytes' % (
+                    label, elapsed * 1e6, baseline / elapsed, size)
+
+
+if __name__ == '__main__':
+    main()
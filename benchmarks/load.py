@@ -0,0 +1,600 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent load generator.
+
+Starts the app on a local threaded server, in its own process, with an
+SMTP stand-in for its outbox workers to deliver to, and runs scripted
+user journeys from many concurrent clients against it:
+
+    $ python -m benchmarks.load --clients 50 --duration 60
+    $ python -m benchmarks.load --clients 50 --hash-workers 2 --pool-size 5
+    $ python -m benchmarks.load --url http://localhost:5000 --clients 20
+
+Each journey registers a user, logs in, polls the session (revalidating
+its ETag), updates the profile and logs out; --reset-ratio of them then
+request a password reset, whose email goes through the outbox to the SMTP
+stand-in (which takes --smtp-delay seconds per message). Every --interval
+seconds the throughput, errors and latencies of each route over the
+interval are printed; at the end, their totals, the server's pool and
+hashing stats and the emails delivered.
+
+Latencies are recorded in log-linear histograms, like HdrHistogram's, so
+percentiles are within 1% whatever the range. --hgrm writes each route's
+percentile distribution in HdrHistogram's .hgrm format, and --json the
+intervals and totals.
+
+With --url no server is started: the journeys run against it, and it
+delivers emails wherever it's configured to.
+"""
+
+import argparse
+import asyncore
+import httplib
+import json
+import logging
+import math
+import os
+import random
+import smtpd
+import socket
+import sys
+import tempfile
+import threading
+import time
+from Cookie import SimpleCookie
+from itertools import count
+from multiprocessing import Event, Process, Queue
+from urllib import urlencode
+from urlparse import urlparse
+
+from werkzeug.serving import make_server
+
+from app import create_app
+from app.extensions import db, hasher, mail
+from app.outbox.worker import OutboxWorker
+from config import TestConfig
+
+ORIGIN = 'http://localhost:9000'
+PASSWORD = 'loadtest'
+
+# Buckets are 1/SUB_BUCKETS wide relative to their values.
+SUB_BUCKET_BITS = 7
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+# Percentiles reported per interval and in the totals.
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def _bucket(value):
+    """Return the lowest value of value's bucket."""
+    if value < SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return value >> shift << shift
+
+
+def _highest_equivalent(bucket):
+    """Return the highest value of a bucket."""
+    if bucket < SUB_BUCKETS:
+        return bucket
+    return bucket + (1 << (bucket.bit_length() - SUB_BUCKET_BITS)) - 1
+
+
+class Histogram(object):
+    """A log-linear histogram of latencies, in microseconds."""
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds):
+        value = int(seconds * 1e6)
+        bucket = _bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        for bucket, n in other.counts.iteritems():
+            self.counts[bucket] = self.counts.get(bucket, 0) + n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return float(self.total) / self.count if self.count else None
+
+    def percentile(self, p):
+        """Return the highest value at the pth percentile, or None."""
+        return self.percentiles([p])[0]
+
+    def percentiles(self, ps):
+        if not self.count:
+            return [None] * len(ps)
+        targets = [max(1, int(math.ceil(self.count * p / 100.0))) for p in ps]
+        results = []
+        seen = 0
+        buckets = iter(sorted(self.counts))
+        bucket = None
+        for target in targets:
+            while seen < target:
+                bucket = next(buckets)
+                seen += self.counts[bucket]
+            results.append(min(_highest_equivalent(bucket), self.max))
+        return results
+
+    def distribution(self, ticks_per_half=5):
+        """
+        Yield (value, percentile, count up to it) at ticks_per_half
+        percentiles per halving of the distance to 100, as HdrHistogram
+        reports them.
+        """
+        if not self.count:
+            return
+        seen = 0
+        buckets = sorted(self.counts)
+        p = 0.0
+        for bucket in buckets:
+            seen += self.counts[bucket]
+            value = min(_highest_equivalent(bucket), self.max)
+            if seen == self.count:
+                # The ticks get ever closer to 100: end on the max instead.
+                break
+            reached = 100.0 * seen / self.count
+            while p <= reached:
+                yield value, p, seen
+                half = 2 ** (int(math.log(100.0 / (100 - p), 2)) + 1)
+                p += 100.0 / (half * ticks_per_half)
+        yield self.max, 100.0, self.count
+
+    def hgrm(self):
+        """Return the percentile distribution in milliseconds, as .hgrm."""
+        lines = ['%12s %14s %10s %14s' % ('Value', 'Percentile', 'TotalCount',
+                                         '1/(1-Percentile)'), '']
+        for value, p, seen in self.distribution():
+            inverse = '%14.2f' % (1 / (1 - p / 100)) if p < 100 else \
+                '%14s' % 'inf'
+            lines.append('%12.3f %2.12f %10d %s' % (value / 1000.0, p / 100,
+                                                    seen, inverse))
+        lines.append('#[Mean    = %12.3f, StdDeviation   = %12s]' % (
+            self.mean / 1000.0, 'n/a'))
+        lines.append('#[Max     = %12.3f, Total count    = %12d]' % (
+            self.max / 1000.0, self.count))
+        lines.append('#[Buckets = %12d, SubBuckets     = %12d]' % (
+            len(self.counts), SUB_BUCKETS))
+        return '\n'.join(lines) + '\n'
+
+    def as_dict(self):
+        result = {'count': self.count, 'max_ms': self.max / 1000.0,
+                  'mean_ms': self.mean / 1000.0 if self.count else None}
+        for p, value in zip(PERCENTILES, self.percentiles(PERCENTILES)):
+            result['p%s_ms' % p] = value / 1000.0 if value is not None \
+                else None
+        return result
+
+
+class RouteStats(object):
+    """The latencies and errors of a route, over an interval or a run."""
+
+    def __init__(self):
+        self.histogram = Histogram()
+        self.errors = 0
+
+    def merge(self, other):
+        self.histogram.merge(other.histogram)
+        self.errors += other.errors
+
+    def as_dict(self, seconds):
+        result = self.histogram.as_dict()
+        result['errors'] = self.errors
+        result['per_sec'] = self.histogram.count / seconds if seconds else None
+        result['error_rate'] = float(self.errors) / self.histogram.count \
+            if self.histogram.count else None
+        return result
+
+
+class Recorder(object):
+    """Per route stats of the current interval, shared by the clients."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = self.interval_started = time.time()
+        self.interval = {}
+        self.totals = {}
+        # The first errors of each kind, (route, message) -> count.
+        self.error_messages = {}
+
+    def record(self, route, seconds, error=None):
+        with self._lock:
+            stats = self.interval.get(route)
+            if stats is None:
+                stats = self.interval[route] = RouteStats()
+            stats.histogram.record(seconds)
+            if error is not None:
+                stats.errors += 1
+                key = (route, error[:100])
+                if key in self.error_messages or \
+                        len(self.error_messages) < 20:
+                    self.error_messages[key] = \
+                        self.error_messages.get(key, 0) + 1
+
+    def next_interval(self):
+        """Return the interval's stats and its length, and start another."""
+        with self._lock:
+            interval, self.interval = self.interval, {}
+            now = time.time()
+            seconds, self.interval_started = now - self.interval_started, now
+        for route, stats in interval.iteritems():
+            self.totals.setdefault(route, RouteStats()).merge(stats)
+        return interval, seconds
+
+
+class SMTPSink(smtpd.SMTPServer):
+    """An SMTP server counting the messages it gets, stalling delay each."""
+
+    def __init__(self, delay=0.0):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.delay = delay
+        self.messages = 0
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if self.delay:
+            time.sleep(self.delay)
+        self.messages += 1
+
+    def start(self):
+        thread = threading.Thread(target=asyncore.loop,
+                                  kwargs={'timeout': 0.1, 'map': self._map})
+        thread.daemon = True
+        thread.start()
+
+
+def make_app(path, smtp_port, options):
+    app = create_app(TestConfig)
+    app.logger.setLevel(logging.WARNING)
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI='sqlite:///' + path,
+        SQLALCHEMY_POOL_SIZE=options.pool_size,
+        SQLALCHEMY_MAX_OVERFLOW=options.max_overflow,
+        MAIL_SERVER='127.0.0.1',
+        MAIL_PORT=smtp_port,
+        MAIL_USE_TLS=False,
+        MAIL_DEBUG=False,
+        MAIL_SUPPRESS_SEND=False,
+        PASSWORD_HASH_WORKERS=options.hash_workers,
+        OUTBOX_POLL_INTERVAL=1,
+    )
+    # Both read their settings on init.
+    mail.init_app(app)
+    hasher.init_app(app)
+    with app.test_request_context():
+        db.create_all()
+    return app
+
+
+def serve(path, port, smtp_port, options, ready, stop, results):
+    """Run the app on port until stop is set; put its stats in results."""
+    # Server errors, without the access log.
+    logging.basicConfig(level=logging.WARNING)
+    app = make_app(path, smtp_port, options)
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    workers = [OutboxWorker(app) for i in range(options.outbox_workers)]
+    for worker in workers:
+        worker.start()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    ready.set()
+    stop.wait()
+    server.shutdown()
+    for worker in workers:
+        worker.stop()
+    results.put({'pools': db.pool_stats(app),
+                 'hashing': hasher.stats.as_dict()})
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class JourneyError(Exception):
+    pass
+
+
+class VirtualUser(threading.Thread):
+    """A client running journeys until the deadline."""
+
+    def __init__(self, url, recorder, options, deadline, next_username,
+                 seed):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        parsed = urlparse(url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+        self.recorder = recorder
+        self.options = options
+        self.deadline = deadline
+        self.next_username = next_username
+        self.rng = random.Random(seed)
+        self.cookies = {}
+
+    def run(self):
+        while time.time() < self.deadline:
+            started = time.time()
+            try:
+                self.journey()
+            except JourneyError as e:
+                self.recorder.record('journey', time.time() - started, str(e))
+            else:
+                self.recorder.record('journey', time.time() - started)
+
+    def journey(self):
+        self.cookies = {}
+        username = self.next_username()
+        email = '%s@example.com' % username
+        body = self.request('users POST', 'POST', '/users/', json_data={
+            'username': username, 'email': email,
+            'password': PASSWORD, 'password_again': PASSWORD})[2]
+        id = json.loads(body)['data']['id']
+        self.think()
+        self.request('session POST', 'POST', '/session/',
+                     form={'email': email, 'password': PASSWORD})
+        etag = None
+        for i in range(self.options.polls):
+            self.think()
+            status, headers, body = self.request('session GET', 'GET',
+                                                 '/session/', etag=etag)
+            etag = headers.get('etag', etag)
+        self.think()
+        self.request('user PUT', 'PUT', '/users/%d/' % id, json_data={
+            'username': username, 'email': email,
+            'first_name': 'Load', 'last_name': 'Test',
+            'gender': self.rng.choice(['female', 'male']),
+            'bio': 'Journey of %s.' % username,
+            'url': 'http://www.example.com/%s' % username})
+        self.think()
+        self.request('session DELETE', 'DELETE', '/session/')
+        if self.rng.random() < self.options.reset_ratio:
+            self.cookies = {}
+            self.think()
+            self.request('password reset POST', 'POST',
+                         '/users/password/reset/', json_data={'email': email})
+
+    def think(self):
+        if self.options.think:
+            time.sleep(self.rng.expovariate(1.0 / self.options.think))
+
+    def request(self, route, method, path, form=None, json_data=None,
+                etag=None):
+        """Make a request; return its status, headers and body."""
+        headers = {'Origin': ORIGIN, 'User-Agent': 'Load generator'}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        elif json_data is not None:
+            body = json.dumps(json_data)
+            headers['Content-Type'] = 'application/json'
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if self.cookies:
+            headers['Cookie'] = '; '.join('%s=%s' % item
+                                          for item in self.cookies.items())
+
+        started = time.time()
+        error = None
+        try:
+            connection = httplib.HTTPConnection(
+                self.host, self.port, timeout=self.options.timeout)
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+            finally:
+                connection.close()
+        except (socket.error, httplib.HTTPException) as e:
+            error = '%s: %s' % (e.__class__.__name__, e)
+        else:
+            expected = (200, 304) if etag is not None else (200,)
+            if response.status not in expected:
+                error = response.reason
+            elif '"status":"fail"' in data or '"status":"error"' in data:
+                error = data
+        self.recorder.record(route, time.time() - started, error)
+        if error is not None:
+            raise JourneyError('%s: %s' % (route, error))
+
+        response_headers = dict(response.getheaders())
+        for header in response.msg.getheaders('set-cookie'):
+            for name, morsel in SimpleCookie(header).items():
+                if morsel.value:
+                    self.cookies[name] = morsel.value
+                else:
+                    self.cookies.pop(name, None)
+        return response.status, response_headers, data
+
+
+def format_interval(elapsed, seconds, route, stats):
+    p50, p99 = stats.histogram.percentiles((50, 99))
+    return '[%5.0fs] %-20s %6d req %8.1f/s %5d err  p50 %8.1fms  ' \
+        'p99 %8.1fms  max %8.1fms' % (
+            elapsed, route, stats.histogram.count,
+            stats.histogram.count / seconds, stats.errors,
+            p50 / 1000.0, p99 / 1000.0, stats.histogram.max / 1000.0)
+
+
+def format_totals(totals, seconds):
+    lines = ['%-20s %8s %8s %7s %9s %9s %9s %9s %9s' % (
+        'route', 'requests', 'req/s', 'errors', 'p50 ms', 'p90 ms', 'p99 ms',
+        'p99.9 ms', 'max ms')]
+    for route in sorted(totals):
+        stats = totals[route].as_dict(seconds)
+        lines.append('%-20s %8d %8.1f %6.2f%% %9.1f %9.1f %9.1f %9.1f %9.1f'
+                     % (route, stats['count'], stats['per_sec'],
+                        stats['error_rate'] * 100, stats['p50_ms'],
+                        stats['p90_ms'], stats['p99_ms'], stats['p99.9_ms'],
+                        stats['max_ms']))
+    return '\n'.join(lines)
+
+
+def run(url, options, out=sys.stdout):
+    """Run the clients against url; return the recorder and intervals."""
+    recorder = Recorder()
+    deadline = time.time() + options.duration
+    # Unique across runs against the same server.
+    run_id = int(time.time()) & 0xffffff
+    counter = count()
+
+    def next_username():
+        return 'l%06xu%d' % (run_id, next(counter))
+
+    clients = []
+    for i in range(options.clients):
+        client = VirtualUser(url, recorder, options, deadline, next_username,
+                             seed=i)
+        clients.append(client)
+        client.start()
+        # Ramp up, rather than a thundering herd of registrations.
+        if options.ramp:
+            time.sleep(float(options.ramp) / options.clients)
+
+    intervals = []
+    while any(client.is_alive() for client in clients):
+        # Until the interval is over, or the last journeys are.
+        while time.time() < recorder.interval_started + options.interval \
+                and any(client.is_alive() for client in clients):
+            time.sleep(0.1)
+        interval, seconds = recorder.next_interval()
+        elapsed = time.time() - recorder.started
+        intervals.append({'elapsed': elapsed, 'routes': dict(
+            (route, stats.as_dict(seconds))
+            for route, stats in interval.iteritems())})
+        for route in sorted(interval):
+            out.write(format_interval(elapsed, seconds, route,
+                                      interval[route]) + '\n')
+        out.flush()
+    return recorder, intervals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--clients', type=int, default=20,
+                        help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds to run for')
+    parser.add_argument('--ramp', type=float, default=5,
+                        help='seconds over which clients start')
+    parser.add_argument('--interval', type=float, default=5,
+                        help='seconds between reports')
+    parser.add_argument('--polls', type=int, default=3,
+                        help='session polls per journey')
+    parser.add_argument('--think', type=float, default=0,
+                        help='mean seconds between requests of a client')
+    parser.add_argument('--reset-ratio', type=float, default=0.25,
+                        help='fraction of journeys requesting a password reset')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='seconds before a request fails')
+    parser.add_argument('--url', help='server to load (default: start one)')
+    parser.add_argument('--pool-size', type=int, default=None,
+                        help='SQLALCHEMY_POOL_SIZE of the local server')
+    parser.add_argument('--max-overflow', type=int, default=None,
+                        help='SQLALCHEMY_MAX_OVERFLOW of the local server')
+    parser.add_argument('--hash-workers', type=int, default=0,
+                        help='PASSWORD_HASH_WORKERS of the local server')
+    parser.add_argument('--outbox-workers', type=int, default=1,
+                        help='outbox workers of the local server')
+    parser.add_argument('--smtp-delay', type=float, default=0,
+                        help='seconds the SMTP stand-in takes per message')
+    parser.add_argument('--json', help='write the intervals and totals here')
+    parser.add_argument('--hgrm', help='write .hgrm files to this directory')
+    options = parser.parse_args()
+
+    sink = server = path = None
+    url = options.url
+    if url is None:
+        sink = SMTPSink(options.smtp_delay)
+        sink.start()
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        port = free_port()
+        ready, stop, results = Event(), Event(), Queue()
+        server = Process(target=serve, args=(path, port, sink.port, options,
+                                             ready, stop, results))
+        server.start()
+        if not ready.wait(30):
+            server.terminate()
+            sys.exit('The server did not start.')
+        url = 'http://127.0.0.1:%d' % port
+
+    print '%d clients for %ds against %s' % (options.clients, options.duration,
+                                             url)
+    try:
+        recorder, intervals = run(url, options)
+        server_stats = None
+        if server is not None:
+            stop.set()
+            server_stats = results.get(timeout=30)
+    finally:
+        if server is not None:
+            stop.set()
+            server.join(5)
+            if server.is_alive():
+                server.terminate()
+        if path is not None:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    seconds = time.time() - recorder.started
+    print
+    print 'Totals over %.1fs' % seconds
+    print format_totals(recorder.totals, seconds)
+    if recorder.error_messages:
+        print
+        print 'Errors'
+        for (route, message), n in sorted(recorder.error_messages.items()):
+            print '%6d %s: %s' % (n, route, message)
+    if server_stats is not None:
+        print
+        for bind, stats in sorted(server_stats['pools'].items()):
+            print 'Pool %s: %d checkouts, %.1fms mean / %.1fms max wait, ' \
+                '%d timeouts, %d max in use, %d max overflow' % (
+                    bind or 'default', stats['checkouts'],
+                    (stats['mean_checkout_seconds'] or 0) * 1000,
+                    stats['max_checkout_seconds'] * 1000, stats['timeouts'],
+                    stats['max_in_use'], stats['max_overflow'])
+        hashing = server_stats['hashing']
+        print 'Hashing: %d hashes, %.1fms mean / %.1fms max queue wait, ' \
+            '%d rejected' % (
+                hashing['count'],
+                hashing['queue_wait'] * 1000 / (hashing['count'] or 1),
+                hashing['queue_wait_max'] * 1000, hashing['rejected'])
+    if sink is not None:
+        print 'SMTP stand-in: %d emails delivered' % sink.messages
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump({'seconds': seconds, 'intervals': intervals,
+                       'totals': dict((route, stats.as_dict(seconds))
+                                      for route, stats in
+                                      recorder.totals.iteritems()),
+                       'server': server_stats}, f, indent=2, sort_keys=True)
+    if options.hgrm:
+        if not os.path.isdir(options.hgrm):
+            os.makedirs(options.hgrm)
+        for route, stats in recorder.totals.iteritems():
+            name = route.replace(' ', '_').replace('.', '') + '.hgrm'
+            with open(os.path.join(options.hgrm, name), 'w') as f:
+                f.write(stats.histogram.hgrm())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Login lookup benchmark.
+
+Times the lookup User.authenticate does (one branch, on the normalized
+email or username index) against the former
+``username = :login OR email = :login`` lookup, on a table of N users:
+
+    $ python -m benchmarks.login_lookup --users 1000000
+    $ python -m benchmarks.login_lookup --users 1000000 \\
+        --database postgresql://localhost/bluebone_bench
+
+The users tables are dropped and recreated (unless --reuse is given), so
+don't point it at a database you care about.
+"""
+
+import argparse
+import random
+import time
+
+from passlib.hash import sha256_crypt
+from sqlalchemy import create_engine, or_, select
+
+from app.extensions import db
+from app.user.models import User, UserDetail, lookup_key
+from app.user.constants import USER, ACTIVE
+
+users = User.__table__
+
+
+def populate(engine, count, batch_size=10000):
+    tables = [UserDetail.__table__, users]
+    db.metadata.drop_all(engine, tables=tables)
+    db.metadata.create_all(engine, tables=tables)
+    password = sha256_crypt.encrypt('default', rounds=1000)
+    connection = engine.connect()
+    for start in xrange(0, count, batch_size):
+        transaction = connection.begin()
+        connection.execute(users.insert(), [
+            {'id': i + 1,
+             'username': 'User%d' % i, 'username_key': 'user%d' % i,
+             'email': 'User%d@Example.com' % i,
+             'email_key': 'user%d@example.com' % i,
+             'password': password, 'role_id': USER, 'status_id': ACTIVE}
+            for i in xrange(start, min(count, start + batch_size))])
+        transaction.commit()
+    connection.close()
+
+
+def or_lookup(login):
+    return select([users]) \
+        .where(or_(users.c.username == login, users.c.email == login)) \
+        .limit(1)
+
+
+def keyed_lookup(login):
+    key = lookup_key(login)
+    column = users.c.email_key if '@' in key else users.c.username_key
+    return select([users]).where(column == key).limit(1)
+
+
+def explain(connection, query):
+    compiled = query.compile(dialect=connection.dialect)
+    params = compiled.construct_params()
+    if connection.dialect.name == 'sqlite':
+        sql = 'EXPLAIN QUERY PLAN %s' % compiled
+    else:
+        sql = 'EXPLAIN %s' % compiled
+    if compiled.positional:
+        rows = connection.execute(sql, *[params[name] for name in
+                                         compiled.positiontup])
+    else:
+        rows = connection.execute(sql, params)
+    return [' '.join(str(column) for column in row) for row in rows]
+
+
+def percentile(timings, p):
+    return timings[min(len(timings) - 1, int(len(timings) * p / 100.0))]
+
+
+def run(connection, lookup, logins):
+    timings = []
+    for login in logins:
+        started = time.time()
+        connection.execute(lookup(login)).first()
+        timings.append(time.time() - started)
+    timings.sort()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--database', default='sqlite:////tmp/bluebone_bench.db')
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--lookups', type=int, default=2000)
+    parser.add_argument('--reuse', action='store_true',
+                        help="don't recreate and populate the users tables")
+    args = parser.parse_args()
+
+    engine = create_engine(args.database)
+    if not args.reuse:
+        started = time.time()
+        populate(engine, args.users)
+        print 'Populated %d users in %.1fs' % (args.users, time.time() - started)
+
+    sample = random.Random(0)
+    logins = []
+    for i in xrange(args.lookups):
+        n = sample.randrange(args.users)
+        logins.append('User%d' % n if i % 2 else 'User%d@Example.com' % n)
+
+    connection = engine.connect()
+    print '%s, %d users, %d lookups (half by email, half by username)' % (
+        engine.dialect.name, args.users, args.lookups)
+    for name, lookup in (('or', or_lookup), ('keyed', keyed_lookup)):
+        print
+        print '%s lookup plan:' % name
+        for login in (logins[0], logins[1]):
+            for line in explain(connection, lookup(login)):
+                print '    %s' % line
+        run(connection, lookup, logins[:100])  # Warm up.
+        timings = run(connection, lookup, logins)
+        print '%s lookup: p50=%.3fms p95=%.3fms p99=%.3fms max=%.3fms' % (
+            name, percentile(timings, 50) * 1000, percentile(timings, 95) * 1000,
+            percentile(timings, 99) * 1000, timings[-1] * 1000)
+    connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+CORS preflight benchmark.
+
+Times OPTIONS preflights to /session/ and /users/<id>/, from a logged in
+client, answered by the PreflightMiddleware against the same preflights
+dispatched through Flask (session, Flask-Login user loading, crossdomain):
+
+    $ python -m benchmarks.preflight --requests 5000
+
+The app runs on a throwaway SQLite database.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from werkzeug.test import EnvironBuilder
+
+from app import create_app
+from app.extensions import db
+from app.user.models import User
+from app.user.constants import USER, ACTIVE
+from config import TestConfig
+
+ORIGIN = 'http://localhost:9000'
+
+
+def make_app(path):
+    app = create_app(TestConfig)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    with app.test_request_context():
+        db.create_all()
+        db.session.add(User(username=u'bench', email='bench@example.com',
+                            password='benchmark', role_id=USER,
+                            status_id=ACTIVE))
+        db.session.commit()
+    return app
+
+
+def login(app):
+    """Return the session cookie of a logged in client."""
+    client = app.test_client()
+    rv = client.post('/session/', data={'email': 'bench@example.com',
+                                        'password': 'benchmark'},
+                     environ_base={'HTTP_ORIGIN': ORIGIN})
+    assert 'success' in rv.data, rv.data
+    return '; '.join('%s=%s' % (cookie.name, cookie.value)
+                     for cookie in client.cookie_jar)
+
+
+def percentile(timings, p):
+    return timings[min(len(timings) - 1, int(len(timings) * p / 100.0))]
+
+
+def run(wsgi_app, environ, count):
+    statuses = []
+
+    def start_response(status, headers, exc_info=None):
+        statuses.append(status)
+
+    timings = []
+    for i in xrange(count):
+        started = time.time()
+        body = wsgi_app(dict(environ), start_response)
+        for chunk in body:
+            pass
+        if hasattr(body, 'close'):
+            body.close()
+        timings.append(time.time() - started)
+    assert statuses[-1] == '200 OK', statuses[-1]
+    timings.sort()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        app = make_app(path)
+        cookie = login(app)
+        middleware = app.wsgi_app
+        for url in ('/session/', '/users/1/'):
+            environ = EnvironBuilder(url, method='OPTIONS', headers={
+                'Origin': ORIGIN,
+                'Cookie': cookie,
+                'Access-Control-Request-Method': 'GET',
+            }).get_environ()
+            print
+            print 'OPTIONS %s, %d requests' % (url, args.requests)
+            for name, wsgi_app in (('flask', middleware.wsgi_app),
+                                   ('middleware', middleware)):
+                run(wsgi_app, environ, 100)  # Warm up.
+                timings = run(wsgi_app, environ, args.requests)
+                print '%-10s p50=%.3fms p95=%.3fms p99=%.3fms ' \
+                    'total=%.2fs' % (
+                        name, percentile(timings, 50) * 1000,
+                        percentile(timings, 95) * 1000,
+                        percentile(timings, 99) * 1000, sum(timings))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,21 @@
 #!/usr/bin/env python
 
 import os
+import sys
+import json
 import datetime
+from multiprocessing import cpu_count
 
 from flaskext.script import Manager, Shell, Server, prompt_bool
 
-from app.extensions import db
+from app.extensions import db, hasher
 from app import create_app
 from config import DevConfig, ProdConfig
 from app.user import User, UserDetail, ADMIN, USER, ACTIVE
+from app.outbox import run_workers
+from app.passwords import calibrate as calibrate_rounds, measure
+from app.user.bulk import UserImporter, read_records
+from app.user.seed import SEED_PASSWORD, seed_users
 
 
 #env = os.environ.get('APP_ENV', 'prod')  # {dev, prod}
@@ -72,6 +79,112 @@ def initdb():
     db.session.commit()
 
 
+@manager.option('-w', '--workers', dest='workers', type=int, default=None,
+                help='number of worker threads (default: OUTBOX_WORKERS)')
+def outbox(workers=None):
+    """Run the transactional email outbox workers."""
+
+    run_workers(app, workers)
+
+
+@manager.option('-t', '--target', dest='target', type=float, default=None,
+                help='seconds to verify a password (default: PASSWORD_VERIFY_TIME)')
+def calibrate(target=None):
+    """Calibrate PASSWORD_ROUNDS for this host."""
+
+    scheme = app.config['PASSWORD_SCHEMES'][0]
+    target = target or app.config['PASSWORD_VERIFY_TIME']
+    rounds = calibrate_rounds(scheme, target)
+    print 'PASSWORD_ROUNDS = %d  # %s, %.3fs per verify' % (
+        rounds, scheme, measure(scheme, rounds))
+
+
+@manager.option('path', help='CSV or JSON lines file of users')
+@manager.option('-f', '--format', dest='format', choices=['csv', 'jsonl'],
+                default=None, help='input format (default: from the extension)')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=1000, help='users inserted per transaction')
+@manager.option('-w', '--workers', dest='workers', type=int, default=None,
+                help='password hashing processes (default: one per CPU)')
+@manager.option('--checkpoint', dest='checkpoint', default=None,
+                help='checkpoint file (default: PATH.checkpoint)')
+def import_users(path, format=None, batch_size=1000, workers=None,
+                 checkpoint=None):
+    """Bulk import users, resuming an interrupted import."""
+
+    if format is None:
+        format = 'csv' if path.endswith('.csv') else 'jsonl'
+    importer = UserImporter(
+        db.get_engine(app), hasher.context, batch_size=batch_size,
+        workers=cpu_count() if workers is None else workers,
+        checkpoint=checkpoint or path + '.checkpoint',
+        report=lambda stats: sys.stderr.write(stats.report() + '\n'))
+    with open(path, 'rb') as f:
+        stats = importer.run(read_records(f, format))
+    for number, error in importer.errors:
+        print 'Record %d: %s' % (number, error)
+    print stats.report()
+
+
+@manager.option('-n', '--count', dest='count', type=int, default=10000,
+                help='number of users')
+@manager.option('-s', '--seed', dest='seed', type=int, default=0,
+                help='random seed')
+@manager.option('--start', dest='start', type=int, default=0,
+                help='index of the first user, to add to a seeded database')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=5000, help='users inserted per transaction')
+def seed(count=10000, seed=0, start=0, batch_size=5000):
+    """Insert synthetic users for scale testing."""
+
+    stats = seed_users(
+        db.get_engine(app), hasher.context, count, seed=seed, start=start,
+        batch_size=batch_size,
+        report=lambda stats: sys.stderr.write(stats.report() + '\n'))
+    print stats.report()
+    print 'Seeded users log in with the password %r.' % SEED_PASSWORD
+
+
+@manager.option('-i', '--iterations', dest='iterations', type=int,
+                default=100, help='timed requests per route')
+@manager.option('-r', '--route', dest='routes', action='append', default=None,
+                help='route to run (default: all), e.g. "user GET"')
+@manager.option('--baseline', dest='baseline', default=None,
+                help='baseline JSON file (default: benchmarks/baseline.json)')
+@manager.option('--save', dest='save', action='store_true', default=False,
+                help='save the results as the baseline')
+@manager.option('--compare', dest='compare', action='store_true',
+                default=False, help='fail if a route regressed from the baseline')
+@manager.option('--threshold', dest='threshold', type=float, default=0.25,
+                help='regression allowed over the baseline, as a fraction')
+def bench(iterations=100, routes=None, baseline=None, save=False,
+          compare=False, threshold=0.25):
+    """Benchmark the endpoints, against a baseline."""
+
+    # Not loaded by the other commands, e.g. runserver.
+    from benchmarks import endpoints
+    if baseline is None:
+        baseline = endpoints.DEFAULT_BASELINE
+    calibration = endpoints.calibrate()
+    print 'Calibration: %.1fms' % (calibration * 1000)
+    print '%d iterations per route' % iterations
+    results = endpoints.run(iterations, names=routes,
+                            report=lambda name, result: sys.stdout.write(
+                                endpoints.format_result(name, result) + '\n'))
+    if save:
+        endpoints.save(baseline, results, iterations, calibration)
+        print 'Saved the baseline to %s.' % baseline
+    if compare:
+        with open(baseline) as f:
+            regressions = endpoints.compare(json.load(f), results, threshold,
+                                            calibration)
+        for name, figure, base, result in regressions:
+            print 'REGRESSION %s %s: %r -> %r' % (name, figure, base, result)
+        if regressions:
+            sys.exit(1)
+        print 'No regressions over %d%%.' % (threshold * 100)
+
+
 manager.add_option('-c', '--config',
                    dest="config",
                    required=False,
@@ -29,6 +29,7 @@ setup(
         'cssmin==0.1.4',
         'fabric==1.6.1',
         'premailer==1.13',
+        'blinker==1.5',
     ],
     classifiers=[
         'Environment :: Web Environment',
@@ -1,15 +1,47 @@
 # -*- coding: utf-8 -*-
 
 import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import gzip
+import zlib
+import time
+import logging
+from cStringIO import StringIO
+import threading
 import datetime
 
-from flask import current_app
+from flask import current_app, render_template
+from flask_mail import Message
+from sqlalchemy import event
+from passlib.hash import sha256_crypt, md5_crypt
+from premailer import Premailer
 from flask.ext.testing import (TestCase as Base, Twill)
 
 from app import create_app
-from app.user import User, UserDetail, ADMIN, USER, ACTIVE
+from app.user import User, UserDetail, ADMIN, USER, NEW, ACTIVE
+from app.user.cache import user_cache
+from app.user.constants import INACTIVE
+from app.user.bulk import Checkpoint, UserImporter, read_records
+from app.user.seed import SEED_PASSWORD, generate_batches, seed_users
 from config import TestConfig
-from app.extensions import db, mail
+from app.extensions import (db, mail, email_renderer, hasher, cors, log,
+                            static_root, jsend, metrics)
+from app.utils import get_resource_as_string
+from app.hashing import HashingExecutor, HashingQueueFull, HashingTimeout
+from app.passwords import calibrate, make_context
+from app import passwords
+from app.outbox import (OutboxMessage, enqueue, process_pending, PENDING,
+                        SENT, FAILED)
+from app.outbox.worker import claim
+from app.log import BufferedHandler, DigestMailHandler
+from app.jsend import JSend, SUCCESS
+from app.middleware import PreflightMiddleware
+from app.timing import parse_request_start
+from app.metrics import Counter, Gauge, Histogram
 
 
 class TestCase(Base):
@@ -153,6 +185,50 @@ class TestUser(TestCase):
         assert 'success' in rv.data
         self.logout()
 
+    def test_get_list(self):
+        self.login(email='admin@example.com', password='default')
+        # Get first page of users.
+        rv = self.client.get('/users/?limit=1', environ_base=self.ENVIRON_BASE)
+        self.assert_200(rv)
+        data = json.loads(rv.data)['data']
+        assert [u['username'] for u in data['users']] == ['demo']
+        assert 'after=1' in data['next']
+        assert 'rel="next"' in rv.headers['Link']
+        # Follow the cursor to the last page.
+        rv = self.client.get('/users/?limit=1&after=1',
+                             environ_base=self.ENVIRON_BASE)
+        data = json.loads(rv.data)['data']
+        assert [u['username'] for u in data['users']] == ['admin']
+        assert data['next'] is None
+        # Stream the whole list.
+        rv = self.client.get('/users/?stream=1', environ_base=self.ENVIRON_BASE)
+        self.assert_200(rv)
+        data = json.loads(rv.data)['data']
+        assert [u['username'] for u in data['users']] == ['demo', 'admin']
+        assert data['users'][0]['dob'] == '1985-01-17'
+        self.logout()
+
+    def test_get_fields(self):
+        self.login(email='admin@example.com', password='default')
+        # Project a page of users on some fields.
+        rv = self.client.get('/users/?fields=username,dob&limit=1',
+                             environ_base=self.ENVIRON_BASE)
+        self.assert_200(rv)
+        data = json.loads(rv.data)['data']
+        assert data['users'] == [{'username': 'demo', 'dob': '1985-01-17'}]
+        assert 'fields=username%2Cdob' in data['next']
+        # Project a user on some fields.
+        rv = self.client.get('/users/%d/?fields=id,status' % 1,
+                             environ_base=self.ENVIRON_BASE)
+        data = json.loads(rv.data)['data']
+        assert data == {'id': 1, 'status': 'active'}
+        # Unknown fields fail.
+        rv = self.client.get('/users/?fields=password',
+                             environ_base=self.ENVIRON_BASE)
+        self.assert_200(rv)
+        assert 'fail' in rv.data
+        self.logout()
+
     def test_register(self):
         data = {
             'username': 'member',
@@ -219,6 +295,8 @@ class TestUser(TestCase):
                                         data=json.dumps(data),
                                         content_type='application/json',
                                         environ_base=self.ENVIRON_BASE)
+            assert len(outbox) == 0
+            assert process_pending() == 1
             assert len(outbox) == 1
             assert outbox[0].subject == "Recover your password"
         user = User.query.filter_by(email=data.get('email')).first()
@@ -278,6 +356,7 @@ class TestMeta(TestCase):
             response = self.client.post('/mail/', data=json.dumps(data),
                                         content_type='application/json',
                                         environ_base=self.ENVIRON_BASE)
+            process_pending()
             assert len(outbox) == 1
             subject = '[%s] Message from %s: %s' % (current_app.config['APP_NAME'], data.get('full_name'), data.get('subject'))
             assert outbox[0].subject == subject
@@ -285,6 +364,725 @@ class TestMeta(TestCase):
             # TODO assert "Thanks for your message. We'll get back to you shortly." in response.data
 
 
+class TestOutbox(TestCase):
+
+    def test_retry_backoff(self):
+        # Deactivation queues a receipt email in the same transaction.
+        self.login(email='demo@example.com', password='default')
+        rv = self.client.delete('/users/%d/' % 1,
+                                environ_base=self.ENVIRON_BASE)
+        self.assert_200(rv)
+        message = OutboxMessage.query.one()
+        assert message.status_id == PENDING
+
+        # SMTP is down: the message is retried later, then given up on.
+        def fail(message, connection):
+            raise socket.error('Connection refused')
+        send = Message.send
+        Message.send = fail
+        try:
+            assert process_pending() == 0
+            message = OutboxMessage.query.one()
+            assert message.status_id == PENDING
+            assert message.attempts == 1
+            assert message.next_attempt_time > datetime.datetime.utcnow()
+            # Not due yet.
+            assert process_pending() == 0
+            assert OutboxMessage.query.one().attempts == 1
+
+            current_app.config['OUTBOX_MAX_ATTEMPTS'] = 2
+            message.next_attempt_time = datetime.datetime.utcnow()
+            db.session.commit()
+            assert process_pending() == 0
+            assert OutboxMessage.query.one().status_id == FAILED
+        finally:
+            Message.send = send
+
+    def test_send(self):
+        data = {'email': 'demo@example.com'}
+        self.client.post('/users/password/reset/', data=json.dumps(data),
+                         content_type='application/json',
+                         environ_base=self.ENVIRON_BASE)
+        with mail.record_messages() as outbox:
+            assert process_pending() == 1
+            assert process_pending() == 0
+            assert outbox[0].recipients == ['demo@example.com']
+        message = OutboxMessage.query.one()
+        assert message.status_id == SENT
+        assert message.sent_time is not None
+
+    def test_poison_message(self):
+        for subject in ('First', 'Poison', 'Last'):
+            enqueue(Message(subject, recipients=['demo@example.com'],
+                            body='Hello.'))
+        db.session.commit()
+
+        # A message that can't be sent, for any other reason than SMTP.
+        send = Message.send
+        def fail(message, connection):
+            if message.subject == 'Poison':
+                raise UnicodeEncodeError('ascii', u'', 0, 1, 'poison')
+            return send(message, connection)
+        Message.send = fail
+        try:
+            with mail.record_messages() as outbox:
+                assert process_pending() == 2
+            assert [m.subject for m in outbox] == ['First', 'Last']
+        finally:
+            Message.send = send
+        poison = OutboxMessage.query.filter_by(subject='Poison').one()
+        assert poison.status_id == FAILED and poison.attempts == 1
+        assert 'UnicodeEncodeError' in poison.last_error
+
+    def test_abandoned_claim(self):
+        enqueue(Message('Hello', recipients=['demo@example.com'],
+                        body='Hello.'))
+        db.session.commit()
+        # Claimed for the last time by a worker that then died.
+        current_app.config['OUTBOX_MAX_ATTEMPTS'] = 1
+        assert len(claim(10)) == 1
+        message = OutboxMessage.query.one()
+        message.next_attempt_time = datetime.datetime.utcnow()
+        db.session.commit()
+        assert claim(10) == []
+        message = OutboxMessage.query.one()
+        assert message.status_id == FAILED and message.attempts == 1
+
+
+class TestEmails(TestCase):
+
+    def test_render(self):
+        context = dict(username=u'<demo>', email_recipient='demo@example.com',
+                       change_password_url='http://example.com/?a=1&b=2')
+        template = 'user/emails/reset_password.html'
+        with self.app.test_request_context():
+            css = get_resource_as_string('static/css/email.css')
+            expected = Premailer(render_template(template, css=css,
+                                                 **context)).transform()
+            assert email_renderer.render(template, **context) == expected
+            # The inlined skeleton is cached and refilled.
+            assert len(current_app.extensions['email_renderer']) == 1
+            context['username'] = u'admin'
+            html = email_renderer.render(template, **context)
+            assert 'Forgot your password, admin?' in html
+            assert len(current_app.extensions['email_renderer']) == 1
+
+
+class TestHashing(TestCase):
+
+    def test_pool(self):
+        executor = HashingExecutor()
+        self.app.config['PASSWORD_HASH_WORKERS'] = 2
+        self.app.config['PASSWORD_ROUNDS'] = 1000
+        executor.init_app(self.app)
+        try:
+            hash = executor.encrypt('default')
+            assert executor.verify('default', hash) is True
+            assert executor.verify('wrong', hash) is False
+            stats = executor.stats.as_dict()
+            assert stats['count'] == 3
+            assert stats['hash_time'] > 0
+
+            # No free slot within the timeout.
+            executor.queue_size = 0
+            executor.timeout = 0.01
+            self.assertRaises(HashingQueueFull, executor.verify, 'default', hash)
+            assert executor.stats.rejected == 1
+        finally:
+            executor.shutdown()
+
+    def test_timeout(self):
+        executor = HashingExecutor()
+        self.app.config['PASSWORD_HASH_WORKERS'] = 1
+        self.app.config['PASSWORD_HASH_TIMEOUT'] = 0.001
+        self.app.config['PASSWORD_ROUNDS'] = 500000
+        executor.init_app(self.app)
+        try:
+            self.assertRaises(HashingTimeout, executor.encrypt, 'default')
+        finally:
+            executor.shutdown()
+
+    def test_timeouts_hold_slots(self):
+        executor = HashingExecutor()
+        self.app.config['PASSWORD_HASH_WORKERS'] = 1
+        self.app.config['PASSWORD_HASH_QUEUE_SIZE'] = 2
+        self.app.config['PASSWORD_HASH_TIMEOUT'] = 0.01
+        self.app.config['PASSWORD_ROUNDS'] = 200000
+        executor.init_app(self.app)
+        try:
+            # Hashes given up on still take a slot until they're done...
+            self.assertRaises(HashingTimeout, executor.encrypt, 'default')
+            self.assertRaises(HashingTimeout, executor.encrypt, 'default')
+            assert executor._in_flight == 2
+            # ...so past the queue size, requests are turned away at once.
+            self.assertRaises(HashingQueueFull, executor.encrypt, 'default')
+            assert executor._in_flight == 2
+            deadline = time.time() + 30
+            while executor._in_flight and time.time() < deadline:
+                time.sleep(0.01)
+            assert executor._in_flight == 0
+            # Errors in the pool give their slot back too.
+            executor.timeout = 30
+            self.assertRaises(ValueError, executor.verify, 'default', 'junk')
+            assert executor._in_flight == 0
+        finally:
+            executor.shutdown()
+
+    def test_queue_full_response(self):
+        # Every slot taken: logins are turned away until hashes are done.
+        hasher.workers = 1
+        hasher.queue_size = 0
+        hasher.timeout = 0.01
+        try:
+            rv = self.client.post('/session/',
+                                  data={'email': 'demo@example.com',
+                                        'password': 'default'},
+                                  environ_base=self.ENVIRON_BASE)
+        finally:
+            hasher.init_app(self.app)
+        assert rv.status_code == 503
+        assert rv.headers['Retry-After'] == '5'
+        assert json.loads(rv.data)['status'] == 'error'
+
+
+class TestPasswords(TestCase):
+
+    def test_rehash_on_login(self):
+        user = User.query.filter_by(email='demo@example.com').first()
+        user._password = sha256_crypt.encrypt('default', rounds=1000)
+        db.session.commit()
+
+        user, authenticated = User.authenticate('demo@example.com', 'wrong')
+        assert authenticated is False
+        assert sha256_crypt.from_string(user.password).rounds == 1000
+
+        user, authenticated = User.authenticate('demo@example.com', 'default')
+        assert authenticated is True
+        assert sha256_crypt.from_string(user.password).rounds == 12345
+        # authenticate() leaves the commit to the view.
+        db.session.rollback()
+        assert sha256_crypt.from_string(user.password).rounds == 1000
+
+        rv = self.login('demo@example.com', 'default')
+        assert json.loads(rv.data)['status'] == 'success'
+        db.session.remove()
+        user = User.query.filter_by(email='demo@example.com').first()
+        assert sha256_crypt.from_string(user.password).rounds == 12345
+        assert user.check_password('default') is True
+
+    def test_rehash_deprecated_scheme(self):
+        user = User.query.filter_by(email='demo@example.com').first()
+        user._password = md5_crypt.encrypt('default')
+        db.session.commit()
+        self.app.config['PASSWORD_SCHEMES'] = ['sha256_crypt', 'md5_crypt']
+        hasher.init_app(self.app)
+
+        user, authenticated = User.authenticate('demo@example.com', 'default')
+        assert authenticated is True
+        assert sha256_crypt.identify(user.password)
+
+    def test_login_lookup(self):
+        user, authenticated = User.authenticate(' Demo ', 'default')
+        assert user.username == 'demo' and authenticated is True
+        user, authenticated = User.authenticate('DEMO@example.com', 'default')
+        assert user.username == 'demo' and authenticated is True
+        user, authenticated = User.authenticate('demo@', 'default')
+        assert user is None and authenticated is False
+        self.login(email='Admin@Example.com', password='default')
+
+        # Usernames registered with an '@' still log in.
+        user = User.get_by_login('demo')
+        user.username = u'Demo@Home'
+        db.session.commit()
+        user, authenticated = User.authenticate('demo@home', 'default')
+        assert user.email == 'demo@example.com' and authenticated is True
+
+    def test_calibrate(self):
+        # A host verifying one round per microsecond.
+        measure = passwords.measure
+        passwords.measure = lambda scheme, rounds, samples=3: rounds * 1e-6
+        try:
+            rounds = calibrate('sha256_crypt', 0.005)
+        finally:
+            passwords.measure = measure
+        assert abs(rounds - 5000) <= 1
+        context = make_context(['sha256_crypt'], 10000, 0.25)
+        assert not context.needs_update(sha256_crypt.encrypt('x', rounds=12000))
+        assert context.needs_update(sha256_crypt.encrypt('x', rounds=13000))
+
+
+class TestUserCache(TestCase):
+
+    def test_load_user(self):
+        self.login(email='demo@example.com', password='default')
+        user_cache.clear()
+        for i in range(3):
+            rv = self.client.get('/session/', environ_base=self.ENVIRON_BASE)
+            assert json.loads(rv.data)['data']['username'] == 'demo'
+        stats = user_cache.stats()
+        assert stats['misses'] == 1 and stats['hits'] == 2
+
+        # A rolled back change doesn't invalidate the cached user.
+        user = User.query.filter_by(email='demo@example.com').first()
+        user.username = u'changed'
+        db.session.flush()
+        db.session.rollback()
+        assert user_cache.stats()['invalidations'] == 0
+
+        # A committed one does.
+        user = User.query.filter_by(email='demo@example.com').first()
+        user.username = u'demo2'
+        db.session.commit()
+        assert user_cache.stats()['invalidations'] == 1
+        rv = self.client.get('/session/', environ_base=self.ENVIRON_BASE)
+        assert json.loads(rv.data)['data']['username'] == 'demo2'
+        assert user_cache.stats()['misses'] == 2
+
+
+class TestCrossdomain(TestCase):
+
+    def test_preflight(self):
+        for i in range(2):
+            rv = self.client.open('/users/1/', method='OPTIONS',
+                                  environ_base=self.ENVIRON_BASE)
+            self.assert_200(rv)
+            assert rv.data == ''
+            assert rv.headers['Access-Control-Allow-Origin'] == 'http://localhost:9000'
+            assert 'PUT' in rv.headers['Access-Control-Allow-Methods']
+            assert rv.headers['Access-Control-Allow-Headers'] == 'CONTENT-TYPE'
+            assert 'GET' in rv.headers['Allow']
+            assert rv.headers['Access-Control-Max-Age'] == '21600'
+            assert rv.headers['Vary'] == 'Origin'
+
+    def test_preflight_middleware(self):
+        # Flask's answer, with the middlewares bypassed.
+        middleware = self.app.wsgi_app
+        preflight = middleware.wsgi_app
+        assert isinstance(preflight, PreflightMiddleware)
+        self.app.wsgi_app = preflight.wsgi_app
+        try:
+            expected = self.client.open('/session/', method='OPTIONS',
+                                        environ_base=self.ENVIRON_BASE)
+        finally:
+            self.app.wsgi_app = middleware
+
+        def fail():
+            raise AssertionError('Preflight reached Flask.')
+        self.app.before_request_funcs.setdefault(None, []).insert(0, fail)
+        rv = self.client.open('/session/', method='OPTIONS',
+                              environ_base=self.ENVIRON_BASE)
+        self.assert_200(rv)
+        assert rv.data == ''
+        # Minus the session cookie Flask saves for Flask-Login's session id.
+        expected.headers.pop('Set-Cookie')
+        assert sorted(rv.headers.items()) == sorted(expected.headers.items())
+
+        # Forbidden origins go through to Flask, for its 403.
+        self.app.before_request_funcs[None].remove(fail)
+        rv = self.client.open('/session/', method='OPTIONS',
+                              environ_base={'HTTP_ORIGIN': 'http://evil.com'})
+        self.assert_403(rv)
+
+    def test_origins(self):
+        self.app.config['ORIGINS_ALLOWED'] = ['http://localhost:9000',
+                                              'https://*.example.com']
+        cors.init_app(self.app)
+        for origin, status in (('https://www.example.com', 200),
+                               ('https://a.b.EXAMPLE.com', 200),
+                               ('https://example.com', 403),
+                               ('https://www.example.com.evil.com', 403),
+                               ('http://localhost', 403)):
+            rv = self.client.get('/session/', environ_base={'HTTP_ORIGIN': origin})
+            self.assertStatus(rv, status)
+            if status == 200:
+                assert rv.headers['Access-Control-Allow-Origin'] == origin
+                assert 'Origin' in rv.headers['Vary']
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestLog(TestCase):
+
+    def setUp(self):
+        super(TestLog, self).setUp()
+        self.handler = RecordingHandler()
+        self.app.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.app.logger.removeHandler(self.handler)
+        self.app.logger.setLevel(logging.NOTSET)
+        super(TestLog, self).tearDown()
+
+    def test_deferred_fields(self):
+        formatted = []
+
+        class Field(object):
+            def __repr__(self):
+                formatted.append(self)
+                return 'field'
+
+        # Disabled levels cost no formatting.
+        self.app.logger.setLevel(logging.INFO)
+        log.debug('Skipped', field=Field())
+        assert self.handler.records == []
+        assert formatted == []
+
+        self.app.logger.setLevel(logging.DEBUG)
+        log.debug('Kept', field=Field(), errors={'email': ['Invalid.']})
+        message = self.handler.records[-1].getMessage()
+        assert message.startswith('Kept endpoint=')
+        assert message.endswith(' errors={"email": ["Invalid."]} field="field"')
+
+        # Within requests records carry the endpoint.
+        rv = self.client.get('/session/', environ_base=self.ENVIRON_BASE)
+        self.assert_200(rv)
+        record = self.handler.records[-2]
+        assert record.fields['endpoint'] == 'session.get'
+        assert record.getMessage().startswith('Returning success')
+        # Followed by the request's timings.
+        assert self.handler.records[-1].getMessage().startswith(
+            'Request timings')
+
+    def test_sampling(self):
+        self.app.logger.setLevel(logging.DEBUG)
+        self.app.config['LOG_SAMPLE_RATES'] = {'session.get': 0}
+        log.init_app(self.app)
+        rv = self.client.get('/session/', environ_base=self.ENVIRON_BASE)
+        self.assert_200(rv)
+        assert self.handler.records == []
+        # Warnings are always kept.
+        rv = self.client.get('/session/', environ_base={'HTTP_ORIGIN': 'http://evil.com'})
+        self.assert_403(rv)
+        assert [r.levelno for r in self.handler.records] == [logging.WARNING]
+
+    def test_buffered_handler(self):
+        handler = BufferedHandler([self.handler], capacity=2)
+        self.app.logger.removeHandler(self.handler)
+        self.app.logger.addHandler(handler)
+        try:
+            self.app.logger.setLevel(logging.DEBUG)
+            with self.app.test_request_context():
+                log.info('Buffered', n=1)
+            handler.flush()
+            record = self.handler.records[-1]
+            assert record.getMessage().startswith('Buffered ')
+            assert record.fields['n'] == 1
+
+            # A stuck target handler doesn't block logging; the overflow
+            # is dropped.
+            release = threading.Event()
+            self.handler.emit = lambda record: release.wait()
+            for i in range(4):
+                log.info('Overflow')
+            assert handler.dropped >= 1
+            release.set()
+            handler.flush()
+        finally:
+            self.app.logger.removeHandler(handler)
+
+
+class RecordingDigestHandler(DigestMailHandler):
+
+    def __init__(self, **kwargs):
+        DigestMailHandler.__init__(self, ('localhost', 25), 'app@example.com',
+                                   ['admin@example.com'], 'Oops', **kwargs)
+        self.digests = []
+        self.sent = threading.Event()
+
+    def deliver(self, subject, body):
+        self.digests.append((subject, body))
+        self.sent.set()
+
+
+class TestErrorMails(TestCase):
+
+    def setUp(self):
+        super(TestErrorMails, self).setUp()
+        self.app.logger.setLevel(logging.ERROR)
+
+    def tearDown(self):
+        self.app.logger.setLevel(logging.NOTSET)
+        super(TestErrorMails, self).tearDown()
+
+    def test_digest(self):
+        handler = RecordingDigestHandler(window=0.2)
+        self.app.logger.addHandler(handler)
+        try:
+            for i in range(50):
+                log.error('Giving up', id=i)
+            try:
+                raise ValueError('boom')
+            except ValueError:
+                log.exception('Failed')
+            # Nothing is sent before the window closes.
+            handler.flush()
+            assert handler.digests == []
+            assert handler.sent.wait(5)
+        finally:
+            self.app.logger.removeHandler(handler)
+        subject, body = handler.digests[0]
+        assert subject == 'Oops (51 errors, 2 distinct)'
+        assert body.startswith('50 times, first at ')
+        assert 'Giving up' in body and 'id=0' in body and 'id=1 ' not in body
+        assert 'ValueError: boom' in body
+
+    def test_rate_limit(self):
+        handler = RecordingDigestHandler(max_per_hour=1, max_errors=1)
+        handler.collect(logging.makeLogRecord({'msg': 'First', 'levelno': 40}))
+        assert handler.send_digest()
+        # Over the limit: errors wait for the next digest.
+        handler.collect(logging.makeLogRecord({'msg': 'Second', 'levelno': 40}))
+        handler.collect(logging.makeLogRecord({'msg': 'Third', 'levelno': 40}))
+        assert not handler.send_digest()
+        assert len(handler.digests) == 1
+        assert handler.send_digest(now=time.time() + 3600)
+        subject, body = handler.digests[1]
+        assert subject == 'Oops (2 errors, 1 distinct)'
+        assert body.endswith('1 more errors not detailed.')
+
+
+class TestSitemap(TestCase):
+
+    def test_sitemap(self):
+        rv = self.client.get('/sitemap.xml')
+        self.assert_200(rv)
+        assert '<loc>http://localhost/users/</loc>' in rv.data
+        etag = rv.headers['ETag']
+        assert rv.headers['Cache-Control'] == 'public, max-age=86400'
+
+        rv = self.client.get('/sitemap.xml',
+                             headers={'Accept-Encoding': 'gzip, deflate'})
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert rv.headers['ETag'] != etag
+        assert 'Accept-Encoding' in rv.headers['Vary']
+        data = gzip.GzipFile(fileobj=StringIO(rv.data)).read()
+        assert '<loc>http://localhost/users/</loc>' in data
+
+        rv = self.client.get('/sitemap.xml', headers={'If-None-Match': etag})
+        self.assertStatus(rv, 304)
+        assert rv.data == ''
+
+    def test_sitemap_index(self):
+        self.app.config['SITEMAP_MAX_URLS'] = 5
+        rules = len(list(self.app.url_map.iter_rules()))
+        pages = (rules + 4) // 5
+        rv = self.client.get('/sitemap.xml')
+        assert '<sitemapindex' in rv.data
+        assert rv.data.count('<sitemap>') == pages
+        for page in range(1, pages + 1):
+            rv = self.client.get('/sitemap-%d.xml' % page)
+            self.assert_200(rv)
+            assert 0 < rv.data.count('<url>') <= 5
+        self.assert_404(self.client.get('/sitemap-%d.xml' % (pages + 1)))
+
+
+class TestStaticRoot(TestCase):
+
+    def test_from_memory(self):
+        robots = get_resource_as_string('static/robots.txt')
+        rv = self.client.get('/robots.txt')
+        self.assert_200(rv)
+        assert rv.data == robots
+        assert rv.headers['Content-Type'].startswith('text/plain')
+        assert rv.headers['Cache-Control'] == 'public, max-age=604800'
+        rv = self.client.get('/robots.txt',
+                             headers={'If-None-Match': rv.headers['ETag']})
+        self.assertStatus(rv, 304)
+
+        rv = self.client.get('/humans.txt', headers={'Accept-Encoding': 'gzip'})
+        self.assert_200(rv)
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert gzip.GzipFile(fileobj=StringIO(rv.data)).read() == \
+            get_resource_as_string('static/humans.txt')
+        self.assert_200(self.client.get('/crossdomain.xml'))
+
+        # Files are read at startup only.
+        def fail(*args):
+            raise AssertionError('Read from disk.')
+        original, __builtins__['open'] = open, fail
+        try:
+            self.assert_200(self.client.get('/robots.txt'))
+        finally:
+            __builtins__['open'] = original
+
+    def test_sendfile(self):
+        self.app.config['STATIC_SENDFILE'] = 'X-Accel-Redirect'
+        self.app.config['STATIC_SENDFILE_MIN_SIZE'] = 0
+        static_root.init_app(self.app)
+        rv = self.client.get('/robots.txt')
+        self.assert_200(rv)
+        assert rv.data == ''
+        assert rv.headers['X-Accel-Redirect'] == '/static-internal/robots.txt'
+
+    def test_uncached(self):
+        self.app.config['STATIC_ROOT_CACHE'] = False
+        static_root.init_app(self.app)
+        rv = self.client.get('/robots.txt')
+        self.assert_200(rv)
+        assert rv.data == get_resource_as_string('static/robots.txt')
+
+
+class TestJSend(TestCase):
+
+    def test_responses(self):
+        rv = jsend.success({'users': [{'url': 'http://a/b'}, 1]})
+        assert rv.data == '{"status":"success","data":{"users":[{"url":"http://a/b"},1]}}'
+        assert rv.headers['Content-Length'] == str(len(rv.data))
+        assert rv.mimetype == 'application/json'
+        assert json.loads(jsend.fail({'email': u'D\xe9j\xe0'}).data) == \
+            {'status': 'fail', 'data': {'email': u'D\xe9j\xe0'}}
+        rv = jsend.error('Wrong data.', 405)
+        self.assertStatus(rv, 405)
+        assert json.loads(rv.data) == {'status': 'error', 'message': 'Wrong data.'}
+        assert jsend.success().data == SUCCESS
+
+        rv = self.client.get('/session/', environ_base=self.ENVIRON_BASE)
+        assert rv.data == '{"status":"success","data":{"auth":false}}'
+
+    def test_encoder(self):
+        self.app.config['JSEND_ENCODER'] = 'json'
+        JSend(self.app)
+        self.app.config['JSEND_ENCODER'] = 'marshal'
+        self.assertRaises(ValueError, JSend, self.app)
+
+
+class TestCompression(TestCase):
+
+    def setUp(self):
+        super(TestCompression, self).setUp()
+        self.app.config['COMPRESS_MIN_SIZE'] = 0
+        self.login(email='admin@example.com', password='default')
+        self.stats = self.app.extensions['compression']
+        self.stats.reset()
+
+    def test_gzip(self):
+        plain = self.client.get('/users/', environ_base=self.ENVIRON_BASE)
+        assert 'Content-Encoding' not in plain.headers
+        rv = self.client.get('/users/', environ_base=self.ENVIRON_BASE,
+                             headers={'Accept-Encoding': 'gzip;q=1.0, *;q=0.5'})
+        self.assert_200(rv)
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert 'Content-Length' not in rv.headers
+        assert set(rv.headers['Vary'].split(', ')) == \
+            set(['Cookie', 'Origin', 'Accept-Encoding'])
+        assert gzip.GzipFile(fileobj=StringIO(rv.data)).read() == plain.data
+        stats = self.stats.as_dict()
+        assert stats['responses'] == 1
+        assert stats['bytes_in'] == len(plain.data)
+        assert stats['ns_per_byte'] > 0
+
+    def test_deflate_stream(self):
+        plain = self.client.get('/users/?stream=1', environ_base=self.ENVIRON_BASE)
+        rv = self.client.get('/users/?stream=1', environ_base=self.ENVIRON_BASE,
+                             headers={'Accept-Encoding': 'deflate'})
+        assert rv.headers['Content-Encoding'] == 'deflate'
+        assert zlib.decompress(rv.data) == plain.data
+
+    def test_skipped(self):
+        # Too short
+        self.app.config['COMPRESS_MIN_SIZE'] = 10000
+        rv = self.client.get('/users/', environ_base=self.ENVIRON_BASE,
+                             headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in rv.headers
+        # Not accepted
+        self.app.config['COMPRESS_MIN_SIZE'] = 0
+        rv = self.client.get('/users/', environ_base=self.ENVIRON_BASE,
+                             headers={'Accept-Encoding': 'gzip;q=0, identity'})
+        assert 'Content-Encoding' not in rv.headers
+        assert self.stats.as_dict()['responses'] == 0
+
+    def test_etag(self):
+        # The sitemap has no deflate variant of its own.
+        rv = self.client.get('/sitemap.xml', headers={'Accept-Encoding': 'deflate'})
+        assert rv.headers['Content-Encoding'] == 'deflate'
+        etag = rv.headers['ETag']
+        assert etag.startswith('W/"')
+        rv = self.client.get('/sitemap.xml', headers={
+            'Accept-Encoding': 'deflate', 'If-None-Match': etag})
+        self.assertStatus(rv, 304)
+
+
+class TestConditionalGet(TestCase):
+
+    def count_statements(self):
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        # Each test app has its own engine, so this goes away with it.
+        event.listen(db.get_engine(self.app), 'before_cursor_execute', count)
+        return statements
+
+    def get(self, url, etag=None):
+        headers = {'If-None-Match': etag} if etag else {}
+        return self.client.get(url, environ_base=self.ENVIRON_BASE,
+                               headers=headers)
+
+    def test_user(self):
+        self.login(email='demo@example.com', password='default')
+        rv = self.get('/users/1/')
+        self.assert_200(rv)
+        etag = rv.headers['ETag']
+        assert etag.startswith('W/"')
+        assert rv.headers['Cache-Control'] == 'no-cache, private'
+        # Revalidated with one version query.
+        statements = self.count_statements()
+        rv = self.get('/users/1/', etag)
+        self.assertStatus(rv, 304)
+        assert rv.data == ''
+        assert len(statements) == 1 and 'updated_time' in statements[0]
+        # Projections are tagged apart.
+        assert self.get('/users/1/?fields=id', etag).status_code == 200
+
+        # Updating the user's details changes the ETag.
+        user = User.query.get(1)
+        user.user_detail.bio = u'New bio.'
+        db.session.commit()
+        rv = self.get('/users/1/', etag)
+        self.assert_200(rv)
+        assert 'New bio.' in rv.data
+        assert rv.headers['ETag'] != etag
+
+    def test_list(self):
+        self.login(email='admin@example.com', password='default')
+        rv = self.get('/users/')
+        etag = rv.headers['ETag']
+        self.assertStatus(self.get('/users/', etag), 304)
+        # A new user changes the page.
+        db.session.add(User(username=u'new', email='new@example.com',
+                            password='default'))
+        db.session.commit()
+        self.assert_200(self.get('/users/', etag))
+
+    def test_session(self):
+        rv = self.get('/session/')
+        anonymous = rv.headers['ETag']
+        self.assertStatus(self.get('/session/', anonymous), 304)
+
+        self.login(email='demo@example.com', password='default')
+        rv = self.get('/session/', anonymous)
+        self.assert_200(rv)
+        etag = rv.headers['ETag']
+        statements = self.count_statements()
+        self.assertStatus(self.get('/session/', etag), 304)
+        assert statements == []
+
+        user = User.query.get(1)
+        user.email = 'demo2@example.com'
+        db.session.commit()
+        rv = self.get('/session/', etag)
+        self.assert_200(rv)
+        assert 'demo2@example.com' in rv.data
+
+
 class TestErrors(TestCase):
 
     def test_401(self):
@@ -320,3 +1118,467 @@ class TestErrors(TestCase):
     def test_static_text_file_request(self):
         response = self.client.get('/robots.txt')
         self.assert_200(response)
+
+
+class TestDatabase(TestCase):
+
+    def create_pooled_app(self, **config):
+        app = create_app(TestConfig)
+        app.config.update(SQLALCHEMY_POOL_SIZE=1, SQLALCHEMY_MAX_OVERFLOW=1,
+                          SQLALCHEMY_POOL_TIMEOUT=0.1, **config)
+        return app
+
+    def test_sqlite_pragmas(self):
+        assert db.session.execute('PRAGMA journal_mode').scalar() == 'wal'
+        assert db.session.execute('PRAGMA foreign_keys').scalar() == 1
+
+    def test_pool_stats(self):
+        stats = db.pool_stats(self.app)[None]
+        self.login(email='demo@example.com', password='default')
+        self.client.get('/users/1/', environ_base=self.ENVIRON_BASE)
+        after = db.pool_stats(self.app)[None]
+        assert after['checkouts'] > stats['checkouts']
+        assert after['max_checkout_seconds'] > 0
+        assert after['in_use'] == 0 and after['max_in_use'] >= 1
+        # SQLite files aren't pooled by default.
+        assert after['pool_size'] is None and after['overflow'] == 0
+
+    def test_overflow(self):
+        app = self.create_pooled_app()
+        engine = db.get_engine(app)
+        first, second = engine.connect(), engine.connect()
+        stats = db.pool_stats(app)[None]
+        assert stats['pool_size'] == 1
+        assert stats['in_use'] == 2 and stats['overflow'] == 1
+        from sqlalchemy.exc import TimeoutError
+        self.assertRaises(TimeoutError, engine.connect)
+        # Returned, the overflow connection fills the pool...
+        second.close()
+        stats = db.pool_stats(app)[None]
+        assert stats['in_use'] == 1 and stats['overflow'] == 1
+        assert stats['max_overflow'] == 1 and stats['timeouts'] == 1
+        # ...so the other one is closed.
+        first.close()
+        stats = db.pool_stats(app)[None]
+        assert stats['in_use'] == 0 and stats['overflow'] == 0
+
+    def test_sqlite_pool_across_threads(self):
+        app = self.create_pooled_app()
+        engine = db.get_engine(app)
+        engine.execute('SELECT 1')
+        results = []
+        # Checks out the connection the main thread opened.
+        thread = threading.Thread(
+            target=lambda: results.append(engine.execute('SELECT 1').scalar()))
+        thread.start()
+        thread.join()
+        assert results == [1]
+
+    def test_pre_ping(self):
+        app = self.create_pooled_app(SQLALCHEMY_POOL_PRE_PING=True)
+        engine = db.get_engine(app)
+        connection = engine.connect()
+        # The server drops the connection while it's idle in the pool.
+        dbapi_connection = connection.connection.connection
+        connection.close()
+        dbapi_connection.close()
+        assert engine.execute('SELECT 1').scalar() == 1
+        stats = db.pool_stats(app)[None]
+        assert stats['disconnects'] == 1 and stats['connects'] == 2
+        # The dropped connection isn't left counted as in use.
+        assert stats['in_use'] == 0 and stats['max_in_use'] == 1
+
+
+class TestReplicas(TestCase):
+
+    REPLICA = os.path.join(TestConfig._basedir, 'test-replica.db')
+
+    def create_app(self):
+        app = super(TestReplicas, self).create_app()
+        app.config['SQLALCHEMY_REPLICAS'] = ['sqlite:///' + self.REPLICA]
+        return app
+
+    def setUp(self):
+        super(TestReplicas, self).setUp()
+        self.replica = db.get_engine(self.app, 'replica0')
+        self.replicate()
+        # Requests share the test's session; start them without its writes.
+        db.session.remove()
+
+    def tearDown(self):
+        super(TestReplicas, self).tearDown()
+        db.metadata.drop_all(self.replica)
+
+    def replicate(self):
+        """Copy the primary's rows to the replica."""
+        db.metadata.drop_all(self.replica)
+        db.metadata.create_all(self.replica)
+        primary = db.get_engine(self.app)
+        for table in db.metadata.sorted_tables:
+            rows = [dict(row) for row in primary.execute(table.select())]
+            if rows:
+                self.replica.execute(table.insert(), rows)
+
+    def set_replica_bio(self, bio):
+        self.replica.execute(UserDetail.__table__.update().values(bio=bio))
+
+    def get_user(self):
+        return self.client.get('/users/1/', environ_base=self.ENVIRON_BASE)
+
+    def change_password(self):
+        data = {'password': 'new password', 'password_again': 'new password'}
+        rv = self.client.put('/users/1/', data=json.dumps(data),
+                             content_type='application/json',
+                             environ_base=self.ENVIRON_BASE)
+        assert 'success' in rv.data
+
+    def test_reads_from_replica(self):
+        self.login(email='demo@example.com', password='default')
+        self.set_replica_bio(u'Replicated.')
+        assert 'Replicated.' in self.get_user().data
+        rv = self.client.get('/session/', environ_base=self.ENVIRON_BASE)
+        assert 'demo@example.com' in rv.data
+        stats = db.pool_stats(self.app)
+        assert stats['replica0']['checkouts'] > 0
+
+    def test_user_cache_reads_primary(self):
+        self.login(email='demo@example.com', password='default')
+        self.replica.execute(User.__table__.update()
+                             .where(User.id == 1)
+                             .values(email='lagging@example.com'))
+        user_cache.clear()
+        for i in range(2):
+            rv = self.client.get('/session/', environ_base=self.ENVIRON_BASE)
+            assert 'demo@example.com' in rv.data
+        assert user_cache.stats()['hits'] == 1
+
+    def test_writes_go_to_primary(self):
+        self.login(email='demo@example.com', password='default')
+        self.change_password()
+        user = User.query.get(1)
+        assert user.check_password('new password')
+        replica_hash = self.replica.execute(
+            User.__table__.select().where(User.id == 1)).first()['password']
+        assert replica_hash != user.password
+
+    def test_read_your_writes(self):
+        self.login(email='demo@example.com', password='default')
+        self.set_replica_bio(u'Lagging.')
+        # Sticks to the primary after writing...
+        self.change_password()
+        assert 'Lagging.' not in self.get_user().data
+        # ...until the replica has caught up.
+        self.app.config['SQLALCHEMY_REPLICA_STICKINESS'] = 0
+        self.change_password()
+        assert 'Lagging.' in self.get_user().data
+
+    def test_workers_read_primary(self):
+        # Queued after the replica's last update.
+        self.client.post('/users/password/reset/',
+                         data=json.dumps({'email': 'demo@example.com'}),
+                         content_type='application/json',
+                         environ_base=self.ENVIRON_BASE)
+        db.session.remove()
+        # Workers and commands run in GET request contexts of their own.
+        with self.app.test_request_context():
+            with mail.record_messages() as outbox:
+                assert process_pending() == 1
+            assert len(outbox) == 1
+            db.session.remove()
+
+
+class TestBulkImport(TestCase):
+
+    CSV = '\n'.join([
+        'username,email,password,password_hash,role,status,first_name,bio,dob',
+        'frodo,frodo@example.com,ring bearer,,,,Frodo,A hobbit.,1968-09-22',
+        'sam,sam@example.com,,%s,staff,new,Samwise,,',
+        'nopass,nopass@example.com,,,,,,,',
+        'demo,demo@example.com,duplicate,,,,,,',
+        'merry,merry@example.com,brandybuck,,user,inactive,,,',
+    ]) % sha256_crypt.encrypt('gardener', rounds=5000)
+
+    def import_users(self, data, format='csv', **options):
+        importer = UserImporter(db.get_engine(self.app), hasher.context,
+                                **options)
+        stats = importer.run(read_records(StringIO(data), format))
+        return importer, stats
+
+    def test_import(self):
+        importer, stats = self.import_users(self.CSV, batch_size=2)
+        assert (stats.read, stats.imported, stats.skipped, stats.invalid) == \
+            (5, 3, 1, 1)
+        assert importer.errors == [(3, 'Missing password or password_hash.')]
+        assert 'users/s' in stats.report()
+
+        frodo = User.query.filter_by(username='frodo').first()
+        assert frodo.check_password('ring bearer')
+        assert frodo.user_detail.bio == 'A hobbit.'
+        assert frodo.user_detail.dob == datetime.date(1968, 9, 22)
+        assert frodo.status_id == ACTIVE and frodo.role_id == USER
+        user, authenticated = User.authenticate('sam@example.com', 'gardener')
+        assert authenticated and user.user_detail.first_name == 'Samwise'
+        # The imported hash was rehashed with the current policy's rounds.
+        assert '$rounds=5000$' not in user.password
+        assert User.get_by_login('merry').get_status() == 'inactive'
+
+    def test_jsonl_in_workers(self):
+        lines = [json.dumps({'username': 'user%d' % i,
+                             'email': 'user%d@example.com' % i,
+                             'password': 'password%d' % i}) for i in range(6)]
+        lines.insert(2, '{not json')
+        importer, stats = self.import_users('\n'.join(lines), 'jsonl',
+                                            batch_size=2, workers=2)
+        assert stats.imported == 6 and stats.invalid == 1
+        assert stats.hash_seconds > 0
+        assert User.get_by_login('user5').check_password('password5')
+
+    def test_resume(self):
+        path = os.path.join(TestConfig._basedir, 'test-import.checkpoint')
+        # The first 4 records were done before the import was interrupted.
+        Checkpoint(path).save(4)
+        importer, stats = self.import_users(self.CSV, checkpoint=path)
+        assert stats.imported == 1
+        assert User.get_by_login('merry') is not None
+        assert User.get_by_login('frodo') is None
+        assert not os.path.exists(path)
+
+
+class TestSeed(TestCase):
+
+    def generate(self, count, seed=0, start=0, batch_size=100):
+        return [row for batch, seconds in
+                generate_batches(count, seed, start, batch_size)
+                for row in batch[1]]
+
+    def test_deterministic(self):
+        key = lambda rows: [(user['username'], detail['bio'])
+                            for user, detail, password in rows]
+        assert key(self.generate(1500)) == key(self.generate(1500))
+        assert key(self.generate(150)) != key(self.generate(150, seed=1))
+        # However the users are split into runs and batches.
+        assert key(self.generate(1500)) == \
+            key(self.generate(1037, batch_size=300)) + \
+            key(self.generate(463, start=1037, batch_size=70))
+
+    def test_distributions(self):
+        rows = self.generate(2000)
+        statuses = [user['status_id'] for user, detail, password in rows]
+        assert 0.7 < statuses.count(ACTIVE) / 2000.0 < 0.9
+        assert set(statuses) == set([ACTIVE, NEW, INACTIVE])
+        assert all(user['activation_key'] for user, detail, password in rows
+                   if user['status_id'] == NEW)
+        bios = [len(detail['bio'] or '') for user, detail, password in rows]
+        assert 0 in bios and max(bios) > 1000
+        assert len(set(user['email_key'] for user, detail, password
+                       in rows)) == 2000
+
+    def test_seed(self):
+        stats = seed_users(db.get_engine(self.app), hasher.context, 120,
+                           batch_size=50)
+        assert stats.imported == 120
+        assert User.query.count() == 122
+        user = User.query.get(3)
+        assert user.check_password(SEED_PASSWORD)
+        assert user.user_detail.first_name
+        # Seeding again only adds the users that aren't there yet.
+        stats = seed_users(db.get_engine(self.app), hasher.context, 150,
+                           batch_size=50)
+        assert stats.imported == 30 and stats.skipped == 120
+
+
+class TestTiming(TestCase):
+
+    def create_app(self):
+        app = super(TestTiming, self).create_app()
+        app.config['SERVER_TIMING'] = True
+        return app
+
+    def metrics(self, rv):
+        """Return the Server-Timing metrics of a response, by name."""
+        metrics = {}
+        for metric in rv.headers['Server-Timing'].split(', '):
+            name, params = metric.split(';', 1)
+            metrics[name] = dict(param.split('=') for param in
+                                 params.split(';'))
+        return metrics
+
+    def test_login(self):
+        handler = RecordingHandler()
+        self.app.logger.addHandler(handler)
+        self.app.logger.setLevel(logging.INFO)
+        try:
+            rv = self.login(email='demo@example.com', password='default')
+        finally:
+            self.app.logger.removeHandler(handler)
+            self.app.logger.setLevel(logging.NOTSET)
+        metrics = self.metrics(rv)
+        assert float(metrics['hash']['dur']) > 0 and 'db' in metrics
+        assert float(metrics['app']['dur']) >= float(metrics['hash']['dur'])
+        assert 'desc' not in metrics['hash'] and 'queue' not in metrics
+        fields = handler.records[-1].fields
+        assert fields['endpoint'] == 'session.post' and fields['status'] == 200
+        assert fields['hash_count'] == 1 and fields['app_ms'] > 0
+
+    def test_phases(self):
+        rv = self.client.post('/users/password/reset/',
+                              data=json.dumps({'email': 'demo@example.com'}),
+                              content_type='application/json',
+                              environ_base=self.ENVIRON_BASE)
+        assert 'success' in rv.data
+        metrics = self.metrics(rv)
+        for phase in ('db', 'render', 'inline', 'mail'):
+            assert phase in metrics, phase
+        # The email is built from its cached skeleton afterwards.
+        rv = self.client.post('/users/password/reset/',
+                              data=json.dumps({'email': 'demo@example.com'}),
+                              content_type='application/json',
+                              environ_base=self.ENVIRON_BASE)
+        metrics = self.metrics(rv)
+        assert 'render' in metrics and 'inline' not in metrics
+
+        self.login(email='demo@example.com', password='default')
+        rv = self.client.get('/users/1/', environ_base=self.ENVIRON_BASE)
+        assert 'serialize' in self.metrics(rv)
+
+    def test_request_start(self):
+        started = time.time() - 0.6
+        for value in ('t=%.3f' % started, '%d' % (started * 1000),
+                      't=%d' % (started * 1e6)):
+            rv = self.client.get('/session/',
+                                 headers={'X-Request-Start': value},
+                                 environ_base=self.ENVIRON_BASE)
+            assert 500 <= float(self.metrics(rv)['queue']['dur']) < 5000
+        assert parse_request_start('t=soon', time.time()) is None
+        # Clock skew doesn't make for negative waits.
+        assert parse_request_start('%.3f' % (time.time() + 1),
+                                   time.time()) == 0
+
+    def test_disabled(self):
+        # Only for those allowed to read the metrics.
+        self.app.config['SERVER_TIMING'] = False
+        rv = self.client.get('/session/', environ_base=self.ENVIRON_BASE)
+        self.assert_200(rv)
+        assert 'Server-Timing' not in rv.headers
+        self.login(email='demo@example.com', password='default')
+        rv = self.client.get('/session/', environ_base=self.ENVIRON_BASE)
+        assert 'Server-Timing' not in rv.headers
+        self.logout()
+        self.login(email='admin@example.com', password='default')
+        rv = self.client.get('/session/', environ_base=self.ENVIRON_BASE)
+        assert 'app' in self.metrics(rv)
+
+
+class TestMetrics(TestCase):
+
+    def scrape(self, **kwargs):
+        """Return the scraped samples, by name and labels."""
+        rv = self.client.get('/metrics', environ_base=self.ENVIRON_BASE,
+                             **kwargs)
+        self.assert_200(rv)
+        assert rv.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+        samples = {}
+        for line in rv.data.splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+
+    def test_requests(self):
+        ok = 'http_requests_total{endpoint="session.get",method="GET",' \
+            'status="200"}'
+        missing = 'http_requests_total{endpoint="none",method="GET",' \
+            'status="404"}'
+        count = 'http_request_duration_seconds_count{endpoint="session.get"}'
+        self.login(email='admin@example.com', password='default')
+        before = self.scrape()
+        for i in range(3):
+            self.client.get('/session/', environ_base=self.ENVIRON_BASE)
+        self.client.get('/i-am-not-found/', environ_base=self.ENVIRON_BASE)
+        after = self.scrape()
+        assert after[ok] - before.get(ok, 0) == 3
+        assert after[missing] - before.get(missing, 0) == 1
+        assert after[count] - before.get(count, 0) == 3
+
+        buckets = sorted(
+            (float(name.split('le="')[1][:-2]), value)
+            for name, value in after.items()
+            if name.startswith('http_request_duration_seconds_bucket'
+                               '{endpoint="session.get"'))
+        assert [bound for bound, value in buckets] == \
+            list(self.app.config['METRICS_BUCKETS']) + [float('inf')]
+        assert [value for bound, value in buckets] == \
+            sorted(value for bound, value in buckets)
+        assert buckets[-1][1] == after[count]
+        assert after['db_pool_checkouts_total{bind="default"}'] > 0
+        assert after['password_hashes_total'] > 0
+
+    def test_exception(self):
+        def fail():
+            raise ValueError('Failing on purpose')
+        self.app.add_url_rule('/fail/', 'fail', fail)
+        self.assertRaises(ValueError, self.client.get, '/fail/',
+                          environ_base=self.ENVIRON_BASE)
+        self.login(email='admin@example.com', password='default')
+        assert self.scrape()['http_requests_total{endpoint="fail",'
+                             'method="GET",status="500"}'] == 1
+
+    def test_access(self):
+        rv = self.client.get('/metrics', environ_base=self.ENVIRON_BASE)
+        self.assert_401(rv)
+        self.login(email='demo@example.com', password='default')
+        rv = self.client.get('/metrics', environ_base=self.ENVIRON_BASE)
+        self.assert_403(rv)
+        self.logout()
+
+        self.app.config['METRICS_TOKEN'] = 'scraper-token'
+        assert self.scrape(headers={
+            'Authorization': 'Bearer scraper-token'})
+        rv = self.client.get('/metrics', environ_base=self.ENVIRON_BASE,
+                             headers={'Authorization': 'Bearer guessed'})
+        self.assert_401(rv)
+
+    def test_workers(self):
+        requests = 'http_requests_total{endpoint="session.get",' \
+            'method="GET",status="200"}'
+        count = 'http_request_duration_seconds_count{endpoint="session.get"}'
+        self.login(email='admin@example.com', password='default')
+        self.client.get('/session/', environ_base=self.ENVIRON_BASE)
+        own = self.scrape()
+
+        # What a live and an exited worker wrote.
+        exited = subprocess.Popen(['true'])
+        exited.wait()
+        snapshot = [
+            Counter('http_requests_total', 'Requests handled.',
+                    ('endpoint', 'method', 'status')),
+            Gauge('user_cache_size', 'Users cached.'),
+            Histogram('http_request_duration_seconds',
+                      'Seconds spent in the app.', ('endpoint',),
+                      self.app.config['METRICS_BUCKETS']),
+        ]
+        snapshot[0].inc(('session.get', 'GET', 200), 5)
+        snapshot[1].set((), 7)
+        snapshot[2].observe(('session.get',), 0.02)
+        directory = tempfile.mkdtemp()
+        try:
+            for pid in (os.getppid(), exited.pid):
+                with open(os.path.join(directory, 'metrics-%d.json' % pid),
+                          'w') as f:
+                    json.dump([metric.describe() for metric in snapshot], f)
+            self.app.config['METRICS_DIR'] = directory
+            self.app.config['METRICS_FLUSH_INTERVAL'] = 3600
+            samples = self.scrape()
+            assert samples[requests] == own[requests] + 10
+            assert samples[count] == own[count] + 2
+            # Only the live worker's gauges.
+            assert samples['user_cache_size'] == own['user_cache_size'] + 7
+
+            # This process' own file isn't counted twice.
+            metrics.flush(self.app)
+            with open(os.path.join(directory,
+                                   'metrics-%d.json' % os.getpid())) as f:
+                assert 'http_requests_total' in f.read()
+            assert self.scrape()[requests] == own[requests] + 10
+        finally:
+            shutil.rmtree(directory)